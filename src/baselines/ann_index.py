@@ -0,0 +1,171 @@
+import json
+import math
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+ANN_BACKENDS = ('faiss_ivf', 'faiss_hnsw')
+# persisted indexes of all ontologies, models and datasets share this budget, see evict_ann_indexes
+DEFAULT_ANN_MAX_SIZE_MB = 4096
+
+
+def check_ann_config(ann_config: dict) -> None:
+    """Validate the optional "ann" section of a prompt-gen config"""
+    backend = ann_config.get('backend')
+    if backend not in ANN_BACKENDS:
+        raise ValueError(f"Unknown ANN backend {backend}, expected one of {', '.join(ANN_BACKENDS)}")
+    # faiss is only needed by configs with an "ann" section, so it is imported here and in the functions below
+    try:
+        import faiss
+    except ImportError:
+        raise ImportError("The ANN backend requires faiss (pip install faiss-cpu)")
+
+
+def ann_tag(ann_config: dict) -> str:
+    """Short string describing backend and build parameters, used in cache file names"""
+    if ann_config['backend'] == 'faiss_hnsw':
+        return f"hnsw{ann_config.get('hnsw_m', 32)}_ef{ann_config.get('ef_construction', 200)}"
+    return f"ivf{ann_config.get('nlist', 'auto')}"
+
+
+def to_faiss_matrix(embeddings) -> np.ndarray:
+    """Convert embeddings to a contiguous float32 matrix with unit-length rows"""
+    import faiss
+    if hasattr(embeddings, 'detach'):
+        embeddings = embeddings.detach().float().cpu().numpy()
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    faiss.normalize_L2(matrix)
+    return matrix
+
+
+def build_ann_index(train_matrix: np.ndarray, ann_config: dict):
+    """Build an inner-product IVF or HNSW index over normalized train embeddings"""
+    import faiss
+    num_train, dim = train_matrix.shape
+    if ann_config['backend'] == 'faiss_hnsw':
+        index = faiss.IndexHNSWFlat(dim, ann_config.get('hnsw_m', 32), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ann_config.get('ef_construction', 200)
+    else:
+        nlist = ann_config.get('nlist', 'auto')
+        if nlist == 'auto':
+            nlist = int(4 * math.sqrt(num_train))
+        # IVF training needs at least one point per list
+        nlist = max(1, min(int(nlist), num_train))
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(train_matrix)
+    index.add(train_matrix)
+    return index
+
+
+def set_search_params(index, ann_config: dict) -> None:
+    """Apply query-time parameters, these are not part of the persisted index"""
+    if ann_config['backend'] == 'faiss_hnsw':
+        index.hnsw.efSearch = ann_config.get('ef_search', 64)
+    else:
+        index.nprobe = min(ann_config.get('nprobe', 16), index.nlist)
+
+
+def load_or_build_ann_index(index_path: str, train_matrix: np.ndarray, ann_config: dict):
+    """Load a persisted index if present, otherwise build and persist it"""
+    import faiss
+    index = None
+    if os.path.exists(index_path):
+        try:
+            index = faiss.read_index(index_path)
+            if index.ntotal != train_matrix.shape[0]:
+                print(f"Cached ANN index {index_path} does not match the train set, rebuilding")
+                index = None
+            else:
+                print(f"Loaded ANN index from: {index_path}")
+                # the modification time orders eviction, loading counts as a use
+                os.utime(index_path)
+        except Exception as e:
+            print(f"Error loading ANN index: {str(e)}")
+            index = None
+    if index is None:
+        start_time = time.time()
+        index = build_ann_index(train_matrix, ann_config)
+        print(f"Built {ann_config['backend']} index in {time.time() - start_time:.2f} seconds")
+        try:
+            faiss.write_index(index, index_path)
+            print(f"Saved ANN index to: {index_path}")
+        except Exception as e:
+            print(f"Error saving ANN index: {str(e)}")
+    set_search_params(index, ann_config)
+    return index
+
+
+def evict_ann_indexes(ann_dir: str, max_size_mb: Optional[float], keep: Optional[str] = None) -> int:
+    """
+    Delete least recently used index files until they fit the size limit, never the file keep
+    :return: number of deleted files
+    """
+    if not max_size_mb:
+        return 0
+    files = []
+    for entry in os.scandir(ann_dir):
+        if entry.name.endswith('.faiss'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # deleted by another process meanwhile
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    excess = sum(size for _, size, _ in files) - int(max_size_mb * 1024 * 1024)
+    evicted = 0
+    for _, size, path in sorted(files):
+        if excess <= 0:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            evicted += 1
+            print(f"Evicted least recently used ANN index: {os.path.basename(path)}")
+        except FileNotFoundError:
+            pass
+        excess -= size
+    return evicted
+
+
+def ann_topk(index, test_matrix: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Search the index, returns (scores, indices); missing neighbours are marked with index -1"""
+    return index.search(test_matrix, min(top_k, index.ntotal))
+
+
+def recall_at_k(ann_indices: np.ndarray, exact_indices: np.ndarray) -> float:
+    """Mean fraction of the exact top-k neighbours that the ANN search also returned"""
+    if len(exact_indices) == 0:
+        return 1.0
+    hits = 0
+    for ann_row, exact_row in zip(ann_indices, exact_indices):
+        hits += len(set(ann_row.tolist()) & set(exact_row.tolist()))
+    return hits / exact_indices.size
+
+
+def sample_rows(num_rows: int, sample_size: int, seed: int = 0) -> np.ndarray:
+    """Deterministic sample of row indices for the recall check"""
+    if num_rows <= sample_size:
+        return np.arange(num_rows)
+    return np.sort(np.random.default_rng(seed).choice(num_rows, size=sample_size, replace=False))
+
+
+def append_report(report_file: str, report: dict) -> None:
+    """Append one recall report entry as a JSON line"""
+    os.makedirs(os.path.dirname(report_file) or '.', exist_ok=True)
+    with open(report_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(report) + '\n')
+
+
+def describe(ann_config: dict, index) -> dict:
+    """Build and search parameters reported next to the recall numbers"""
+    params = {'backend': ann_config['backend']}
+    if ann_config['backend'] == 'faiss_hnsw':
+        params.update(hnsw_m=ann_config.get('hnsw_m', 32), ef_construction=ann_config.get('ef_construction', 200),
+                      ef_search=index.hnsw.efSearch)
+    else:
+        params.update(nlist=index.nlist, nprobe=index.nprobe)
+    return params
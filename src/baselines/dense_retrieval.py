@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import time
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from sentence_transformers import util
+from tqdm import tqdm
+
+from common.jsonl_io import open_text
+from ann_index import (DEFAULT_ANN_MAX_SIZE_MB, ann_tag, ann_topk, append_report, describe, evict_ann_indexes,
+                       load_or_build_ann_index, recall_at_k, sample_rows, to_faiss_matrix)
+
+
+def load_sentences(file_path: str) -> Tuple[List[str], List[str], str]:
+    """Load sentences, IDs, and compute file content hash from JSONL file"""
+    sentences, ids = [], []
+    content = []
+    try:
+        with open_text(file_path, 'r') as f:
+            for line in f:
+                content.append(line)
+                data = json.loads(line.strip())
+                sentences.append(data['sent'])
+                ids.append(data['id'])
+        file_content = ''.join(content)
+        file_hash = hashlib.sha1(file_content.encode('utf-8')).hexdigest()
+        return sentences, ids, file_hash
+    except Exception as e:
+        print(f"Error loading sentences from {file_path}: {str(e)}")
+        return [], [], ''
+
+
+def topk_cosine(test_embeddings: torch.Tensor,
+                train_embeddings: torch.Tensor,
+                top_k: int,
+                chunk_size: int = 1024,
+                show_progress: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Top-k cosine search in chunks of test rows, peak memory is chunk_size x len(train) scores"""
+    # normalize once, then every chunk costs a single matmul and a single topk
+    train_norm = util.normalize_embeddings(train_embeddings)
+    k = min(top_k, train_norm.shape[0])
+    top_scores, top_indices = [], []
+    for start in tqdm(range(0, test_embeddings.shape[0], chunk_size), disable=not show_progress):
+        test_norm = util.normalize_embeddings(test_embeddings[start:start + chunk_size])
+        cosine_scores = torch.mm(test_norm, train_norm.transpose(0, 1))
+        # same topk kernel as the former per-row search, so ties are ordered the same way
+        scores, indices = torch.topk(cosine_scores, k=k, dim=1)
+        top_scores.append(scores.cpu())
+        top_indices.append(indices.cpu())
+    if not top_scores:
+        return torch.empty(0, k), torch.empty(0, k, dtype=torch.long)
+    return torch.cat(top_scores), torch.cat(top_indices)
+
+
+def search_neighbours(test_embeddings: torch.Tensor,
+                      train_embeddings: torch.Tensor,
+                      top_k: int,
+                      chunk_size: int = 1024,
+                      ann=None,
+                      show_progress: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """(scores, indices) of the top-k train neighbours, exactly or through an ANN index"""
+    if ann is not None:
+        # ANN search marks neighbours it could not fill with -1
+        return ann_topk(ann, to_faiss_matrix(test_embeddings), top_k)
+    top_scores, top_indices = topk_cosine(test_embeddings, train_embeddings, top_k, chunk_size, show_progress)
+    return top_scores.float().numpy(), top_indices.numpy()
+
+
+def open_ann_index(onto: str, ann_config: dict, model_key: str, store_root: str, train_embeddings: torch.Tensor,
+                   train_hash: str, train_file: str):
+    """
+    Load or build the ANN index of an ontology's train embeddings, persisted next to the embedding store. The
+    file is keyed by the train file, so ontologies of the same name in different datasets keep their own
+    index, and least recently used indexes are evicted once all of them exceed the "max_size_mb" of the config
+    """
+    ann_dir = os.path.join(store_root, 'ann')
+    os.makedirs(ann_dir, exist_ok=True)
+    dataset_key = hashlib.sha1(os.path.abspath(train_file).encode('utf-8')).hexdigest()[:12]
+    ann_path = os.path.join(ann_dir, f"{onto}__{model_key.replace('/', '_')}__{dataset_key}__{train_hash}__"
+                                     f"{ann_tag(ann_config)}.faiss")
+    ann = load_or_build_ann_index(ann_path, to_faiss_matrix(train_embeddings), ann_config)
+    evict_ann_indexes(ann_dir, ann_config.get('max_size_mb', DEFAULT_ANN_MAX_SIZE_MB), keep=ann_path)
+    return ann
+
+
+def report_ann_recall(onto: str,
+                      ann,
+                      ann_config: dict,
+                      test_embeddings: torch.Tensor,
+                      train_embeddings: torch.Tensor,
+                      top_k: int,
+                      chunk_size: int,
+                      report_file: str) -> None:
+    """Compare ANN neighbours with exact search on a sample of test sentences and append recall@k to a report"""
+    rows = sample_rows(test_embeddings.shape[0], ann_config.get('recall_sample', 1000))
+    sample = test_embeddings[torch.from_numpy(rows)]
+
+    start_time = time.time()
+    _, exact_indices = topk_cosine(sample, train_embeddings, top_k, chunk_size)
+    exact_time = time.time() - start_time
+
+    start_time = time.time()
+    _, ann_indices = ann_topk(ann, to_faiss_matrix(sample), top_k)
+    ann_time = time.time() - start_time
+
+    recall = recall_at_k(ann_indices, exact_indices.numpy())
+    report = {'onto': onto, 'top_k': top_k, 'sample_size': len(rows), 'num_train': train_embeddings.shape[0],
+              f'recall@{top_k}': round(recall, 4), 'exact_seconds': round(exact_time, 4),
+              'ann_seconds': round(ann_time, 4), **describe(ann_config, ann)}
+    append_report(report_file, report)
+    print(f"ANN recall@{top_k} on {len(rows)} test sentences: {recall:.4f} "
+          f"(exact {exact_time:.3f}s, ann {ann_time:.3f}s)")
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_STORE_DIR = os.environ.get(
+    'TEXT2KG_EMBEDDING_STORE', os.path.join(os.path.expanduser('~'), '.cache', 'text2kgbench', 'embeddings'))
+DEFAULT_MAX_SIZE_MB = 10240
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dim INTEGER NOT NULL, capacity INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL, hash TEXT NOT NULL, row INTEGER NOT NULL, last_used REAL NOT NULL,
+    PRIMARY KEY (model, hash));
+CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used);
+CREATE TABLE IF NOT EXISTS free_rows (model TEXT NOT NULL, row INTEGER NOT NULL, PRIMARY KEY (model, row));
+"""
+# stay well below SQLite's limit on bound parameters per statement
+_QUERY_CHUNK = 500
+
+
+def sentence_hash(sentence: str) -> str:
+    """Content address of a sentence"""
+    return hashlib.sha1(sentence.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """Content-addressed sentence embedding cache shared by all configs and datasets.
+
+    Vectors are keyed by (model key, sentence hash) and kept as float16 rows of one memory-mapped array per
+    model. A SQLite index maps keys to rows and records the last use of every entry; when the live vectors
+    exceed max_size_mb, the least recently used entries are evicted and the files compacted to their live rows,
+    and files only grow as far as the limit allows. Vectors are written and flushed before the index is
+    committed, so an interrupted run never leaves entries that point at unwritten rows. The store assumes a
+    single writer at a time.
+    """
+
+    def __init__(self, root: str = DEFAULT_STORE_DIR, max_size_mb: Optional[float] = DEFAULT_MAX_SIZE_MB):
+        self.root = root
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, 'index.sqlite'))
+        self.db.executescript(_SCHEMA)
+        self._arrays = {}
+
+    def _vector_path(self, model_key: str) -> str:
+        safe_key = model_key.replace('/', '_').replace('\\', '_')
+        return os.path.join(self.root, f"{safe_key}__{sentence_hash(model_key)[:8]}.f16")
+
+    def _model_info(self, model_key: str) -> Optional[tuple]:
+        return self.db.execute('SELECT dim, capacity FROM models WHERE model = ?', (model_key,)).fetchone()
+
+    def _array(self, model_key: str) -> np.memmap:
+        info = self._model_info(model_key)
+        dim, capacity = info
+        array = self._arrays.get(model_key)
+        if array is None or array.shape[0] != capacity:
+            array = np.memmap(self._vector_path(model_key), dtype=np.float16, mode='r+', shape=(capacity, dim))
+            self._arrays[model_key] = array
+        return array
+
+    def _grow(self, model_key: str, dim: int, min_free: int) -> None:
+        info = self._model_info(model_key)
+        if info is None:
+            self.db.execute('INSERT INTO models (model, dim, capacity) VALUES (?, ?, 0)', (model_key, dim))
+            info = (dim, 0)
+        elif info[0] != dim:
+            raise ValueError(f"Embedding size {dim} does not match the stored size {info[0]} for {model_key}")
+        capacity = info[1]
+        num_free = self.db.execute('SELECT COUNT(*) FROM free_rows WHERE model = ?', (model_key,)).fetchone()[0]
+        if num_free >= min_free:
+            return
+        needed = capacity + min_free - num_free
+        new_capacity = max(2 * capacity, 1024)
+        if self.max_bytes is not None:
+            # spare rows never take the files of all models beyond the size limit
+            other_bytes = self.disk_bytes() - capacity * dim * 2
+            new_capacity = min(new_capacity, (self.max_bytes - other_bytes) // (dim * 2))
+        new_capacity = max(new_capacity, needed)
+        with open(self._vector_path(model_key), 'ab') as f:
+            f.truncate(new_capacity * dim * 2)
+        self.db.executemany('INSERT INTO free_rows (model, row) VALUES (?, ?)',
+                            ((model_key, row) for row in range(capacity, new_capacity)))
+        self.db.execute('UPDATE models SET capacity = ? WHERE model = ?', (new_capacity, model_key))
+        self._arrays.pop(model_key, None)
+
+    def size_bytes(self) -> int:
+        """Bytes held by live vectors across all models"""
+        return self.db.execute(
+            'SELECT COALESCE(SUM(m.dim * 2), 0) FROM embeddings e JOIN models m ON e.model = m.model').fetchone()[0]
+
+    def disk_bytes(self) -> int:
+        """Bytes of the vector files across all models, live and free rows"""
+        return self.db.execute('SELECT COALESCE(SUM(capacity * dim * 2), 0) FROM models').fetchone()[0]
+
+    def _compact(self, model_key: str) -> None:
+        """Move the live rows behind the first free rows into them and truncate the vector file to the live rows"""
+        dim, capacity = self._model_info(model_key)
+        live = self.db.execute('SELECT COUNT(*) FROM embeddings WHERE model = ?', (model_key,)).fetchone()[0]
+        if live == capacity:
+            return
+        moving = self.db.execute('SELECT hash, row FROM embeddings WHERE model = ? AND row >= ? ORDER BY row',
+                                 (model_key, live)).fetchall()
+        if moving:
+            holes = [row for (row,) in self.db.execute(
+                'SELECT row FROM free_rows WHERE model = ? AND row < ? ORDER BY row', (model_key, live)).fetchall()]
+            array = self._array(model_key)
+            array[holes] = array[[row for _, row in moving]]
+            array.flush()
+            del array
+            self.db.executemany('UPDATE embeddings SET row = ? WHERE model = ? AND hash = ?',
+                                ((row, model_key, digest) for row, (digest, _) in zip(holes, moving)))
+        self.db.execute('DELETE FROM free_rows WHERE model = ?', (model_key,))
+        self.db.execute('UPDATE models SET capacity = ? WHERE model = ?', (live, model_key))
+        self.db.commit()
+        # the moved rows are committed before the file shrinks, the old rows stay readable until then
+        self._arrays.pop(model_key, None)
+        with open(self._vector_path(model_key), 'r+b') as f:
+            f.truncate(live * dim * 2)
+
+    def evict(self, reserve_bytes: int = 0) -> int:
+        """
+        Evict least recently used entries until the live vectors plus reserve_bytes fit the size limit, then
+        compact the vector files of the models that lost entries, so their disk use shrinks with them
+        """
+        if self.max_bytes is None:
+            return 0
+        excess = self.size_bytes() + reserve_bytes - self.max_bytes
+        evicted = 0
+        models = set()
+        while excess > 0:
+            oldest = self.db.execute(
+                'SELECT e.model, e.hash, e.row, m.dim FROM embeddings e JOIN models m ON e.model = m.model '
+                'ORDER BY e.last_used LIMIT 1000').fetchall()
+            if not oldest:
+                break
+            for model_key, digest, row, dim in oldest:
+                self.db.execute('DELETE FROM embeddings WHERE model = ? AND hash = ?', (model_key, digest))
+                self.db.execute('INSERT INTO free_rows (model, row) VALUES (?, ?)', (model_key, row))
+                models.add(model_key)
+                excess -= dim * 2
+                evicted += 1
+                if excess <= 0:
+                    break
+        self.db.commit()
+        if evicted:
+            print(f"Evicted {evicted} embeddings from the store")
+        for model_key in sorted(models):
+            self._compact(model_key)
+        return evicted
+
+    def _stored_rows(self, model_key: str, hashes: List[str]) -> Dict[str, int]:
+        rows = {}
+        for start in range(0, len(hashes), _QUERY_CHUNK):
+            chunk = hashes[start:start + _QUERY_CHUNK]
+            query = f"SELECT hash, row FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})"
+            rows.update(self.db.execute(query, (model_key, *chunk)).fetchall())
+        return rows
+
+    def get(self, model_key: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Fetch stored vectors by sentence hash and mark them as used; missing hashes are left out"""
+        if self._model_info(model_key) is None:
+            return {}
+        rows = self._stored_rows(model_key, hashes)
+        if not rows:
+            return {}
+        now = time.time()
+        self.db.executemany('UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?',
+                            ((now, model_key, digest) for digest in rows))
+        self.db.commit()
+        digests = list(rows)
+        vectors = np.asarray(self._array(model_key)[[rows[digest] for digest in digests]], dtype=np.float32)
+        return dict(zip(digests, vectors))
+
+    def put(self, model_key: str, hashes: List[str], vectors: np.ndarray) -> None:
+        """Store vectors for new sentence hashes, evicting old entries first if the size limit requires it"""
+        if not hashes:
+            return
+        dim = vectors.shape[1]
+        self.evict(reserve_bytes=len(hashes) * dim * 2)
+        # the last vector of a hash wins; hashes already stored are overwritten in their row, only new ones
+        # take free rows, so no row is left behind without an entry
+        positions = {digest: i for i, digest in enumerate(hashes)}
+        rows = self._stored_rows(model_key, list(positions))
+        new = [digest for digest in positions if digest not in rows]
+        self._grow(model_key, dim, len(new))
+        free = self.db.execute('SELECT row FROM free_rows WHERE model = ? ORDER BY row LIMIT ?',
+                               (model_key, len(new))).fetchall()
+        rows.update(zip(new, (row for (row,) in free)))
+        array = self._array(model_key)
+        array[[rows[digest] for digest in positions]] = vectors[list(positions.values())].astype(np.float16)
+        array.flush()
+        now = time.time()
+        self.db.executemany('DELETE FROM free_rows WHERE model = ? AND row = ?',
+                            ((model_key, rows[digest]) for digest in new))
+        self.db.executemany('INSERT INTO embeddings (model, hash, row, last_used) VALUES (?, ?, ?, ?) '
+                            'ON CONFLICT (model, hash) DO UPDATE SET last_used = excluded.last_used',
+                            ((model_key, digest, rows[digest], now) for digest in positions))
+        self.db.commit()
+
+    def encode(self,
+               model_key: str,
+               sentences: List[str],
+               encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Return float32 embeddings for the sentences, encoding only those not found in the store"""
+        hashes = [sentence_hash(sentence) for sentence in sentences]
+        cached = self.get(model_key, list(dict.fromkeys(hashes)))
+        missing = {}
+        for digest, sentence in zip(hashes, sentences):
+            if digest not in cached and digest not in missing:
+                missing[digest] = sentence
+        print(f"Embedding store: {len(sentences) - sum(h in missing for h in hashes)} cached, "
+              f"{len(missing)} to encode")
+        if missing:
+            vectors = np.asarray(encode_fn(list(missing.values())), dtype=np.float32)
+            self.put(model_key, list(missing), vectors)
+            # round-trip through float16 so fresh and cached vectors are identical
+            cached.update(zip(missing, vectors.astype(np.float16).astype(np.float32)))
+        if not hashes:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([cached[digest] for digest in hashes])
+
+    def ensure(self,
+               model_key: str,
+               sentences: List[str],
+               encode_fn: Callable[[List[str]], np.ndarray],
+               chunk_size: int = 8192) -> int:
+        """Encode and store every distinct sentence that is not in the store yet, without loading any vectors.
+        Work is committed every chunk_size sentences, so an interrupted run keeps what it already encoded."""
+        missing = {sentence_hash(sentence): sentence for sentence in sentences}
+        if self._model_info(model_key) is not None:
+            for digest in self._stored_rows(model_key, list(missing)):
+                del missing[digest]
+        print(f"Embedding store: {len(missing)} of {len(sentences)} sentences to encode")
+        digests = list(missing)
+        for start in range(0, len(digests), chunk_size):
+            chunk = digests[start:start + chunk_size]
+            vectors = np.asarray(encode_fn([missing[digest] for digest in chunk]), dtype=np.float32)
+            self.put(model_key, chunk, vectors)
+        return len(digests)
+
+    def close(self) -> None:
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays.clear()
+        self.db.close()
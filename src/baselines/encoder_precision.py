@@ -0,0 +1,91 @@
+import random
+from typing import List
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer, util
+
+PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+def encoder_key(model_name: str, precision: str) -> str:
+    """Key under which embeddings of a model/precision pair are cached; full precision keeps the plain name"""
+    return model_name if precision == 'fp32' else f"{model_name}@{precision}"
+
+
+def bf16_supported(device: torch.device) -> bool:
+    """Check whether bfloat16 matmuls run on the device"""
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    try:
+        torch.mm(torch.ones(2, 2, dtype=torch.bfloat16), torch.ones(2, 2, dtype=torch.bfloat16))
+        return True
+    except RuntimeError:
+        return False
+
+
+def reduce_precision(model: SentenceTransformer, precision: str) -> SentenceTransformer:
+    """Convert a loaded full-precision encoder in place to dynamic int8 (linear layers, CPU only) or bfloat16"""
+    if precision == 'int8':
+        if model.device.type != 'cpu':
+            raise ValueError("Dynamic int8 quantization is only available on CPU")
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif precision == 'bf16':
+        if not bf16_supported(model.device):
+            raise ValueError(f"bfloat16 is not supported on {model.device}")
+        model.to(torch.bfloat16)
+    elif precision != 'fp32':
+        raise ValueError(f"Unknown encoder precision {precision}, expected one of {', '.join(PRECISIONS)}")
+    return model
+
+
+def topk_neighbours(queries: np.ndarray, pool: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top-k cosine neighbours of each query in the pool"""
+    scores = torch.mm(util.normalize_embeddings(torch.from_numpy(queries)),
+                      util.normalize_embeddings(torch.from_numpy(pool)).transpose(0, 1))
+    return torch.topk(scores, k=min(top_k, pool.shape[0]), dim=1)[1].numpy()
+
+
+def topk_overlap(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Mean fraction of reference neighbours that the candidate neighbour lists share"""
+    if reference.size == 0:
+        return 1.0
+    shared = sum(len(set(ref.tolist()) & set(cand.tolist())) for ref, cand in zip(reference, candidate))
+    return shared / reference.size
+
+
+def load_encoder(model_name: str,
+                 precision: str,
+                 query_sentences: List[str],
+                 pool_sentences: List[str],
+                 check_config: dict,
+                 top_k: int = 5,
+                 local_files_only: bool = False) -> SentenceTransformer:
+    """Load an encoder at the requested precision. For reduced precision, neighbours of a sample of queries
+    are compared against the full-precision encoder before conversion; a ValueError is raised when the
+    top-k overlap is below check_config['min_topk_overlap']."""
+    device = 'cpu' if precision == 'int8' else None
+    model = SentenceTransformer(model_name, device=device, local_files_only=local_files_only)
+    if precision == 'fp32':
+        return model
+
+    rng = random.Random(check_config.get('seed', 0))
+    queries = rng.sample(query_sentences, min(check_config.get('sample_size', 200), len(query_sentences)))
+    pool = rng.sample(pool_sentences, min(check_config.get('pool_size', 2000), len(pool_sentences)))
+    batch_size = check_config.get('batch_size', 32)
+    # go through a tensor, bfloat16 outputs have no numpy equivalent
+    encode = lambda sentences: model.encode(sentences, batch_size=batch_size,
+                                            convert_to_tensor=True).float().cpu().numpy()
+
+    print(f"Encoding {len(queries)} queries and {len(pool)} pool sentences at full precision...")
+    reference = topk_neighbours(encode(queries), encode(pool), top_k)
+    reduce_precision(model, precision)
+    print(f"Encoding the same sample at {precision}...")
+    candidate = topk_neighbours(encode(queries), encode(pool), top_k)
+
+    overlap = topk_overlap(reference, candidate)
+    threshold = check_config.get('min_topk_overlap', 0.9)
+    print(f"Top-{top_k} neighbour overlap of {precision} vs fp32: {overlap:.4f} (threshold {threshold})")
+    if overlap < threshold:
+        raise ValueError(f"{precision} encoder top-{top_k} overlap {overlap:.4f} is below {threshold}")
+    return model
@@ -2,27 +2,16 @@ import argparse
 import json
 import os
 import sys
-from typing import List, Dict, Optional
+from collections.abc import Mapping
+from contextlib import ExitStack
+from typing import List, Dict, Optional, Tuple, Union
 
-def load_file(src_file: str) -> Optional[dict]:
-    """Load either JSON or JSONL file"""
-    try:
-        with open(src_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                return data
-            except json.JSONDecodeError:
-                f.seek(0)
-                data = []
-                for line in f:
-                    try:
-                        data.append(json.loads(line.strip()))
-                    except json.JSONDecodeError:
-                        continue
-                return data
-    except Exception as e:
-        print(f"Error loading file {src_file}: {str(e)}")
-        return None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.jsonl_index import JsonlIndex, open_keyed_jsonl
+from common.jsonl_io import compression_suffix, open_text
+from common.prompt_jobs import estimate_tokens, load_file, packed_prompt_file
+from prompt_packing import PACK_INSTRUCTION, plan_packs, slot_marker
+from similarity_io import load_similarities
 
 def get_concept_label(ontology: dict, concept_qid: str) -> str:
     """
@@ -111,69 +100,77 @@ def get_test_prompt(test_sentence: str) -> str:
     """Generate test prompt"""
     return f"\n\nTest Sentence: {test_sentence}\nOutput:"
 
-def get_similar_sentences(test_id: str, similarity_dict: dict) -> List[str]:
-    """Get similar sentences with improved error handling"""
+def get_similar_sentences(test_id: str, similarity_dict: dict, min_score: Optional[float] = None) -> List[str]:
+    """
+    Get the ids of similar train sentences, most similar first.
+    :param test_id: The id of the test sentence.
+    :param similarity_dict: Neighbours as returned by load_similarities.
+    :param min_score: Drop neighbours scoring below this; neighbours without a score are kept.
+    :return: The train sentence ids.
+    """
     try:
-        if isinstance(similarity_dict, dict):
-            return similarity_dict.get(test_id, [])
-        elif isinstance(similarity_dict, list):
-            for item in similarity_dict:
-                if item.get('test_id') == test_id:
-                    return item.get('similar_sentences', [])
-        return []
+        return [train_id for train_id, score in similarity_dict.get(test_id, [])
+                if min_score is None or score is None or score >= min_score]
     except Exception:
         return []
 
-def get_train_sentence(simil_sent_id: str, train_sentences: List[dict]) -> Optional[dict]:
+def get_train_sentence(simil_sent_id: str, train_sentences: Union[List[dict], Mapping]) -> Optional[dict]:
     """Get training sentence with proper triple extraction"""
     try:
-        if isinstance(train_sentences, list):
-            for sent in train_sentences:
-                if sent.get('id') == simil_sent_id:
-                    # Get the sentence text
-                    sentence = sent.get('text', sent.get('sent', ''))
-                    
-                    # Get triples from the training data
-                    triples = []
-                    if 'triples' in sent:
-                        triples = sent['triples']
-                    elif all(k in sent for k in ['relation', 'subject', 'object']):
-                        triples = [{
-                            'rel': sent['relation'],
-                            'sub': sent['subject'],
-                            'obj': sent['object']
-                        }]
-                    
-                    return {
-                        'sent': sentence,
-                        'triples': triples
-                    }
-        return None
+        sent = None
+        if isinstance(train_sentences, Mapping):
+            # indexed access, only the requested line is read and parsed
+            sent = train_sentences.get(simil_sent_id)
+        elif isinstance(train_sentences, list):
+            sent = next((s for s in train_sentences if s.get('id') == simil_sent_id), None)
+        if sent is None:
+            return None
+
+        # Get the sentence text
+        sentence = sent.get('text', sent.get('sent', ''))
+
+        # Get triples from the training data
+        triples = []
+        if 'triples' in sent:
+            triples = sent['triples']
+        elif all(k in sent for k in ['relation', 'subject', 'object']):
+            triples = [{
+                'rel': sent['relation'],
+                'sub': sent['subject'],
+                'obj': sent['object']
+            }]
+
+        return {
+            'sent': sentence,
+            'triples': triples
+        }
     except Exception as e:
         print(f"Error getting train sentence: {str(e)}")
         return None
 
-def prepare_prompt(ontology: dict, test_sentence: str, train_sent: dict) -> Optional[str]:
-    """Prepare prompt with proper formatting"""
+def prompt_head(ontology: dict) -> str:
+    """The instruction and ontology every prompt of an ontology starts with, plain and packed alike"""
+    prompt = (
+        "Given the following ontology and sentences, please extract the triples from the sentence according "
+        "to the relations in the ontology. In the output, only include the triples in the given output format."
+        "\n\nCONTEXT:\n\n"
+    )
+    # Add concepts and relations
+    prompt += f"Ontology Concepts: {get_ontology_concepts(ontology)}\n"
+    prompt += f"Ontology Relations: {get_ontology_relations(ontology)}"
+    return prompt
+
+def prepare_prompt(ontology: dict, test_sentence: str, train_sent: Optional[dict]) -> Optional[str]:
+    """Prepare prompt with proper formatting, a zero-shot prompt without example if train_sent is None"""
     try:
-        if not all([ontology, test_sentence, train_sent]):
+        if not all([ontology, test_sentence]):
             return None
             
-        prompt = (
-            "Given the following ontology and sentences, please extract the triples from the sentence according "
-            "to the relations in the ontology. In the output, only include the triples in the given output format."
-            "\n\nCONTEXT:\n\n"
-        )
-        
-        # Add concepts and relations
-        concepts = get_ontology_concepts(ontology)
-        relations = get_ontology_relations(ontology)
-        
-        prompt += f"Ontology Concepts: {concepts}\n"
-        prompt += f"Ontology Relations: {relations}"
+        prompt = prompt_head(ontology)
         
         # Add example with triples
-        prompt += get_example_prompt(train_sent)
+        if train_sent is not None:
+            prompt += get_example_prompt(train_sent)
         
         # Add test sentence
         prompt += f"\n\nTest Sentence: {test_sentence}\nOutput:"
@@ -182,6 +179,58 @@ def prepare_prompt(ontology: dict, test_sentence: str, train_sent: dict) -> Opti
     except Exception:
         return None
 
+def prepare_packed_prompt(ontology: dict, slots: List[Tuple[str, dict]]) -> Optional[str]:
+    """
+    Prepare one prompt for several test sentences of an ontology: the instruction and ontology once, the
+    example of every sentence once, then the packing instruction and the numbered test sentences. Up to the
+    first example it is the prompt of the first sentence, so both share the ontology's prefix state.
+    :param slots: (test sentence, train sentence) pairs in slot order
+    """
+    try:
+        prompt = prompt_head(ontology)
+
+        examples = []
+        for _, train_sent in slots:
+            example = get_example_prompt(train_sent)
+            if example not in examples:
+                examples.append(example)
+                prompt += example
+
+        prompt += f"\n\n{PACK_INSTRUCTION}\n"
+        for slot, (test_sentence, _) in enumerate(slots, 1):
+            prompt += f"\nTest Sentence {slot_marker(slot)}: {test_sentence}"
+        prompt += "\nOutput:"
+        return prompt
+    except Exception:
+        return None
+
+def pack_prompts(ontology: dict, entries: List[dict], budget: int, output_tokens: int, max_size: int) -> List[dict]:
+    """
+    Pack the test sentences of an ontology into prompts under a token budget.
+    :param entries: {'id', 'text', 'train_sent', 'prompt'} per test sentence, in prompt file order
+    :param budget: estimated tokens per packed prompt including output_tokens of answer per sentence
+    :return: {'id', 'prompt', 'slots', 'max_tokens'} per pack; a single sentence keeps its own prompt
+    """
+    header_tokens = estimate_tokens(prepare_packed_prompt(ontology, []) or '')
+    items = []
+    for entry in entries:
+        example = get_example_prompt(entry['train_sent'])
+        slot_tokens = estimate_tokens(f"\nTest Sentence {slot_marker(max_size)}: {entry['text']}") + output_tokens
+        items.append((example, estimate_tokens(example), slot_tokens))
+
+    packs = []
+    for indices in plan_packs(items, header_tokens, budget, max_size):
+        members = [entries[i] for i in indices]
+        slots = [{'id': entry['id'], 'sentence': entry['text']} for entry in members]
+        if len(members) == 1:
+            packs.append({'id': members[0]['id'], 'prompt': members[0]['prompt'], 'slots': slots})
+            continue
+        prompt = prepare_packed_prompt(ontology, [(entry['text'], entry['train_sent']) for entry in members])
+        if prompt:
+            packs.append({'id': f"pack_{len(packs) + 1}", 'prompt': prompt, 'slots': slots,
+                          'max_tokens': output_tokens * len(members)})
+    return packs
+
 def write_prompts(prompts_json: List[dict], prompt_file: str) -> None:
     """Write prompts to JSONL file with proper formatting"""
     try:
@@ -189,10 +238,11 @@ def write_prompts(prompts_json: List[dict], prompt_file: str) -> None:
         output_dir = os.path.dirname(prompt_file)
         os.makedirs(output_dir, exist_ok=True)
         
-        with open(prompt_file, 'w', encoding='utf-8') as f:
+        with open_text(prompt_file, 'w') as f:
             for prompt_data in prompts_json:
                 # Ensure consistent formatting
                 formatted_prompt = {
+                    **prompt_data,
                     'id': prompt_data['id'],
                     'prompt': prompt_data['prompt'].replace('\n        ', '\n').strip()
                 }
@@ -202,6 +252,16 @@ def write_prompts(prompts_json: List[dict], prompt_file: str) -> None:
     except Exception as e:
         print(f"Error writing prompts: {str(e)}")
 
+def load_train_sentences(train_file: str) -> Union[List[dict], Mapping, None]:
+    """Open JSONL training data for lookups by id, fall back to loading the whole file"""
+    base_name = train_file[:len(train_file) - len(compression_suffix(train_file))]
+    if base_name.endswith('.jsonl') and os.path.exists(train_file):
+        try:
+            return open_keyed_jsonl(train_file)
+        except Exception as e:
+            print(f"Error indexing file {train_file}: {str(e)}")
+    return load_file(train_file)
+
 def get_file_paths(config: dict) -> Dict[str, dict]:
     """Generate file paths from config based on path_patterns"""
     try:
@@ -225,6 +285,13 @@ def get_file_paths(config: dict) -> Dict[str, dict]:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--prompt_gen_config_path', required=True, help='Path to prompt generation config file')
+    parser.add_argument('--pack_budget', type=int, default=None,
+                        help='Also write packed prompts of several test sentences each, estimated tokens of prompt '
+                             'and answer per packed prompt; keep it within the model context (2048 tokens for the '
+                             'Qwen runner). The runners send them with --packed')
+    parser.add_argument('--pack_output_tokens', type=int, default=100,
+                        help='Answer tokens reserved per sentence of a packed prompt')
+    parser.add_argument('--max_pack_size', type=int, default=8, help='Most test sentences per packed prompt')
     args = parser.parse_args()
 
     config = load_file(args.prompt_gen_config_path)
@@ -236,44 +303,58 @@ if __name__ == "__main__":
         sys.exit(1)
 
     for onto in config['onto_list']:
-        print(f"\nProcessing ontology: {onto}")
-        paths = file_paths[onto]
+        with ExitStack() as stack:
+            print(f"\nProcessing ontology: {onto}")
+            paths = file_paths[onto]
         
-        test_train_similarity = load_file(paths['test_train_similarity_file'])
-        train_sentences = load_file(paths['train_file'])
-        test_sentences = load_file(paths['test_file'])
-        ontology = load_file(paths['ontology_file'])
+            test_train_similarity = load_similarities(paths['test_train_similarity_file'])
+            train_sentences = load_train_sentences(paths['train_file'])
+            if isinstance(train_sentences, JsonlIndex):
+                # the index keeps the train file and its sidecar open until the ontology is done
+                stack.enter_context(train_sentences)
+            test_sentences = load_file(paths['test_file'])
+            ontology = load_file(paths['ontology_file'])
         
-        if not all([test_train_similarity, train_sentences, test_sentences, ontology]):
-            print(f"Skipping {onto} due to missing files")
-            continue
+            if not all([test_train_similarity, train_sentences, test_sentences, ontology]):
+                print(f"Skipping {onto} due to missing files")
+                continue
 
-        prompts_json = []
+            prompts_json = []
+            entries = []
 
-        try:
-            for test_sentence in test_sentences:
-                test_id = test_sentence.get('id')
-                test_text = test_sentence.get('text', test_sentence.get('sent', ''))
+            try:
+                for test_sentence in test_sentences:
+                    test_id = test_sentence.get('id')
+                    test_text = test_sentence.get('text', test_sentence.get('sent', ''))
                 
-                if not test_id or not test_text:
-                    continue
+                    if not test_id or not test_text:
+                        continue
 
-                similar_sents = get_similar_sentences(test_id, test_train_similarity)
-                if not similar_sents:
-                    continue
+                    similar_sents = get_similar_sentences(test_id, test_train_similarity, config.get('min_similarity'))
+                    if not similar_sents:
+                        continue
                     
-                train_sent = get_train_sentence(similar_sents[0], train_sentences)
-                if not train_sent:
-                    continue
+                    train_sent = get_train_sentence(similar_sents[0], train_sentences)
+                    if not train_sent:
+                        continue
                     
-                prompt = prepare_prompt(ontology, test_text, train_sent)
-                if prompt:
-                    prompt_data = {'id': test_id, 'prompt': prompt}
-                    prompts_json.append(prompt_data)
+                    prompt = prepare_prompt(ontology, test_text, train_sent)
+                    if prompt:
+                        prompt_data = {'id': test_id, 'prompt': prompt}
+                        prompts_json.append(prompt_data)
+                        entries.append({'id': test_id, 'text': test_text, 'train_sent': train_sent, 'prompt': prompt})
             
-            write_prompts(prompts_json, paths['prompt_file'])
-            print(f"Generated {len(prompts_json)} prompts for {onto}")
+                write_prompts(prompts_json, paths['prompt_file'])
+                print(f"Generated {len(prompts_json)} prompts for {onto}")
+
+                if args.pack_budget:
+                    packs = pack_prompts(ontology, entries, args.pack_budget, args.pack_output_tokens,
+                                         args.max_pack_size)
+                    write_prompts(packs, packed_prompt_file(paths['prompt_file']))
+                    print(f"Packed {len(prompts_json)} prompts into {len(packs)} "
+                          f"(about {sum(estimate_tokens(p['prompt']) for p in prompts_json)} prompt tokens down to "
+                          f"{sum(estimate_tokens(p['prompt']) for p in packs)})")
             
-        except Exception as e:
-            print(f"Error processing ontology {onto}: {str(e)}")
-            continue
\ No newline at end of file
+            except Exception as e:
+                print(f"Error processing ontology {onto}: {str(e)}")
+                continue
\ No newline at end of file
@@ -1,165 +1,261 @@
 import argparse
-import json
+import asyncio
 import os
 import sys
 import time
-from typing import List, Dict, Optional
-from openai import OpenAI
-
-def load_file(src_file: str) -> Optional[dict]:
-    """Load either JSON or JSONL file"""
-    try:
-        with open(src_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                return data
-            except json.JSONDecodeError:
-                f.seek(0)
-                data = []
-                for line in f:
-                    try:
-                        data.append(json.loads(line.strip()))
-                    except json.JSONDecodeError:
-                        continue
-                return data
-    except Exception as e:
-        print(f"Error loading file {src_file}: {str(e)}")
-        return None
-
-def parse_triples(response_text: str) -> List[List[str]]:
-    """Parse the response text to extract triples"""
-    triples = []
-    lines = response_text.strip().split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if '(' in line and ')' in line:
-            try:
-                relation_part, args_part = line.split('(', 1)
-                args_part = args_part.rstrip(')')
-                args = args_part.split(',', 1)
-                if len(args) == 2:
-                    sub = args[0].strip()
-                    obj = args[1].strip()
-                    rel = relation_part.strip()
-                    triples.append([sub, rel, obj])
-            except Exception as e:
-                print(f"Error parsing line: {line}, Error: {str(e)}")
-    return triples
-def get_file_paths(config: dict) -> Dict[str, dict]:
-    """Generate file paths from config"""
-    try:
-        # Extract dataset and type (seen/unseen) from path patterns
-        prompt_pattern = config['path_patterns']['prompt']
-        
-        # Determine if it's an unseen dataset
-        is_unseen = 'unseen' in prompt_pattern
-        
-        # Extract base dataset path (e.g., "../../data/dbpedia_webnlg" or "../../data/wikidata_tekgen")
-        base_path = prompt_pattern.split('/baselines')[0]
-        
-        # Construct response directory path
-        response_base = f"{base_path}/baselines/OpenAI-GPT-4o"
-        if is_unseen:
-            response_dir = f"{response_base}/unseen/llm_responses"
-        else:
-            response_dir = f"{response_base}/llm_responses"
-        
-        file_paths = {}
-        for onto in config['onto_list']:
-            file_paths[onto] = {
-                'prompt_file': prompt_pattern.replace('$$onto$$', onto),
-                'response_dir': response_dir
-            }
-        return file_paths
-    except Exception as e:
-        print(f"Error generating file paths: {str(e)}")
-        return {}
+from contextlib import ExitStack
+from typing import List, Optional
+from openai import AsyncOpenAI, OpenAI
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--prompt_gen_config_path', required=True, help='Path to prompt generation config file')
-    parser.add_argument('--api_key', required=False, help='OpenAI API key')
-    args = parser.parse_args()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.checkpoint import ResponseCheckpoint
+from common.prompt_jobs import prompt_jobs, response_record, retry_prompts
+from common.response_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_SIZE_MB, ResponseCache
+from openai_async import AsyncChatRunner
+from openai_batch import build_batch_requests, custom_id, run_batches
+from prompt_dedup import PromptDedup
+from prompt_packing import ResponseRouter, prompt_params
+from streaming import STOP_CONDITIONS
 
-    config = load_file(args.prompt_gen_config_path)
-    if not config:
-        sys.exit(1)
+BATCH_STATE_FILE = 'batch_state.json'
+MODEL = "gpt-4o"
+# directory under <dataset>/baselines the responses are written to
+BASELINE_NAME = "OpenAI-GPT-4o"
+REQUEST_PARAMS = {'max_tokens': 250, 'temperature': 0}
 
-    api_key = args.api_key or os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        print("OpenAI API key not provided. Please set it as an argument or environment variable.")
-        sys.exit(1)
+def cache_params(args: argparse.Namespace) -> dict:
+    """Decoding parameters of the response cache key, early stopping truncates responses so it is part of it"""
+    params = dict(REQUEST_PARAMS)
+    if args.stream and (args.stop_on or args.max_triples):
+        params['stop'] = {'on': sorted(args.stop_on), 'max_triples': args.max_triples}
+    return params
 
-    client = OpenAI(api_key=api_key)
+def process_prompts_batch(client: OpenAI,
+                          dedup: PromptDedup,
+                          responses: ResponseRouter,
+                          output_dir: str,
+                          poll_interval: float,
+                          cache: Optional[ResponseCache],
+                          backend: str,
+                          model: str = MODEL) -> None:
+    """Answer the distinct prompts of all jobs through provider batch jobs and append every response to the
+    checkpoints of all prompts it answers"""
+    prompts_by_job = {job: dedup.dispatch(job) for job in responses.checkpoints}
+    requests = build_batch_requests(prompts_by_job, model, REQUEST_PARAMS)
+    results = run_batches(client, requests, os.path.join(output_dir, BATCH_STATE_FILE), poll_interval)
 
-    file_paths = get_file_paths(config)
-    if not file_paths:
-        sys.exit(1)
+    for job, prompts in prompts_by_job.items():
+        answered = 0
+        for prompt_data in prompts:
+            response_text = results.get(custom_id(job, prompt_data.get('id')))
+            if response_text is None:
+                for target_job, target_id in dedup.targets_of(job, prompt_data['id']):
+                    responses.failed(target_job, target_id)
+                continue
+            for target_job, target_id in dedup.fan_out(job, prompt_data['id'], response_text):
+                responses.write(target_job, target_id, response_text)
+            if cache is not None:
+                cache.put(backend, model, prompt_params(REQUEST_PARAMS, prompt_data), prompt_data['prompt'],
+                          response_text)
+            answered += 1
+        print(f"{job}: {answered} of {len(prompts)} prompts answered")
 
-    # Get response directory from the first onto (all have same response_dir)
-    output_dir = next(iter(file_paths.values()))['response_dir']
-    os.makedirs(output_dir, exist_ok=True)
+async def process_prompts(runner: AsyncChatRunner,
+                          dedup: PromptDedup,
+                          job: str,
+                          responses: ResponseRouter,
+                          cache: Optional[ResponseCache],
+                          backend: str,
+                          params: dict) -> None:
+    """Query the distinct prompts of a job concurrently, each response is appended to the checkpoints of all
+    prompts it answers as it arrives"""
 
-    for onto in config['onto_list']:
-        print(f"\nProcessing ontology: {onto}")
-        paths = file_paths[onto]
-        prompt_file = paths['prompt_file']
-        
-        if not os.path.exists(prompt_file):
-            print(f"Prompt file {prompt_file} not found. Skipping ontology {onto}.")
-            continue
+    def done(prompt_data: dict, result: dict) -> None:
+        usage = result.get('usage') or {}
+        targets = dedup.fan_out(job, prompt_data['id'], result['response'], usage.get('prompt_tokens'),
+                                usage.get('completion_tokens'))
+        for i, (target_job, target_id) in enumerate(targets):
+            # timing belongs to the request, it is recorded with the prompt that was sent
+            responses.write(target_job, target_id, result['response'], result.get('timing') if i == 0 else None)
+        if cache is not None:
+            cache.put(backend, runner.model, prompt_params(params, prompt_data), prompt_data['prompt'],
+                      result['response'])
+        copies = f", also answers {len(targets) - 1} duplicate(s)" if len(targets) > 1 else ''
+        timing = result.get('timing')
+        if timing:
+            print(f"Processed prompt {prompt_data['id']} in {result['latency']:.2f} seconds "
+                  f"(first token {timing['ttft']}s, last triple {timing['time_to_last_triple']}s"
+                  f"{', stopped on ' + result['stop_reason'] if result['stop_reason'] else ''}){copies}")
+        else:
+            print(f"Processed prompt {prompt_data['id']} in {result['latency']:.2f} seconds{copies}")
 
-        try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompts = [json.loads(line.strip()) for line in f if line.strip()]
-        except Exception as e:
-            print(f"Error reading prompt file {prompt_file}: {str(e)}")
-            continue
+    prompts = dedup.dispatch(job)
+    start_time = time.time()
+    results = await runner.run(prompts, on_result=done)
+    for prompt_data, result in zip(prompts, results):
+        if result is None:
+            for target_job, target_id in dedup.targets_of(job, prompt_data['id']):
+                responses.failed(target_job, target_id)
+    print(f"Queried {len(prompts)} prompts in {time.time() - start_time:.2f} seconds ({runner.stats})")
 
-        responses = []
-        for prompt_data in prompts:
-            prompt_id = prompt_data.get('id')
-            prompt_text = prompt_data.get('prompt')
-            if not prompt_id or not prompt_text:
-                continue
+def pending_prompts(prompts: List[dict],
+                    responses: ResponseRouter,
+                    job: str,
+                    cache: Optional[ResponseCache],
+                    backend: str,
+                    model: str = MODEL,
+                    params: dict = REQUEST_PARAMS) -> List[dict]:
+    """Prompts that need the model: responses already in the checkpoint are skipped and cached responses are
+    appended to the checkpoint without a request"""
+    prompts = [p for p in prompts if p.get('id') and p.get('prompt')]
+    pending = responses.pending(job, prompts)
+    if len(pending) < len(prompts):
+        print(f"Resuming: {len(prompts) - len(pending)} prompts already answered, {len(pending)} remaining")
+    if cache is None:
+        return pending
 
-            print(f"Processing prompt {prompt_id}")
+    uncached = []
+    for prompt_data in pending:
+        response_text = cache.get(backend, model, prompt_params(params, prompt_data), prompt_data['prompt'])
+        if response_text is None:
+            uncached.append(prompt_data)
+        else:
+            responses.write(job, prompt_data['id'], response_text)
+    if len(uncached) < len(pending):
+        print(f"Response cache: {len(pending) - len(uncached)} cached, {len(uncached)} to query")
+    return uncached
 
-            try:
-                start_time = time.time()
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt_text}],
-                    max_tokens=250,
-                    temperature=0
-                )
-                end_time = time.time()
-                print(f"Query OpenAI loading time: {end_time - start_time:.2f} seconds")
+def send_prompts(args: argparse.Namespace,
+                 api_key: str,
+                 dedup: PromptDedup,
+                 responses: ResponseRouter,
+                 output_dir: str,
+                 cache: Optional[ResponseCache],
+                 backend: str,
+                 params: dict) -> None:
+    """Send the distinct prompts of all jobs online or as provider batch jobs"""
+    if args.mode == 'batch':
+        client = OpenAI(api_key=api_key, base_url=args.base_url)
+        process_prompts_batch(client, dedup, responses, output_dir, args.poll_interval, cache, backend, args.model)
+        # every result is saved, the finished jobs do not need to be resumed
+        state_file = os.path.join(output_dir, BATCH_STATE_FILE)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        return
 
-                response_text = response.choices[0].message.content
-                triples = parse_triples(response_text)
+    async def send_all() -> None:
+        # one event loop for every job: the client's connections and the rate limiter belong to the loop
+        # retries are handled by the runner so they share its rate limits
+        client = AsyncOpenAI(api_key=api_key, base_url=args.base_url, max_retries=0)
+        runner = AsyncChatRunner(client, args.model, max_concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm,
+                                 max_retries=args.max_retries, request_params=REQUEST_PARAMS, stream=args.stream,
+                                 stop_on=tuple(args.stop_on), max_triples=args.max_triples)
+        async with client:
+            for job in responses.checkpoints:
+                if dedup.dispatch(job):
+                    print(f"\nProcessing ontology: {job}")
+                    await process_prompts(runner, dedup, job, responses, cache, backend, params)
 
-                response_data = {
-                    'id': prompt_id,
-                    'response': response_text,
-                    'triples': triples
-                }
+    asyncio.run(send_all())
 
-                responses.append(response_data)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prompt_gen_config_path', required=True, nargs='+',
+                        help='Prompt generation config files, identical prompts across them are sent once')
+    parser.add_argument('--api_key', required=False, help='OpenAI API key')
+    parser.add_argument('--base_url', required=False,
+                        help='OpenAI-compatible endpoint, e.g. llama_server.py or a local stand-in server')
+    parser.add_argument('--model', default=MODEL, help='Model name sent with every request')
+    parser.add_argument('--baseline_name', default=BASELINE_NAME,
+                        help='Response directory under <dataset>/baselines, e.g. Qwen2_5-32B-Instruct-Q4KM when '
+                             'targeting llama_server.py')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of requests in flight')
+    parser.add_argument('--rpm', type=float, default=500, help='Requests per minute limit, 0 disables it')
+    parser.add_argument('--tpm', type=float, default=30000, help='Tokens per minute limit, 0 disables it')
+    parser.add_argument('--max_retries', type=int, default=6, help='Retries on 429, 5xx and connection errors')
+    parser.add_argument('--mode', choices=['online', 'batch'], default='online',
+                        help='Send requests directly or submit all ontologies as provider batch jobs')
+    parser.add_argument('--poll_interval', type=float, default=30.0, help='Initial batch status polling interval')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream completions, parse triples as they arrive and record time to first token')
+    parser.add_argument('--stop_on', nargs='*', choices=STOP_CONDITIONS, default=[],
+                        help='With --stream, close the request once triples are followed by a blank or a '
+                             'non-triple line')
+    parser.add_argument('--max_triples', type=int, default=None,
+                        help='With --stream, close the request after this many triples')
+    parser.add_argument('--packed', action='store_true',
+                        help='Send the packed prompts of gen_prompt.py --pack_budget, answers are split per sentence '
+                             'and sentences without a reliable answer are retried with their own prompt')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Discard existing responses instead of resuming from them')
+    parser.add_argument('--cache_path', default=DEFAULT_CACHE_PATH, help='Response cache database')
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_MAX_SIZE_MB, help='Response cache size limit')
+    parser.add_argument('--no_cache', action='store_true', help='Neither read nor write the response cache')
+    args = parser.parse_args()
 
-            except Exception as e:
-                print(f"Error processing prompt {prompt_id}: {str(e)}")
-                continue
+    # a local server does not check the key
+    api_key = args.api_key or os.getenv('OPENAI_API_KEY') or ('local' if args.base_url else None)
+    if not api_key:
+        print("OpenAI API key not provided. Please set it as an argument or environment variable.")
+        sys.exit(1)
+
+    if args.packed and (args.stop_on or args.max_triples):
+        # a packed answer holds the triples of several sentences, stopping early would cut off the later ones
+        print("--stop_on and --max_triples do not apply to packed prompts and are ignored")
+        args.stop_on, args.max_triples = [], None
+
+    jobs = prompt_jobs(args.prompt_gen_config_path, args.baseline_name, args.packed)
+    if jobs is None:
+        sys.exit(1)
 
-        output_file = os.path.join(output_dir, f'ont_{onto}_responses.jsonl')
+    # responses of a stand-in server are cached apart from those of the real API
+    backend = f"openai@{args.base_url}" if args.base_url else "openai"
+    cache = None if args.no_cache else ResponseCache(args.cache_path, args.cache_max_mb)
+    params = REQUEST_PARAMS if args.mode == 'batch' else cache_params(args)
+    # batch state is kept next to the responses of the first job
+    output_dir = jobs[0]['response_dir'] if jobs else '.'
+
+    # byte-identical prompts of all configs and ontologies are sent once, so every checkpoint stays open until
+    # the last response is fanned out
+    dedup = PromptDedup(backend, args.model)
+    responses = ResponseRouter(response_record)
+    with ExitStack() as stack:
+        for job in jobs:
+            print(f"\nPlanning ontology: {job['name']}")
+            checkpoint = stack.enter_context(ResponseCheckpoint(job['output_file'], overwrite=args.overwrite))
+            responses.add_job(job['name'], checkpoint, job['prompts'] if job['packed'] else None)
+            dedup.add(job['name'], pending_prompts(job['prompts'], responses, job['name'], cache, backend,
+                                                   args.model, params), params)
+        print(dedup.plan_summary())
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                for response_data in responses:
-                    json_line = json.dumps(response_data, ensure_ascii=False)
-                    f.write(json_line + '\n')
-            print(f"Successfully wrote responses to {output_file}")
+            send_prompts(args, api_key, dedup, responses, output_dir, cache, backend, params)
+
+            if any(responses.retry.values()):
+                # sentences a packed answer left out or answered under another number get their own prompt
+                print(f"\nPacked prompts: {responses.stats['sentences']} sentences answered, "
+                      f"{responses.stats['retried']} retried with their own prompt")
+                retry_dedup = PromptDedup(backend, args.model)
+                for job in jobs:
+                    prompt_ids = responses.retry[job['name']]
+                    if prompt_ids:
+                        retry_dedup.add(job['name'], pending_prompts(retry_prompts(job, prompt_ids), responses,
+                                                                     job['name'], cache, backend, args.model,
+                                                                     params), params)
+                send_prompts(args, api_key, retry_dedup, responses, output_dir, cache, backend, params)
         except Exception as e:
-            print(f"Error writing responses: {str(e)}")
-            continue
+            print(f"Error sending prompts: {str(e)}")
+            sys.exit(1)
+        print(dedup.summary())
+        # failed requests leave their sentences without a response, unless a retry answered them
+        unanswered = {job['name']: len(responses.pending(job['name'], [p for p in job['prompts']
+                                                                      if p.get('id') and p.get('prompt')]))
+                      for job in jobs}
+    for job in jobs:
+        print(f"Responses saved to {job['output_file']}")
+
+    if cache is not None:
+        cache.close()
+    if any(unanswered.values()):
+        print(f"{sum(unanswered.values())} prompts are still unanswered: "
+              f"{', '.join(f'{name} ({count})' for name, count in unanswered.items() if count)}")
+        sys.exit(1)
@@ -1,246 +1,243 @@
 import argparse
-import json
 import os
 import sys
-import time
-from typing import List, Dict, Optional
-
-from llama_cpp import Llama
-from huggingface_hub import hf_hub_download
-
-def download_model() -> Optional[str]:
-    """
-    Downloads the model from Hugging Face Hub if not already present.
-    
-    Returns:
-        The path to the downloaded model or None if download fails.
-    """
-    models_dir = "/data/johnsonv/models"
-    model_name = "qwen2.5-32b-instruct-q4_k_m.gguf"
-    model_path = os.path.join(models_dir, model_name)
-    
-    # Create models directory if it doesn't exist
-    os.makedirs(models_dir, exist_ok=True)
-    
-    # Check if model already exists
-    if os.path.exists(model_path):
-        print(f"Model already exists at {model_path}")
-        return model_path
-    
-    print("Downloading model... This may take a while.")
-    try:
-        model_path = hf_hub_download(
-            repo_id="TheRains/Qwen2.5-32B-Instruct-Q4_K_M-GGUF",
-            filename=model_name,
-            local_dir=models_dir,
-            local_dir_use_symlinks=False
-        )
-        print(f"Model downloaded successfully to {model_path}")
-        return model_path
-    except Exception as e:
-        print(f"Error downloading model: {str(e)}")
-        return None
-
-
-def initialize_model() -> Optional[Llama]:
-    """
-    Initializes the model using llama_cpp.
-    
-    Returns:
-        An instance of the Llama model or None if initialization fails.
-    """
-    model_path = download_model()
+from contextlib import ExitStack
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.checkpoint import ResponseCheckpoint
+from common.prompt_jobs import load_file, prompt_jobs, read_prompts, response_record, retry_prompts
+from common.response_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_SIZE_MB, ResponseCache
+from llama_pool import (DEFAULT_REPLICA_OVERHEAD_MB, DEFAULT_STATE_DIR, DEFAULT_STATE_MAX_SIZE_MB, LlamaPool,
+                        plan_replicas, shared_prefix)
+from model_files import (DEFAULT_MODELS_DIR, DRAFT_MODEL_NAME, DRAFT_MODEL_REPO, MODEL_NAME, MODEL_REPO,
+                         download_model, llama_kwargs)
+from ontology_grammar import build_grammar, grammar_hash
+from prompt_dedup import PromptDedup
+from prompt_packing import ResponseRouter, prompt_params
+from speculative import SPECULATIVE_MODES
+from streaming import STOP_CONDITIONS
+
+N_CTX = 2048
+# directory under <dataset>/baselines the responses are written to
+BASELINE_NAME = "Qwen2_5-32B-Instruct-Q4KM"
+# decoding parameters, part of the response cache key
+GENERATION_PARAMS = {'temperature': 0, 'n_ctx': N_CTX}
+
+def start_pool(args: argparse.Namespace) -> Optional[LlamaPool]:
+    """Download the model if needed and start the replicas"""
+    model_path = download_model(MODEL_REPO, MODEL_NAME, args.models_dir)
     if not model_path:
         return None
-    
     try:
-        llm = Llama(
-            model_path=model_path,
-            n_gpu_layers=-1,        # Maximum layers for RTX 3090
-            n_ctx=2048,             # Keep default context size
-            n_threads=24,           # Match your CPU core count
-            offload_kqv=True,       # Beneficial for large models
-            use_mlock=True,
-			verbose=False
-        )
+        replicas = None if args.replicas == 'auto' else int(args.replicas)
+        replicas, n_threads = plan_replicas(model_path, replicas, args.threads, args.replica_overhead_mb)
+        state_dir = None if args.kv_state_dir == 'none' else args.kv_state_dir
+        stream_options = None
+        if args.stream:
+            stream_options = {'stop_on': tuple(args.stop_on), 'max_triples': args.max_triples}
+        speculative = None
+        if args.speculative:
+            speculative = {'mode': args.speculative, 'num_pred_tokens': args.num_draft_tokens}
+            if args.speculative == 'draft_model':
+                speculative['model_path'] = args.draft_model_path or download_model(DRAFT_MODEL_REPO,
+                                                                                    DRAFT_MODEL_NAME, args.models_dir)
+                if not speculative['model_path']:
+                    return None
+        pool = LlamaPool(llama_kwargs(model_path, n_threads, args.n_gpu_layers, N_CTX),
+                         {'temperature': GENERATION_PARAMS['temperature'], 'max_tokens': args.max_tokens},
+                         replicas, state_dir, stream_options, speculative, state_max_size_mb=args.kv_state_max_mb)
+        pool.start()
         print("Model initialized successfully.")
-        return llm
+        return pool
     except Exception as e:
         print(f"Error initializing model: {str(e)}")
         return None
 
-def load_file(src_file: str) -> Optional[dict]:
-    """Load either JSON or JSONL file."""
-    try:
-        with open(src_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                return data
-            except json.JSONDecodeError:
-                f.seek(0)
-                data = []
-                for line in f:
-                    try:
-                        data.append(json.loads(line.strip()))
-                    except json.JSONDecodeError:
-                        continue
-                return data
-    except Exception as e:
-        print(f"Error loading file {src_file}: {str(e)}")
-        return None
-
-def parse_triples(response_text: str) -> List[List[str]]:
-    """Parse the response text to extract triples."""
-    triples = []
-    lines = response_text.strip().split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if '(' in line and ')' in line:
-            try:
-                relation_part, args_part = line.split('(', 1)
-                args_part = args_part.rstrip(')')
-                args = args_part.split(',', 1)
-                if len(args) == 2:
-                    sub = args[0].strip()
-                    obj = args[1].strip()
-                    rel = relation_part.strip()
-                    triples.append([sub, rel, obj])
-            except Exception as e:
-                print(f"Error parsing line: {line}, Error: {str(e)}")
-    return triples
-
-def get_file_paths(config: dict) -> Dict[str, dict]:
-    """Generate file paths from config."""
-    try:
-        # Extract dataset and type (seen/unseen) from path patterns
-        prompt_pattern = config['path_patterns']['prompt']
-        
-        # Determine if it's an unseen dataset
-        is_unseen = 'unseen' in prompt_pattern
-        
-        # Extract base dataset path (e.g., "../../data/dbpedia_webnlg" or "../../data/wikidata_tekgen")
-        base_path = prompt_pattern.split('/baselines')[0]
-        
-        # Construct response directory path
-        response_base = f"{base_path}/baselines/Qwen2_5-32B-Instruct-Q4KM"
-        if is_unseen:
-            response_dir = f"{response_base}/unseen/llm_responses"
-        else:
-            response_dir = f"{response_base}/llm_responses"
-        
-        file_paths = {}
-        for onto in config['onto_list']:
-            file_paths[onto] = {
-                'prompt_file': prompt_pattern.replace('$$onto$$', onto),
-                'response_dir': response_dir
-            }
-        return file_paths
-    except Exception as e:
-        print(f"Error generating file paths: {str(e)}")
-        return {}
-
-def generate_response(llm: Llama, prompt: str) -> Optional[str]:
-    """
-    Generates a response from the model given a prompt using chat completion.
-    
-    Args:
-        llm: The initialized model.
-        prompt: The input prompt string.
-    
-    Returns:
-        The generated response string or None if generation fails.
-    """
-    try:
-        start_time = time.time()
-        response = llm.create_chat_completion(
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        end_time = time.time()
-        
-        # Extract content from chat completion response
-        response_text = response['choices'][0]['message']['content']
-        
-        print(f"Response generated in {end_time - start_time:.2f} seconds.")
-        return response_text
-    except Exception as e:
-        print(f"Error generating response: {str(e)}")
-        return None
-
 def main():
     parser = argparse.ArgumentParser(description="Process prompts using model and store responses.")
-    parser.add_argument('--prompt_gen_config_path', required=True, help='Path to prompt generation config file')
+    parser.add_argument('--prompt_gen_config_path', required=True, nargs='+',
+                        help='Prompt generation config files, identical prompts across them are generated once')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Discard existing responses instead of resuming from them')
+    parser.add_argument('--cache_path', default=DEFAULT_CACHE_PATH, help='Response cache database')
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_MAX_SIZE_MB, help='Response cache size limit')
+    parser.add_argument('--no_cache', action='store_true', help='Neither read nor write the response cache')
+    parser.add_argument('--models_dir', default=DEFAULT_MODELS_DIR,
+                        help='Where GGUF models are kept and downloaded to, also set by TEXT2KG_MODELS_DIR')
+    parser.add_argument('--replicas', default='1',
+                        help='Model replicas decoding in parallel, "auto" sizes them to free memory and cores')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='CPU threads shared by all replicas')
+    parser.add_argument('--n_gpu_layers', type=int, default=-1,
+                        help='Layers offloaded to the GPU, 0 for CPU-only; every replica offloads its own copy')
+    parser.add_argument('--replica_overhead_mb', type=float, default=DEFAULT_REPLICA_OVERHEAD_MB,
+                        help='Memory per replica besides the shared weights, used by --replicas auto')
+    parser.add_argument('--kv_state_dir', default=DEFAULT_STATE_DIR,
+                        help='Where KV states of shared ontology prefixes are kept across runs, "none" keeps them '
+                             'in memory only')
+    parser.add_argument('--kv_state_max_mb', type=float, default=DEFAULT_STATE_MAX_SIZE_MB,
+                        help='Size limit of --kv_state_dir, least recently used states are deleted beyond it')
+    parser.add_argument('--no_prefix_reuse', action='store_true',
+                        help='Evaluate every prompt from scratch instead of restoring the shared prefix state')
+    parser.add_argument('--grammar', action='store_true',
+                        help="Constrain decoding to relation(subject, object) lines with the ontology's relations")
+    parser.add_argument('--max_tokens', type=int, default=None, help='Maximum number of generated tokens')
+    # greedy verification keeps outputs identical to plain decoding, so cached responses stay valid
+    parser.add_argument('--speculative', choices=SPECULATIVE_MODES, default=None,
+                        help='Draft tokens from n-grams of the prompt or with a small model of the same family')
+    parser.add_argument('--draft_model_path', default=None,
+                        help=f'GGUF draft model for --speculative draft_model, {DRAFT_MODEL_NAME} is downloaded '
+                             f'if not given')
+    parser.add_argument('--num_draft_tokens', type=int, default=None,
+                        help='Tokens drafted per step, 10 for prompt_lookup and 6 for draft_model by default')
+    parser.add_argument('--packed', action='store_true',
+                        help='Generate the packed prompts of gen_prompt.py --pack_budget, answers are split per '
+                             'sentence and sentences without a reliable answer are retried with their own prompt')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream generation, parse triples as they are generated and record time to first token')
+    parser.add_argument('--stop_on', nargs='*', choices=STOP_CONDITIONS, default=[],
+                        help='With --stream, stop generating once triples are followed by a blank or a '
+                             'non-triple line')
+    parser.add_argument('--max_triples', type=int, default=None,
+                        help='With --stream, stop generating after this many triples')
     args = parser.parse_args()
 
-    config = load_file(args.prompt_gen_config_path)
-    if not config:
-        sys.exit(1)
+    if args.packed and (args.stop_on or args.max_triples):
+        # a packed answer holds the triples of several sentences, stopping early would cut off the later ones
+        print("--stop_on and --max_triples do not apply to packed prompts and are ignored")
+        args.stop_on, args.max_triples = [], None
 
-    llm = initialize_model()
-    if not llm:
-        print("Failed to initialize model.")
+    jobs = prompt_jobs(args.prompt_gen_config_path, BASELINE_NAME, args.packed)
+    if jobs is None:
         sys.exit(1)
 
-    file_paths = get_file_paths(config)
-    if not file_paths:
-        sys.exit(1)
-
-    # Get response directory from the first ontology (all have same response_dir)
-    output_dir = next(iter(file_paths.values()))['response_dir']
-    os.makedirs(output_dir, exist_ok=True)
-
-    for onto in config['onto_list']:
-        print(f"\nProcessing ontology: {onto}")
-        paths = file_paths[onto]
-        prompt_file = paths['prompt_file']
-        
-        if not os.path.exists(prompt_file):
-            print(f"Prompt file {prompt_file} not found. Skipping ontology {onto}.")
-            continue
-
-        try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompts = [json.loads(line.strip()) for line in f if line.strip()]
-        except Exception as e:
-            print(f"Error reading prompt file {prompt_file}: {str(e)}")
-            continue
-
-        responses = []
-        for prompt_data in prompts:
-            prompt_id = prompt_data.get('id')
-            prompt_text = prompt_data.get('prompt')
-            if not prompt_id or not prompt_text:
-                continue
-
-            print(f"Processing prompt {prompt_id}")
-
-            response_text = generate_response(llm, prompt_text)
-            if response_text:
-                triples = parse_triples(response_text)
-
-                response_data = {
-                    'id': prompt_id,
-                    'response': response_text,
-                    'triples': triples
-                }
-
-                responses.append(response_data)
-                print(f"Prompt {prompt_id} processed successfully.")
+    cache = None if args.no_cache else ResponseCache(args.cache_path, args.cache_max_mb)
+
+    # the replicas are started on the first cache miss, a fully cached run never loads the model
+    pool = None
+
+    def plan(dedup: PromptDedup, job: dict, prompts: List[dict], packed: bool) -> bool:
+        """Answer what the checkpoint and the cache can and register the rest, False if the job is skipped"""
+        onto = job['onto']
+        # decoding options are part of the response cache key
+        generation_params = dict(GENERATION_PARAMS)
+        if args.max_tokens:
+            generation_params['max_tokens'] = args.max_tokens
+        grammar = None
+        if args.grammar:
+            ontology = load_file(job['ontology_file']) if job['ontology_file'] else None
+            if not isinstance(ontology, dict):
+                print(f"Ontology file for {onto} not found, the grammar needs its relations. "
+                      f"Skipping ontology {onto}.")
+                return False
+            try:
+                grammar = build_grammar(ontology, packed)
+            except ValueError as e:
+                print(f"Cannot build a grammar for {onto}: {str(e)}. Skipping ontology {onto}.")
+                return False
+            generation_params['grammar'] = grammar_hash(grammar)
+        if args.stream and (args.stop_on or args.max_triples):
+            # early stopping truncates responses
+            generation_params['stop'] = {'on': sorted(args.stop_on), 'max_triples': args.max_triples}
+        job['grammar'] = grammar
+        job['generation_params'] = generation_params
+
+        # the instruction and ontology block shared by all prompts of the ontology is evaluated once and its
+        # KV state restored for every prompt. It is computed once from the whole prompt file, not from the
+        # pending prompts, so resumed runs and retries find the same state; packed prompts start with it too
+        if 'prefix' not in job:
+            job['prefix'] = None
+            if not args.no_prefix_reuse:
+                all_prompts = (read_prompts(job['prompt_file']) if job['packed'] else job['prompts']) or []
+                job['prefix'] = shared_prefix([p.get('prompt') or '' for p in all_prompts])
+
+        prompts = [p for p in prompts if p.get('id') and p.get('prompt')]
+        pending = responses.pending(job['name'], prompts)
+        if len(pending) < len(prompts):
+            print(f"Resuming: {len(prompts) - len(pending)} prompts already answered, {len(pending)} remaining")
+
+        # answer from the response cache first
+        uncached = []
+        for prompt_data in pending:
+            response_text = None
+            if cache is not None:
+                response_text = cache.get('llama_cpp', MODEL_NAME, prompt_params(generation_params, prompt_data),
+                                          prompt_data['prompt'])
+            if response_text is None:
+                uncached.append(prompt_data)
             else:
-                print(f"Failed to generate response for prompt {prompt_id}.")
-
-        output_file = os.path.join(output_dir, f'ont_{onto}_responses.jsonl')
-        try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                for response_data in responses:
-                    json_line = json.dumps(response_data, ensure_ascii=False)
-                    f.write(json_line + '\n')
-            print(f"Successfully wrote responses to {output_file}")
-        except Exception as e:
-            print(f"Error writing responses: {str(e)}")
-            continue
+                responses.write(job['name'], prompt_data['id'], response_text)
+        if len(uncached) < len(pending):
+            print(f"Response cache: {len(pending) - len(uncached)} cached, {len(uncached)} to generate")
+        dedup.add(job['name'], uncached, generation_params)
+        return True
+
+    def generate(dedup: PromptDedup, planned: List[dict]) -> None:
+        """Generate the distinct prompts of every planned job and route each response to all prompts it answers"""
+        nonlocal pool
+        for job in planned:
+            owned = dedup.dispatch(job['name'])
+            if not owned:
+                continue
+            print(f"\nProcessing ontology: {job['name']}")
+            if pool is None:
+                pool = start_pool(args)
+                if pool is None:
+                    sys.exit(1)
+                # the replicas are shut down with the checkpoints, also when generation fails
+                stack.enter_context(pool)
+
+            # replicas take prompts from a shared queue, responses are written in completion order; packed
+            # prompts bring their own answer allowance
+            prompts = {p['id']: p for p in owned}
+            overrides = {p['id']: {'max_tokens': p['max_tokens']} for p in owned if p.get('max_tokens')}
+            for prompt_id, result in pool.imap([(p['id'], p['prompt']) for p in owned], job['prefix'],
+                                               job['grammar'], overrides):
+                if result is None or not result['response']:
+                    print(f"Failed to generate response for prompt {prompt_id}.")
+                    for target_job, target_id in dedup.targets_of(job['name'], prompt_id):
+                        responses.failed(target_job, target_id)
+                    continue
+                if cache is not None:
+                    cache.put('llama_cpp', MODEL_NAME, prompt_params(job['generation_params'], prompts[prompt_id]),
+                              prompts[prompt_id]['prompt'], result['response'])
+                targets = dedup.fan_out(job['name'], prompt_id, result['response'], result['prompt_tokens'],
+                                        result['completion_tokens'])
+                for i, (target_job, target_id) in enumerate(targets):
+                    # timing belongs to the generation, it is recorded with the prompt that was generated
+                    responses.write(target_job, target_id, result['response'],
+                                    result.get('timing') if i == 0 else None)
+
+    # byte-identical prompts of all configs and ontologies are generated once, so every checkpoint stays open
+    # until the last response is fanned out
+    dedup = PromptDedup('llama_cpp', MODEL_NAME)
+    responses = ResponseRouter(response_record)
+    with ExitStack() as stack:
+        planned = []
+        for job in jobs:
+            print(f"\nPlanning ontology: {job['name']}")
+            # each response is written as soon as it is generated, a restart skips the prompts already answered
+            checkpoint = stack.enter_context(ResponseCheckpoint(job['output_file'], overwrite=args.overwrite))
+            responses.add_job(job['name'], checkpoint, job['prompts'] if job['packed'] else None)
+            if plan(dedup, job, job['prompts'], job['packed']):
+                planned.append(job)
+        print(dedup.plan_summary())
+        generate(dedup, planned)
+
+        if any(responses.retry.values()):
+            # sentences a packed answer left out or answered under another number get their own prompt
+            print(f"\nPacked prompts: {responses.stats['sentences']} sentences answered, "
+                  f"{responses.stats['retried']} retried with their own prompt")
+            retry_dedup = PromptDedup('llama_cpp', MODEL_NAME)
+            retried = [job for job in planned if responses.retry[job['name']]
+                       and plan(retry_dedup, job, retry_prompts(job, responses.retry[job['name']]), False)]
+            generate(retry_dedup, retried)
+        print(dedup.summary())
+    for job in jobs:
+        print(f"Responses saved to {job['output_file']}")
+
+    if pool is not None:
+        print(f"Generation totals: {pool.stats}")
 
 if __name__ == "__main__":
     main()
@@ -1,15 +1,22 @@
 import argparse
-import glob
-import hashlib
 import json
 import os
-import shutil
 import sys
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
+import numpy as np
 import torch
-from sentence_transformers import SentenceTransformer, util
-from tqdm import tqdm
+from sentence_transformers import SentenceTransformer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from embedding_store import DEFAULT_MAX_SIZE_MB, DEFAULT_STORE_DIR, EmbeddingStore
+from encoder_precision import PRECISIONS, encoder_key, load_encoder
+from lexical_retrieval import LEXICAL_METHODS, LexicalIndex, hybrid_rerank
+from similarity_io import write_similarities
+from ann_index import check_ann_config
+from dense_retrieval import load_sentences, open_ann_index, report_ann_recall, search_neighbours
+
+RETRIEVERS = ('dense', 'hybrid') + LEXICAL_METHODS
 
 def load_file(file_path: str) -> dict:
     """Load JSON config file"""
@@ -20,49 +27,122 @@ def load_file(file_path: str) -> dict:
         print(f"Error loading file {file_path}: {str(e)}")
         return {}
 
-def load_sentences(file_path: str) -> Tuple[List[str], List[str], str]:
-    """Load sentences, IDs, and compute file content hash from JSONL file"""
-    sentences, ids = [], []
-    content = []
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                content.append(line)
-                data = json.loads(line.strip())
-                sentences.append(data['sent'])
-                ids.append(data['id'])
-        file_content = ''.join(content)
-        file_hash = hashlib.sha1(file_content.encode('utf-8')).hexdigest()
-        return sentences, ids, file_hash
-    except Exception as e:
-        print(f"Error loading sentences from {file_path}: {str(e)}")
-        return [], [], ''
-
 def compute_similarities(test_embeddings: torch.Tensor,
                        train_embeddings: torch.Tensor,
-                       test_ids: List[str],
-                       train_ids: List[str],
-                       top_k: int) -> dict:
-    """Compute similarities between test and train embeddings"""
+                       top_k: int,
+                       chunk_size: int = 1024,
+                       ann=None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Compute (scores, indices) of the top-k train neighbours, exactly or through an ANN index"""
     try:
         # Compute similarities and find top-k similar sentences
-        similarity_results = {}
         print('Computing similarities and finding top similar sentences...')
-        for idx, test_embedding in enumerate(tqdm(test_embeddings)):
-            cosine_scores = util.cos_sim(test_embedding, train_embeddings)[0]
-            top_results = torch.topk(cosine_scores, k=top_k)
-            similar_train_ids = [train_ids[i] for i in top_results[1]]
-            similarity_results[test_ids[idx]] = similar_train_ids
-        return similarity_results
+        return search_neighbours(test_embeddings, train_embeddings, top_k, chunk_size, ann)
     except Exception as e:
         print(f"Error computing similarities: {str(e)}")
-        return {}
+        return None
+
+def lexical_index(config: dict, train_sentences: List[str], method: str) -> LexicalIndex:
+    """Build a BM25 or TF-IDF index with the parameters of the optional "lexical" config section"""
+    lexical_config = config.get('lexical', {})
+    return LexicalIndex(train_sentences, method, k1=lexical_config.get('k1', 1.5), b=lexical_config.get('b', 0.75))
+
+def lexical_similarities(config: dict,
+                         test_sentences: List[str],
+                         train_sentences: List[str],
+                         top_k: int,
+                         chunk_size: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Rank train sentences for all test sentences with sparse BM25/TF-IDF scoring"""
+    try:
+        print(f"Scoring test sentences with {config['retriever']}...")
+        index = lexical_index(config, train_sentences, config['retriever'])
+        return index.topk(test_sentences, top_k, chunk_size)
+    except Exception as e:
+        print(f"Error computing lexical similarities: {str(e)}")
+        return None
+
+def hybrid_similarities(config: dict,
+                        test_sentences: List[str],
+                        train_sentences: List[str],
+                        test_embeddings: np.ndarray,
+                        train_embeddings: np.ndarray,
+                        top_k: int,
+                        chunk_size: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Retrieve lexical top-N candidates and rerank them by dense cosine similarity"""
+    try:
+        method = config.get('lexical', {}).get('method', 'bm25')
+        num_candidates = config.get('hybrid_candidates', 50)
+        print(f"Retrieving {num_candidates} {method} candidates and reranking with dense embeddings...")
+        index = lexical_index(config, train_sentences, method)
+        _, candidates = index.topk(test_sentences, max(num_candidates, top_k), chunk_size)
+        return hybrid_rerank(candidates, test_embeddings, train_embeddings, top_k, chunk_size)
+    except Exception as e:
+        print(f"Error computing hybrid similarities: {str(e)}")
+        return None
+
+def pool_sentences(configs: List[dict], patterns: Tuple[str, ...] = ('train', 'test')) -> List[str]:
+    """Collect the sentences of every ontology in the configs for the given path patterns"""
+    pooled = []
+    for config in configs:
+        for onto in config['onto_list']:
+            for pattern in patterns:
+                sentences, _, _ = load_sentences(config['path_patterns'][pattern].replace('$$onto$$', onto))
+                pooled.extend(sentences)
+    return pooled
+
+def prefetch_embeddings(configs: List[dict],
+                        model: SentenceTransformer,
+                        model_key: str,
+                        store: EmbeddingStore,
+                        batch_size: int) -> None:
+    """Pool train and test sentences of every ontology in the configs and encode the distinct ones missing
+    from the store in a single pass"""
+    pooled = pool_sentences(configs)
+    print(f'\n{"-"*40}\nPooled {len(pooled)} sentences from {len(configs)} config(s)\n{"-"*40}')
+    # go through a tensor, bfloat16 outputs have no numpy equivalent
+    store.ensure(model_key, pooled, lambda sentences: model.encode(sentences, batch_size=batch_size,
+                                                                   convert_to_tensor=True,
+                                                                   show_progress_bar=True).float().cpu().numpy())
+
+def dense_similarities(onto: str,
+                       config: dict,
+                       model_key: str,
+                       store: EmbeddingStore,
+                       test_vectors: np.ndarray,
+                       train_vectors: np.ndarray,
+                       train_hash: str,
+                       train_file: str,
+                       top_k: int,
+                       chunk_size: int,
+                       output_dir: str,
+                       device: torch.device) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Exact cosine search, or ANN search when the config has an "ann" section"""
+    train_embeddings = torch.from_numpy(train_vectors).to(device)
+    test_embeddings = torch.from_numpy(test_vectors).to(device)
+
+    # Optional approximate search, the index is persisted next to the embedding store
+    ann = None
+    ann_config = config.get('ann')
+    if ann_config:
+        ann = open_ann_index(onto, ann_config, model_key, store.root, train_embeddings, train_hash,
+                             train_file)
+        report_ann_recall(onto, ann, ann_config, test_embeddings, train_embeddings, top_k, chunk_size,
+                          os.path.join(output_dir, 'ann_recall_report.jsonl'))
+
+    # Compute similarities
+    return compute_similarities(
+        test_embeddings=test_embeddings,
+        train_embeddings=train_embeddings,
+        top_k=top_k,
+        chunk_size=chunk_size,
+        ann=ann
+    )
 
 def process_ontology(onto: str, 
                     config: dict, 
-                    model: SentenceTransformer,
-                    model_name: str) -> None:
-    """Process single ontology with cross-config cache support"""
+                    model: Optional[SentenceTransformer],
+                    model_key: Optional[str],
+                    store: EmbeddingStore) -> None:
+    """Process single ontology, embeddings are shared with other configs through the embedding store"""
     try:
         # Get file paths using patterns
         test_file = config['path_patterns']['test'].replace('$$onto$$', onto)
@@ -79,96 +159,38 @@ def process_ontology(onto: str,
             print(f"Skipping {onto} due to missing data")
             return
 
-        # Set up cache paths
         output_dir = os.path.dirname(output_file)
-        current_cache_dir = os.path.join(output_dir, 'cache')
-        os.makedirs(current_cache_dir, exist_ok=True)
-
-        # Check regular config cache directory if available
-        regular_cache_dir = current_cache_dir.replace('/unseen/', '/').replace('\\unseen\\', '\\')
-        potential_sources = [current_cache_dir]
-        if regular_cache_dir != current_cache_dir and os.path.exists(regular_cache_dir):
-            potential_sources.append(regular_cache_dir)
-            print(f"Checking regular config cache dir: {regular_cache_dir}")
-
-        # Generate cache filename components
-        safe_model_name = model_name.replace('/', '_')
-        cache_filename = f"{onto}__{safe_model_name}__{train_hash}.pt"
-        current_cache_path = os.path.join(current_cache_dir, cache_filename)
-
-        # Look for existing caches in potential locations
-        existing_caches = []
-        for source_dir in potential_sources:
-            candidate = os.path.join(source_dir, cache_filename)
-            if os.path.exists(candidate):
-                existing_caches.append(candidate)
-                print(f"Found valid cache in: {candidate}")
-
-        # Copy cache from regular config if available
-        if existing_caches:
-            best_source = existing_caches[0]
-            if best_source != current_cache_path:
-                print(f"\nCopying shared cache from: {best_source}")
-                try:
-                    shutil.copyfile(best_source, current_cache_path)
-                    print(f"Successfully copied cache to: {current_cache_path}")
-                except Exception as e:
-                    print(f"Cache copy failed: {str(e)}")
-                    existing_caches = []  # Force recompute if copy failed
-
-        # Cleanup old caches in current directory
-        cache_pattern = os.path.join(current_cache_dir, f"{onto}__{safe_model_name}__*.pt")
-        existing_cache_files = glob.glob(cache_pattern)
-        for file_path in existing_cache_files:
-            if file_path != current_cache_path:
-                try:
-                    os.remove(file_path)
-                    print(f"Removed outdated cache: {os.path.basename(file_path)}")
-                except Exception as e:
-                    print(f"Failed to remove old cache: {str(e)}")
-
-        # Load or compute embeddings
-        train_embeddings = None
-        if os.path.exists(current_cache_path):
-            print(f"\nLoading cached embeddings from: {current_cache_path}")
-            try:
-                cache_data = torch.load(current_cache_path)
-                train_embeddings = cache_data['train_embeddings']
-                device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-                train_embeddings = train_embeddings.to(device)
-                print(f"Successfully loaded cached embeddings (shape: {train_embeddings.shape})")
-            except Exception as e:
-                print(f"Error loading cache file: {str(e)}")
-                train_embeddings = None
-
-        if train_embeddings is None:
-            print('\nComputing fresh embeddings for train sentences...')
-            train_embeddings = model.encode(train_sentences, convert_to_tensor=True, show_progress_bar=True)
-            try:
-                torch.save({'train_embeddings': train_embeddings}, current_cache_path)
-                print(f"\nSaved new cache to: {current_cache_path}")
-            except Exception as e:
-                print(f"Error saving cache file: {str(e)}")
-
-        # Compute test embeddings and similarities
-        print('\nComputing embeddings for test sentences...')
-        test_embeddings = model.encode(test_sentences, convert_to_tensor=True, show_progress_bar=True)
-
-        # Compute similarities
-        similarity_results = compute_similarities(
-            test_embeddings=test_embeddings,
-            train_embeddings=train_embeddings,
-            test_ids=test_ids,
-            train_ids=train_ids,
-            top_k=config.get('top_k', 5)
-        )
-
-        if similarity_results:
-            # Ensure output directory exists
-            os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            # Save results
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(similarity_results, f, indent=4)
+        top_k = config.get('top_k', 5)
+        chunk_size = config.get('similarity_chunk_size', 1024)
+        retriever = config.get('retriever', 'dense')
+
+        if retriever in LEXICAL_METHODS:
+            # Sparse retrieval needs no encoder at all
+            similarity_results = lexical_similarities(config, test_sentences, train_sentences, top_k, chunk_size)
+        else:
+            # Train and test embeddings come from the shared content-addressed store, so only sentences that
+            # no config has encoded with this model before are run through the encoder
+            batch_size = config.get('encode_batch_size', 32)
+            # go through a tensor, bfloat16 outputs have no numpy equivalent
+            encode_fn = lambda sentences: model.encode(sentences, batch_size=batch_size, convert_to_tensor=True,
+                                                       show_progress_bar=True).float().cpu().numpy()
+            print('\nEmbedding train sentences...')
+            train_vectors = store.encode(model_key, train_sentences, encode_fn)
+            print('\nEmbedding test sentences...')
+            test_vectors = store.encode(model_key, test_sentences, encode_fn)
+
+            if retriever == 'hybrid':
+                similarity_results = hybrid_similarities(config, test_sentences, train_sentences, test_vectors,
+                                                         train_vectors, top_k, chunk_size)
+            else:
+                similarity_results = dense_similarities(onto, config, model_key, store, test_vectors, train_vectors,
+                                                        train_hash, train_file, top_k, chunk_size,
+                                                        output_dir, model.device)
+
+        if similarity_results is not None:
+            # Save results, the format follows the output file extension
+            scores, indices = similarity_results
+            write_similarities(output_file, test_ids, train_ids, scores, indices)
             print(f'\n{"-"*40}\nResults saved to {output_file}\n{"-"*40}')
 
     except Exception as e:
@@ -176,26 +198,79 @@ def process_ontology(onto: str,
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--prompt_gen_config_path', required=True, help='Path to config file')
+    parser.add_argument('--prompt_gen_config_path', required=True, nargs='+',
+                        help='Path to one or more config files, processed with one model load per model name')
     args = parser.parse_args()
 
-    # Load config
-    config = load_file(args.prompt_gen_config_path)
-    if not config:
-        sys.exit(1)
+    # Load configs
+    configs = []
+    for config_path in args.prompt_gen_config_path:
+        config = load_file(config_path)
+        if not config:
+            sys.exit(1)
+        if config.get('ann'):
+            try:
+                check_ann_config(config['ann'])
+            except (ValueError, ImportError) as e:
+                print(f"Invalid ANN configuration in {config_path}: {str(e)}")
+                sys.exit(1)
+        if config.get('retriever', 'dense') not in RETRIEVERS:
+            print(f"Invalid retriever in {config_path}, expected one of {', '.join(RETRIEVERS)}")
+            sys.exit(1)
+        if config.get('encoder_precision', 'fp32') not in PRECISIONS:
+            print(f"Invalid encoder_precision in {config_path}, expected one of {', '.join(PRECISIONS)}")
+            sys.exit(1)
+        configs.append(config)
 
     try:
-        # Initialize model
-        model_name = config.get('model_name', 'sentence-t5-xxl')
-        model = SentenceTransformer(model_name)
+        # The store is shared by all configs, its location and size limit come from the first config
+        store_config = configs[0].get('embedding_store', {})
+        store = EmbeddingStore(store_config.get('path', DEFAULT_STORE_DIR),
+                               store_config.get('max_size_mb', DEFAULT_MAX_SIZE_MB))
 
-        # Process each ontology
-        for onto in config['onto_list']:
-            process_ontology(onto, config, model, model_name)
+        # Lexical retrieval does not load an encoder
+        for config in configs:
+            if config.get('retriever', 'dense') in LEXICAL_METHODS:
+                for onto in config['onto_list']:
+                    process_ontology(onto, config, None, None, store)
+
+        configs_by_model = {}
+        for config in configs:
+            if config.get('retriever', 'dense') in LEXICAL_METHODS:
+                continue
+            encoder = (config.get('model_name', 'sentence-t5-xxl'), config.get('encoder_precision', 'fp32'))
+            configs_by_model.setdefault(encoder, []).append(config)
+
+        for (model_name, precision), model_configs in configs_by_model.items():
+            # Initialize model once for every config that uses it, reduced precision is checked against
+            # full precision on a sample before it is used
+            first = model_configs[0]
+            reduced = precision != 'fp32'
+            try:
+                model = load_encoder(model_name, precision,
+                                     query_sentences=pool_sentences(model_configs, ('test',)) if reduced else [],
+                                     pool_sentences=pool_sentences(model_configs, ('train',)) if reduced else [],
+                                     check_config=first.get('precision_check', {}),
+                                     top_k=first.get('top_k', 5),
+                                     local_files_only=first.get('local_files_only', False))
+            except ValueError as e:
+                print(f"Refusing to use the {precision} encoder: {str(e)}")
+                sys.exit(1)
+            model_key = encoder_key(model_name, precision)
+            batch_size = first.get('encode_batch_size', 32)
+
+            # Encode the sentences of all ontologies in one pass
+            prefetch_embeddings(model_configs, model, model_key, store, batch_size)
+
+            # Process each ontology, its embeddings are now read back from the store
+            for config in model_configs:
+                for onto in config['onto_list']:
+                    process_ontology(onto, config, model, model_key, store)
+        store.close()
 
     except Exception as e:
         print(f"Error in main execution: {str(e)}")
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
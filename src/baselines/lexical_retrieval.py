@@ -0,0 +1,126 @@
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy import sparse
+
+LEXICAL_METHODS = ('bm25', 'tfidf')
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def count_matrix(sentences: List[str], vocabulary: Dict[str, int], grow: bool) -> sparse.csr_matrix:
+    """Sentence x term count matrix; unknown terms are added when grow is set and dropped otherwise"""
+    indptr, indices = [0], []
+    for sentence in sentences:
+        for token in tokenize(sentence):
+            column = vocabulary.get(token)
+            if column is None:
+                if not grow:
+                    continue
+                column = vocabulary[token] = len(vocabulary)
+            indices.append(column)
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(sentences), len(vocabulary)))
+    # duplicate (row, column) entries are summed into term counts
+    matrix.sum_duplicates()
+    return matrix
+
+
+def l2_normalize_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Scale every row of a sparse matrix to unit length, empty rows stay empty"""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+class LexicalIndex:
+    """BM25 or TF-IDF index over the training sentences of one ontology. Scores of all test sentences are
+    computed with a single sparse matrix product per chunk."""
+
+    def __init__(self, train_sentences: List[str], method: str = 'bm25', k1: float = 1.5, b: float = 0.75):
+        if method not in LEXICAL_METHODS:
+            raise ValueError(f"Unknown lexical method {method}, expected one of {', '.join(LEXICAL_METHODS)}")
+        self.method = method
+        self.vocabulary = {}
+        counts = count_matrix(train_sentences, self.vocabulary, grow=True).tocsc()
+        num_docs = counts.shape[0]
+        doc_freq = np.diff(counts.indptr)
+        counts = counts.tocsr()
+        if method == 'bm25':
+            self.idf = np.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+            doc_len = np.asarray(counts.sum(axis=1)).ravel()
+            avg_len = doc_len.mean() if num_docs else 0
+            norm = k1 * (1 - b + b * doc_len / avg_len) if avg_len else np.full(num_docs, k1)
+            # saturate term frequencies per document: tf * (k1 + 1) / (tf + norm)
+            weights = counts.copy()
+            row_norm = np.repeat(norm, np.diff(counts.indptr))
+            weights.data = weights.data * (k1 + 1) / (weights.data + row_norm)
+            self.doc_matrix = (weights @ sparse.diags(self.idf)).tocsr()
+        else:
+            self.idf = (np.log((1 + num_docs) / (1 + doc_freq)) + 1).astype(np.float32)
+            self.doc_matrix = l2_normalize_rows((counts @ sparse.diags(self.idf)).tocsr())
+        self.doc_matrix_t = self.doc_matrix.T.tocsr()
+
+    def query_matrix(self, sentences: List[str]) -> sparse.csr_matrix:
+        """Test sentence x term matrix in the index vocabulary"""
+        counts = count_matrix(sentences, self.vocabulary, grow=False)
+        if self.method == 'bm25':
+            # BM25 sums the document weights of the query terms, repeated query terms count repeatedly
+            return counts
+        return l2_normalize_rows((counts @ sparse.diags(self.idf)).tocsr())
+
+    def topk(self, sentences: List[str], top_k: int, chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k train rows per test sentence as (scores, indices), ties broken by the lower train index"""
+        k = min(top_k, self.doc_matrix.shape[0])
+        queries = self.query_matrix(sentences)
+        all_scores, all_indices = [], []
+        for start in range(0, queries.shape[0], chunk_size):
+            scores = (queries[start:start + chunk_size] @ self.doc_matrix_t).toarray()
+            indices = top_k_rows(scores, k)
+            all_scores.append(np.take_along_axis(scores, indices, axis=1))
+            all_indices.append(indices)
+        if not all_indices:
+            return np.zeros((0, k), dtype=np.float32), np.zeros((0, k), dtype=np.int64)
+        return np.concatenate(all_scores), np.concatenate(all_indices)
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k largest values per row, sorted by score descending and index ascending"""
+    num_cols = scores.shape[1]
+    if k >= num_cols:
+        return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    # partition to the k-th largest score, then order only the columns that reach it; a stable sort keeps the
+    # lower index first among equal scores
+    kth_largest = -np.partition(-scores, k - 1, axis=1)[:, k - 1]
+    rows = []
+    for row, threshold in zip(scores, kth_largest):
+        columns = np.flatnonzero(row >= threshold)
+        rows.append(columns[np.argsort(-row[columns], kind='stable')[:k]])
+    return np.stack(rows) if rows else np.zeros((0, k), dtype=np.int64)
+
+
+def hybrid_rerank(candidate_indices: np.ndarray,
+                  test_embeddings: np.ndarray,
+                  train_embeddings: np.ndarray,
+                  top_k: int,
+                  chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+    """Rerank lexical candidates by dense cosine similarity, returns (scores, train indices)"""
+    train_norm = train_embeddings / np.maximum(np.linalg.norm(train_embeddings, axis=1, keepdims=True), 1e-12)
+    test_norm = test_embeddings / np.maximum(np.linalg.norm(test_embeddings, axis=1, keepdims=True), 1e-12)
+    k = min(top_k, candidate_indices.shape[1])
+    all_scores, all_indices = [], []
+    for start in range(0, candidate_indices.shape[0], chunk_size):
+        candidates = candidate_indices[start:start + chunk_size]
+        scores = np.einsum('nd,ncd->nc', test_norm[start:start + chunk_size], train_norm[candidates])
+        order = top_k_rows(scores, k)
+        all_scores.append(np.take_along_axis(scores, order, axis=1))
+        all_indices.append(np.take_along_axis(candidates, order, axis=1))
+    if not all_indices:
+        return np.zeros((0, k), dtype=np.float32), np.zeros((0, k), dtype=np.int64)
+    return np.concatenate(all_scores), np.concatenate(all_indices)
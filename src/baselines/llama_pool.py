@@ -0,0 +1,444 @@
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from speculative import make_draft_model
+from streaming import IncrementalTripleParser, consume_stream
+
+# memory of one replica beyond the weights: KV cache, compute buffers and the interpreter
+DEFAULT_REPLICA_OVERHEAD_MB = 1024
+# fewer threads than this per replica makes single-sequence decode slower than the throughput gained
+MIN_THREADS_PER_REPLICA = 4
+DEFAULT_STATE_DIR = os.environ.get(
+    'TEXT2KG_KV_STATE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'text2kgbench', 'kv_states'))
+# a state of a 32B model's ontology prefix takes a few hundred MB
+DEFAULT_STATE_MAX_SIZE_MB = 4096
+
+
+def available_memory_bytes() -> int:
+    """MemAvailable from /proc/meminfo, falling back to total physical memory"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def plan_replicas(model_path: str,
+                  replicas: Optional[int] = None,
+                  n_threads: Optional[int] = None,
+                  replica_overhead_mb: float = DEFAULT_REPLICA_OVERHEAD_MB) -> Tuple[int, int]:
+    """
+    Choose the number of model replicas and the threads of each.
+    Replicas map the GGUF file, so the weights sit in the page cache once and every replica only adds its
+    own KV cache and buffers. Without an explicit count, as many replicas run as fit both the available
+    memory and the cores at MIN_THREADS_PER_REPLICA each.
+    :return: (replicas, threads per replica)
+    """
+    cores = n_threads or os.cpu_count() or 1
+    if replicas is None:
+        spare = available_memory_bytes() - os.path.getsize(model_path)
+        by_memory = int(spare // (replica_overhead_mb * 1024 * 1024))
+        replicas = max(1, min(by_memory, cores // MIN_THREADS_PER_REPLICA))
+    return replicas, max(1, cores // replicas)
+
+
+def shared_prefix(prompts: List[str]) -> Optional[str]:
+    """Longest common prefix of the prompts, cut back to the last line break; None for fewer than two prompts"""
+    if len(prompts) < 2:
+        return None
+    prefix = os.path.commonprefix(prompts)
+    cut = prefix.rfind('\n')
+    return prefix[:cut + 1] if cut > 0 else None
+
+
+def find_subsequence(tokens: List[int], part: List[int]) -> int:
+    """Start of the first occurrence of part in tokens, -1 if absent"""
+    if not part:
+        return -1
+    for start in range(len(tokens) - len(part) + 1):
+        if tokens[start:start + len(part)] == part:
+            return start
+    return -1
+
+
+class PrefixStateCache:
+    """
+    KV states of evaluated prompt prefixes, kept in memory and optionally pickled to disk.
+
+    A state holds the tokens of the chat template head plus the shared ontology block of one ontology.
+    Restoring it before a prompt leaves llama.cpp's own prefix matching only the item-specific suffix to
+    evaluate. llama.cpp already reuses a prefix shared with the previous prompt of the same context, so the
+    snapshot pays off for the first prompt of an ontology in every replica and run, and whenever a replica
+    switches ontologies. Files are keyed by model and prefix hash, so they survive restarts and are shared by
+    all replicas. When the files exceed max_size_mb, the least recently used ones are deleted; a file's
+    modification time is its last use.
+    """
+
+    def __init__(self, llm, llama_kwargs: dict, state_dir: Optional[str] = None, max_in_memory: int = 2,
+                 max_size_mb: Optional[float] = DEFAULT_STATE_MAX_SIZE_MB):
+        self.llm = llm
+        self.state_dir = state_dir
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_in_memory = max_in_memory
+        self.model_id = f"{os.path.basename(llama_kwargs['model_path'])}:{llama_kwargs.get('n_ctx')}"
+        if getattr(llm, 'draft_model', None) is not None:
+            # speculative decoding keeps the logits of every position, its states do not load into a plain model
+            self.model_id += ':logits_all'
+        self.states = {}
+        # prefix text -> prefix tokens in chat-formatted prompts, None when they could not be located
+        self.prefix_tokens = {}
+        self.stats = {'restored': 0, 'reused': 0, 'created': 0, 'loaded': 0, 'evicted': 0}
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.state_dir, f"{key}.state")
+
+    def _key(self, prefix: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\n{prefix}".encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, state) -> None:
+        self.states[key] = state
+        while len(self.states) > self.max_in_memory:
+            del self.states[next(iter(self.states))]
+
+    def _lookup(self, key: str):
+        state = self.states.get(key)
+        if state is None and self.state_dir and os.path.exists(self._path(key)):
+            try:
+                with open(self._path(key), 'rb') as f:
+                    state = pickle.load(f)
+                self.stats['loaded'] += 1
+                self._remember(key, state)
+                os.utime(self._path(key))
+            except Exception as e:
+                print(f"Error loading KV state {self._path(key)}: {str(e)}")
+        return state
+
+    def restore(self, prefix: Optional[str]) -> None:
+        """Make the context start with the prefix state before the next prompt is evaluated"""
+        if not prefix:
+            return
+        if prefix not in self.prefix_tokens:
+            # a state saved by an earlier run or another replica also tells which tokens the prefix covers
+            state = self._lookup(self._key(prefix))
+            if state is None:
+                return
+            self.prefix_tokens[prefix] = [int(token) for token in state.input_ids[:state.n_tokens]]
+        tokens = self.prefix_tokens[prefix]
+        if not tokens:
+            return
+        n = len(tokens)
+        if self.llm.n_tokens >= n and list(self.llm.input_ids[:n]) == tokens:
+            # the previous prompt shared the prefix, llama.cpp matches it without a restore
+            self.stats['reused'] += 1
+            return
+        state = self._lookup(self._key(prefix))
+        if state is not None:
+            self.llm.load_state(state)
+            self.stats['restored'] += 1
+
+    def learn(self, prefix: Optional[str], prompt_tokens: List[int]) -> None:
+        """After the first prompt with a new prefix, locate the prefix in its chat-formatted tokens and snapshot
+        the KV state of exactly those tokens"""
+        if not prefix or prefix in self.prefix_tokens:
+            return
+        # the last token may merge with the text that follows the prefix, match without it
+        user_tokens = self.llm.tokenize(prefix.encode('utf-8'), add_bos=False)[:-1]
+        start = find_subsequence(prompt_tokens, user_tokens)
+        if start < 0:
+            print("Shared prefix not found in the formatted prompt, prefix reuse disabled for it")
+            self.prefix_tokens[prefix] = None
+            return
+        tokens = prompt_tokens[:start + len(user_tokens)]
+        self.prefix_tokens[prefix] = tokens
+        key = self._key(prefix)
+        # rewind the context to the end of the prefix instead of evaluating it again; the cells of the finished
+        # prompt stay in the snapshot but are dropped by the next evaluation after a restore
+        self.llm.n_tokens = len(tokens)
+        state = self.llm.save_state()
+        self.stats['created'] += 1
+        self._remember(key, state)
+        if self.state_dir:
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self._path(key))
+                self.evict(keep=self._path(key))
+            except Exception as e:
+                print(f"Error saving KV state: {str(e)}")
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """
+        Delete least recently used state files until they fit the size limit, never the file keep
+        :return: number of deleted files
+        """
+        if self.max_bytes is None or not self.state_dir:
+            return 0
+        files = []
+        for entry in os.scandir(self.state_dir):
+            if entry.name.endswith('.state'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # deleted by another replica meanwhile
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        excess = sum(size for _, size, _ in files) - self.max_bytes
+        evicted = 0
+        for _, size, path in sorted(files):
+            if excess <= 0:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            excess -= size
+        self.stats['evicted'] += evicted
+        return evicted
+
+
+def _stream_completion(llm, messages: List[dict], kwargs: dict, stream_options: dict) -> dict:
+    """Stream a chat completion into an incremental triple parser, generation ends at the first stop condition"""
+    chunks = llm.create_chat_completion(messages=messages, stream=True, **kwargs)
+
+    def texts():
+        try:
+            for chunk in chunks:
+                content = chunk['choices'][0]['delta'].get('content')
+                if content:
+                    yield content
+        finally:
+            chunks.close()
+
+    result = consume_stream(texts(), IncrementalTripleParser(**stream_options))
+    # every streamed chunk is one sampled token
+    completion_tokens = result['chunks']
+    return {'response': result['response'], 'timing': result['timing'], 'stop_reason': result['stop_reason'],
+            'prompt_tokens': max(0, llm.n_tokens - completion_tokens), 'completion_tokens': completion_tokens}
+
+
+def _relay_completion(llm, messages: List[dict], kwargs: dict, task_id: str, results) -> dict:
+    """Stream a chat completion to the end and put every generated piece on the result queue as
+    ('token', task id, text) ahead of the final result"""
+    pieces, finish_reason = [], None
+    for chunk in llm.create_chat_completion(messages=messages, stream=True, **kwargs):
+        choice = chunk['choices'][0]
+        content = choice['delta'].get('content')
+        if content:
+            pieces.append(content)
+            results.put(('token', task_id, content))
+        finish_reason = choice.get('finish_reason') or finish_reason
+    # every streamed chunk is one sampled token
+    return {'response': ''.join(pieces), 'finish_reason': finish_reason,
+            'prompt_tokens': max(0, llm.n_tokens - len(pieces)), 'completion_tokens': len(pieces)}
+
+
+def _worker(worker_id: int, llama_kwargs: dict, generation_kwargs: dict, state_dir: Optional[str],
+            state_max_size_mb: Optional[float], stream_options: Optional[dict], speculative: Optional[dict], tasks,
+            results) -> None:
+    """Hold one model replica and answer prompts from the shared task queue until a None sentinel arrives"""
+    try:
+        from llama_cpp import Llama
+        draft_model = make_draft_model(speculative, llama_kwargs)
+        llm = Llama(**llama_kwargs, draft_model=draft_model) if draft_model else Llama(**llama_kwargs)
+    except Exception as e:
+        results.put(('init_error', worker_id, str(e)))
+        return
+    prefix_states = PrefixStateCache(llm, llama_kwargs, state_dir, max_size_mb=state_max_size_mb)
+    # grammars arrive as GBNF text, compiled once per replica
+    grammars = {}
+    results.put(('ready', worker_id, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, prompt, prefix, grammar, overrides, relay = task
+        start_time = time.time()
+        try:
+            kwargs = {**generation_kwargs, **(overrides or {})}
+            if grammar:
+                if grammar not in grammars:
+                    from llama_cpp import LlamaGrammar
+                    grammars[grammar] = LlamaGrammar.from_string(grammar, verbose=False)
+                kwargs['grammar'] = grammars[grammar]
+            prefix_states.restore(prefix)
+            # a prompt is the user message, or a full message list when relayed by llama_server
+            messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+            if relay:
+                result = _relay_completion(llm, messages, kwargs, task_id, results)
+            elif stream_options is not None:
+                result = _stream_completion(llm, messages, kwargs, stream_options)
+            else:
+                response = llm.create_chat_completion(messages=messages, **kwargs)
+                usage = response.get('usage') or {}
+                result = {'response': response['choices'][0]['message']['content'],
+                          'prompt_tokens': usage.get('prompt_tokens', 0),
+                          'completion_tokens': usage.get('completion_tokens', 0)}
+            if prefix is not None and prefix not in prefix_states.prefix_tokens:
+                prefix_states.learn(prefix, list(llm.input_ids[:result['prompt_tokens']]))
+            result.update({'seconds': time.time() - start_time, 'worker': worker_id,
+                           'prefix_states': dict(prefix_states.stats),
+                           'speculative': draft_model.stats if draft_model else None})
+            results.put(('done', task_id, result))
+        except Exception as e:
+            results.put(('error', task_id, str(e)))
+
+
+class LlamaPool:
+    """
+    Worker processes that each hold a llama.cpp model replica and take prompts from one shared queue, so
+    several sequences decode at the same time. Results come back in completion order together with
+    aggregate throughput statistics. With stream_options (IncrementalTripleParser arguments), generation is
+    streamed, stops early once the answer is complete and results carry its timing. With speculative
+    (see speculative.make_draft_model), every replica drafts tokens that the model verifies in one batch.
+    """
+
+    def __init__(self, llama_kwargs: dict, generation_kwargs: dict, replicas: int = 1,
+                 state_dir: Optional[str] = None, stream_options: Optional[dict] = None,
+                 speculative: Optional[dict] = None, state_max_size_mb: Optional[float] = DEFAULT_STATE_MAX_SIZE_MB):
+        self.llama_kwargs = llama_kwargs
+        self.generation_kwargs = generation_kwargs
+        self.replicas = replicas
+        self.state_dir = state_dir
+        self.state_max_size_mb = state_max_size_mb
+        self.stream_options = stream_options
+        self.speculative = speculative
+        # llama.cpp threads do not survive fork, every replica starts in a fresh interpreter
+        self.context = mp.get_context('spawn')
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.workers = []
+        self.stats = {'prompts': 0, 'failed': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'busy_seconds': 0.0,
+                      'stopped_early': 0}
+        # latest prefix state and draft acceptance counters reported by each worker
+        self.prefix_stats = {}
+        self.draft_stats = {}
+        # tags the tasks of each imap call, results of an earlier call left in the queue are told apart by it
+        self.generation = 0
+
+    def start(self) -> None:
+        """Start the workers and wait until every replica has loaded the model"""
+        for worker_id in range(self.replicas):
+            process = self.context.Process(target=_worker, daemon=True,
+                                           args=(worker_id, self.llama_kwargs, self.generation_kwargs,
+                                                 self.state_dir, self.state_max_size_mb, self.stream_options,
+                                                 self.speculative, self.tasks, self.results))
+            process.start()
+            self.workers.append(process)
+        for _ in range(self.replicas):
+            status, worker_id, error = self.get_result()
+            if status == 'init_error':
+                self.close()
+                raise RuntimeError(f"Replica {worker_id} failed to load the model: {error}")
+        print(f"Started {self.replicas} model replica(s) with {self.llama_kwargs.get('n_threads')} threads each")
+
+    def submit(self, task_id: str, prompt: str, prefix: Optional[str] = None, grammar: Optional[str] = None,
+               overrides: Optional[dict] = None, relay_tokens: bool = False) -> None:
+        """
+        Queue one prompt, overrides replace generation arguments for it; collect it with get_result.
+        With relay_tokens, get_result also returns a ('token', task id, text) for every generated piece before
+        the result; the completion then runs to its end without the early stop of stream_options.
+        """
+        if not (prefix and isinstance(prompt, str) and prompt.startswith(prefix)):
+            prefix = None
+        self.tasks.put((task_id, prompt, prefix, grammar, overrides, relay_tokens))
+
+    def get_result(self) -> tuple:
+        """Next (status, task id, result or error) from any replica, raises if a replica died"""
+        while True:
+            try:
+                return self.results.get(timeout=5)
+            except queue.Empty:
+                dead = [process.pid for process in self.workers if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Model worker(s) {dead} exited unexpectedly")
+
+    def imap(self,
+             prompts: List[Tuple[str, str]],
+             prefix: Optional[str] = None,
+             grammar: Optional[str] = None,
+             overrides: Optional[Dict[str, dict]] = None) -> Iterator[Tuple[str, Optional[dict]]]:
+        """
+        Answer (task id, prompt) pairs, yields (task id, result) as they complete; result is None on failure.
+        Prompts starting with prefix reuse its KV state, a GBNF grammar constrains decoding, overrides maps task
+        ids to generation arguments of their own. Throughput of the run is printed at the end.
+        """
+        self.generation += 1
+        generation = self.generation
+        for task_id, prompt in prompts:
+            self.submit((generation, task_id), prompt, prefix, grammar, (overrides or {}).get(task_id))
+        start_time = time.time()
+        completion_tokens = 0
+        done = 0
+        while done < len(prompts):
+            status, tag, result = self.get_result()
+            if not (isinstance(tag, tuple) and tag[0] == generation):
+                # left over from an imap call whose consumer stopped before all its results arrived
+                continue
+            task_id = tag[1]
+            done += 1
+            if status != 'done':
+                self.stats['failed'] += 1
+                print(f"Error generating response for {task_id}: {result}")
+                yield task_id, None
+                continue
+            self.stats['prompts'] += 1
+            self.stats['prompt_tokens'] += result['prompt_tokens']
+            self.stats['completion_tokens'] += result['completion_tokens']
+            self.stats['busy_seconds'] += result['seconds']
+            if result.get('stop_reason'):
+                self.stats['stopped_early'] += 1
+            completion_tokens += result['completion_tokens']
+            self.prefix_stats[result['worker']] = result['prefix_states']
+            if result.get('speculative'):
+                self.draft_stats[result['worker']] = result['speculative']
+            elapsed = time.time() - start_time
+            timing = result.get('timing')
+            first_token = f", first token after {timing['ttft']}s" if timing and timing['ttft'] is not None else ''
+            print(f"[{done}/{len(prompts)}] {task_id} generated in {result['seconds']:.2f} seconds by replica "
+                  f"{result['worker']}{first_token}, aggregate {completion_tokens / elapsed:.1f} tokens/s")
+            yield task_id, result
+        if prompts:
+            elapsed = time.time() - start_time
+            print(f"Generated {completion_tokens} tokens for {len(prompts)} prompts in {elapsed:.2f} seconds "
+                  f"({completion_tokens / elapsed:.1f} tokens/s with {self.replicas} replica(s))")
+            if prefix:
+                totals = {}
+                for worker_stats in self.prefix_stats.values():
+                    for name, value in worker_stats.items():
+                        totals[name] = totals.get(name, 0) + value
+                print(f"Prefix KV states: {totals}")
+            if self.draft_stats:
+                proposed = sum(stats['proposed'] for stats in self.draft_stats.values())
+                accepted = sum(stats['accepted'] for stats in self.draft_stats.values())
+                print(f"Speculative decoding: {accepted} of {proposed} drafted tokens accepted "
+                      f"({100 * accepted / max(proposed, 1):.1f}%)")
+
+    def close(self) -> None:
+        for _ in self.workers:
+            self.tasks.put(None)
+        for process in self.workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
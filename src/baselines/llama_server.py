@@ -0,0 +1,351 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from llama_pool import DEFAULT_REPLICA_OVERHEAD_MB, LlamaPool, plan_replicas
+from model_files import (DEFAULT_MODELS_DIR, DRAFT_MODEL_NAME, DRAFT_MODEL_REPO, MODEL_NAME, MODEL_REPO,
+                         download_model, llama_kwargs)
+from speculative import SPECULATIVE_MODES
+
+# request fields passed on to llama.cpp, anything else in the request is ignored
+GENERATION_FIELDS = ('temperature', 'top_p', 'max_tokens', 'stop', 'seed', 'frequency_penalty', 'presence_penalty')
+
+
+class ServerState:
+    """
+    The model pool behind the server. Handler threads submit prompts to the pool's queue and wait for their
+    result, which a dispatcher thread hands over from the pool's result queue together with the generated
+    tokens of streaming requests. Prompts beyond max_queue waiting or running requests are rejected with 429
+    so clients back off instead of timing out.
+    """
+
+    def __init__(self, pool: LlamaPool, model_name: str, max_queue: int, request_timeout: float):
+        self.pool = pool
+        self.model_name = model_name
+        self.max_queue = max_queue
+        self.request_timeout = request_timeout
+        self.status = 'loading'
+        self.error = None
+        self.lock = threading.Lock()
+        # task id -> [event, (status, result), queue of generated tokens then None for streaming requests]
+        self.pending = {}
+        self.started = time.time()
+        self.metrics = {'requests_total': 0, 'completed_total': 0, 'failed_total': 0, 'rejected_total': 0,
+                        'prompt_tokens_total': 0, 'completion_tokens_total': 0, 'request_seconds_total': 0.0,
+                        'generation_seconds_total': 0.0}
+
+    def load(self) -> None:
+        """Start the replicas and the dispatcher, the server answers health checks meanwhile"""
+        try:
+            self.pool.start()
+        except Exception as e:
+            self.status, self.error = 'error', str(e)
+            print(f"Error initializing model: {str(e)}")
+            return
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        self.status = 'ok'
+        print(f"Serving {self.model_name}")
+
+    def _dispatch(self) -> None:
+        while True:
+            try:
+                status, task_id, result = self.pool.get_result()
+            except RuntimeError as e:
+                self.status, self.error = 'error', str(e)
+                with self.lock:
+                    for slot in self.pending.values():
+                        self._finish(slot, ('error', str(e)))
+                return
+            with self.lock:
+                slot = self.pending.get(task_id)
+            if slot is None:
+                continue
+            if status == 'token':
+                if slot[2] is not None:
+                    slot[2].put(result)
+            else:
+                self._finish(slot, (status, result))
+
+    @staticmethod
+    def _finish(slot: list, outcome: tuple) -> None:
+        slot[1] = outcome
+        slot[0].set()
+        if slot[2] is not None:
+            slot[2].put(None)
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.metrics[name] += value
+
+    def generate(self, prompt, overrides: dict, on_token: Optional[Callable[[str], None]] = None) -> Optional[tuple]:
+        """
+        Queue a prompt and wait for it, on_token is called with every generated piece as it arrives
+        :return: (status, result or error), None if the queue is full
+        """
+        task_id = uuid.uuid4().hex
+        slot = [threading.Event(), None, queue.Queue() if on_token else None]
+        with self.lock:
+            if len(self.pending) >= self.max_queue:
+                self.metrics['rejected_total'] += 1
+                return None
+            self.pending[task_id] = slot
+        try:
+            self.pool.submit(task_id, prompt, overrides=overrides, relay_tokens=on_token is not None)
+            timeout = f"No result within {self.request_timeout} seconds"
+            if on_token is None:
+                return slot[1] if slot[0].wait(self.request_timeout) else ('timeout', timeout)
+            deadline = time.time() + self.request_timeout
+            while True:
+                try:
+                    token = slot[2].get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    return 'timeout', timeout
+                if token is None:
+                    return slot[1]
+                on_token(token)
+        finally:
+            with self.lock:
+                del self.pending[task_id]
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = dict(self.metrics)
+            in_flight = len(self.pending)
+        lines = []
+        for name, value in metrics.items():
+            lines += [f"# TYPE llama_server_{name} counter", f"llama_server_{name} {value}"]
+        gauges = {'in_flight_requests': in_flight, 'max_queue': self.max_queue, 'replicas': self.pool.replicas,
+                  'up': int(self.status == 'ok'), 'uptime_seconds': round(time.time() - self.started, 1)}
+        for name, value in gauges.items():
+            lines += [f"# TYPE llama_server_{name} gauge", f"llama_server_{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+
+def completion_body(model: str, content: str, prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens}
+    }
+
+
+class ServerHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible /v1/chat/completions and /v1/models, plus /health and /metrics"""
+    state: ServerState = None
+    verbose = False
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status: int, data: bytes, content_type: str, headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status: int, body: dict, headers: dict = None) -> None:
+        self.send_body(status, json.dumps(body).encode('utf-8'), 'application/json', headers)
+
+    def send_error_json(self, status: int, message: str, error_type: str, headers: dict = None) -> None:
+        self.send_json(status, {'error': {'message': message, 'type': error_type, 'code': None}}, headers)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/health':
+            body = {'status': self.state.status, 'model': self.state.model_name, 'replicas': self.state.pool.replicas,
+                    'in_flight': len(self.state.pending)}
+            if self.state.error:
+                body['error'] = self.state.error
+            self.send_json(200 if self.state.status == 'ok' else 503, body)
+        elif path == '/metrics':
+            self.send_body(200, self.state.prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+        elif path == '/v1/models':
+            self.send_json(200, {'object': 'list', 'data': [{'id': self.state.model_name, 'object': 'model',
+                                                             'created': int(self.state.started),
+                                                             'owned_by': 'local'}]})
+        else:
+            self.send_error_json(404, f"Unknown path {path}", 'invalid_request_error')
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path != '/v1/chat/completions':
+            self.send_error_json(404, f"Unknown path {path}", 'invalid_request_error')
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            messages = request['messages']
+        except (ValueError, KeyError) as e:
+            self.send_error_json(400, f"Invalid request: {str(e)}", 'invalid_request_error')
+            return
+        if self.state.status != 'ok':
+            self.send_error_json(503, f"Model is {self.state.status}", 'server_error', {'retry-after': '10'})
+            return
+
+        self.state.count('requests_total')
+        overrides = {name: request[name] for name in GENERATION_FIELDS if request.get(name) is not None}
+        if request.get('max_completion_tokens') is not None:
+            overrides['max_tokens'] = request['max_completion_tokens']
+        # a lone user message goes through the same path as the runners' prompts, so outputs match theirs
+        prompt = messages[0]['content'] if len(messages) == 1 and messages[0].get('role') == 'user' else messages
+
+        start_time = time.time()
+        if request.get('stream'):
+            self.send_stream(prompt, overrides, bool((request.get('stream_options') or {}).get('include_usage')),
+                             start_time)
+            return
+        outcome = self.state.generate(prompt, overrides)
+        if outcome is None:
+            self.send_queue_full()
+            return
+        status, result = outcome
+        if status != 'done':
+            self.state.count('failed_total')
+            self.send_error_json(504 if status == 'timeout' else 500, str(result), 'server_error')
+            return
+        self.count_completed(result, start_time)
+        self.send_json(200, completion_body(self.state.model_name, result['response'], result['prompt_tokens'],
+                                            result['completion_tokens']))
+
+    def send_queue_full(self) -> None:
+        self.send_error_json(429, f"Request queue is full ({self.state.max_queue} requests)", 'rate_limit_error',
+                             {'retry-after': '1'})
+
+    def count_completed(self, result: dict, start_time: float) -> None:
+        self.state.count('completed_total')
+        self.state.count('prompt_tokens_total', result['prompt_tokens'])
+        self.state.count('completion_tokens_total', result['completion_tokens'])
+        self.state.count('generation_seconds_total', result['seconds'])
+        self.state.count('request_seconds_total', time.time() - start_time)
+
+    def send_stream(self, prompt, overrides: dict, include_usage: bool, start_time: float) -> None:
+        """
+        Answer a stream=True request with server-sent events, one chunk per generated token as the replica
+        samples it. The headers go out with the first token, so a request that fails before it still gets an
+        error status; a failure after it ends the stream with an error event.
+        """
+        base = {'id': f"chatcmpl-{uuid.uuid4().hex[:24]}", 'object': 'chat.completion.chunk',
+                'created': int(time.time()), 'model': self.state.model_name}
+        started = []
+
+        def send_event(chunk: dict) -> None:
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+
+        def on_token(text: str) -> None:
+            delta = {'content': text}
+            if not started:
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                started.append(True)
+                delta = {'role': 'assistant', 'content': text}
+            send_event({**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+
+        try:
+            outcome = self.state.generate(prompt, overrides, on_token)
+            if outcome is None:
+                self.send_queue_full()
+                return
+            status, result = outcome
+            if status != 'done':
+                self.state.count('failed_total')
+                if started:
+                    send_event({'error': {'message': str(result), 'type': 'server_error', 'code': None}})
+                else:
+                    self.send_error_json(504 if status == 'timeout' else 500, str(result), 'server_error')
+                return
+            self.count_completed(result, start_time)
+            if not started:
+                # an empty completion still opens the stream with the assistant role
+                on_token('')
+            send_event({**base, 'choices': [{'index': 0, 'delta': {},
+                                             'finish_reason': result.get('finish_reason') or 'stop'}]})
+            if include_usage:
+                usage = {'prompt_tokens': result['prompt_tokens'], 'completion_tokens': result['completion_tokens'],
+                         'total_tokens': result['prompt_tokens'] + result['completion_tokens']}
+                send_event({**base, 'choices': [], 'usage': usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except OSError as e:
+            # the client went away mid-stream, the replica finishes the completion unread
+            self.state.count('failed_total')
+            if self.verbose:
+                print(f"Stream closed by the client: {str(e)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a llama.cpp model through an OpenAI-compatible API, '
+                                                 'so several runs share one loaded model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model_path', default=None, help=f'GGUF model, {MODEL_NAME} is downloaded if not given')
+    parser.add_argument('--models_dir', default=DEFAULT_MODELS_DIR,
+                        help='Where GGUF models are kept and downloaded to, also set by TEXT2KG_MODELS_DIR')
+    parser.add_argument('--model_name', default=None, help='Model id reported to clients, the file name by default')
+    parser.add_argument('--n_ctx', type=int, default=2048)
+    parser.add_argument('--max_tokens', type=int, default=250, help='Generated tokens when a request sets none')
+    parser.add_argument('--replicas', default='1',
+                        help='Model replicas decoding in parallel, "auto" sizes them to free memory and cores')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='CPU threads shared by all replicas')
+    parser.add_argument('--n_gpu_layers', type=int, default=-1,
+                        help='Layers offloaded to the GPU, 0 for CPU-only; every replica offloads its own copy')
+    parser.add_argument('--replica_overhead_mb', type=float, default=DEFAULT_REPLICA_OVERHEAD_MB,
+                        help='Memory per replica besides the shared weights, used by --replicas auto')
+    parser.add_argument('--speculative', choices=SPECULATIVE_MODES, default=None,
+                        help='Draft tokens from n-grams of the prompt or with a small model of the same family')
+    parser.add_argument('--draft_model_path', default=None,
+                        help=f'GGUF draft model for --speculative draft_model, {DRAFT_MODEL_NAME} is downloaded '
+                             f'if not given')
+    parser.add_argument('--num_draft_tokens', type=int, default=None, help='Tokens drafted per step')
+    parser.add_argument('--max_queue', type=int, default=64,
+                        help='Waiting and running requests before new ones are answered with 429')
+    parser.add_argument('--request_timeout', type=float, default=600.0,
+                        help='Seconds a request waits for its result before failing with 504')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    model_path = args.model_path or download_model(MODEL_REPO, MODEL_NAME, args.models_dir)
+    if not model_path:
+        raise SystemExit(1)
+    speculative = None
+    if args.speculative:
+        speculative = {'mode': args.speculative, 'num_pred_tokens': args.num_draft_tokens}
+        if args.speculative == 'draft_model':
+            speculative['model_path'] = args.draft_model_path or download_model(DRAFT_MODEL_REPO, DRAFT_MODEL_NAME,
+                                                                                args.models_dir)
+            if not speculative['model_path']:
+                raise SystemExit(1)
+
+    replicas, n_threads = plan_replicas(model_path, None if args.replicas == 'auto' else int(args.replicas),
+                                        args.threads, args.replica_overhead_mb)
+    pool = LlamaPool(llama_kwargs(model_path, n_threads, args.n_gpu_layers, args.n_ctx),
+                     {'temperature': 0, 'max_tokens': args.max_tokens}, replicas, speculative=speculative)
+    ServerHandler.state = ServerState(pool, args.model_name or os.path.basename(model_path), args.max_queue,
+                                      args.request_timeout)
+    ServerHandler.verbose = args.verbose
+    server = ThreadingHTTPServer((args.host, args.port), ServerHandler)
+    # the port answers health checks while the model loads
+    threading.Thread(target=ServerHandler.state.load, daemon=True).start()
+    print(f"Listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
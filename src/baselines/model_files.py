@@ -0,0 +1,57 @@
+import os
+from typing import Optional
+
+MODEL_NAME = "qwen2.5-32b-instruct-q4_k_m.gguf"
+MODEL_REPO = "TheRains/Qwen2.5-32B-Instruct-Q4_K_M-GGUF"
+# same tokenizer as the 32B model, used for speculative decoding
+DRAFT_MODEL_NAME = "qwen2.5-0.5b-instruct-q8_0.gguf"
+DRAFT_MODEL_REPO = "Qwen/Qwen2.5-0.5B-Instruct-GGUF"
+DEFAULT_MODELS_DIR = os.environ.get(
+    "TEXT2KG_MODELS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "text2kgbench", "models"))
+
+
+def download_model(repo_id: str = MODEL_REPO,
+                   model_name: str = MODEL_NAME,
+                   models_dir: str = DEFAULT_MODELS_DIR) -> Optional[str]:
+    """
+    Downloads the model from Hugging Face Hub if not already present.
+    :param repo_id: Hugging Face repository of the GGUF file
+    :param model_name: GGUF file name
+    :param models_dir: local model directory, TEXT2KG_MODELS_DIR by default
+    :return: the path to the model or None if the download fails
+    """
+    model_path = os.path.join(models_dir, model_name)
+    os.makedirs(models_dir, exist_ok=True)
+
+    if os.path.exists(model_path):
+        print(f"Model already exists at {model_path}")
+        return model_path
+
+    print("Downloading model... This may take a while.")
+    try:
+        # only needed for the download, a local model works without huggingface_hub
+        from huggingface_hub import hf_hub_download
+        model_path = hf_hub_download(
+            repo_id=repo_id,
+            filename=model_name,
+            local_dir=models_dir,
+            local_dir_use_symlinks=False
+        )
+        print(f"Model downloaded successfully to {model_path}")
+        return model_path
+    except Exception as e:
+        print(f"Error downloading model: {str(e)}")
+        return None
+
+
+def llama_kwargs(model_path: str, n_threads: int, n_gpu_layers: int, n_ctx: int = 2048) -> dict:
+    """Arguments of the Llama constructor for one model replica"""
+    return dict(
+        model_path=model_path,
+        n_gpu_layers=n_gpu_layers,  # -1 offloads all layers, e.g. to an RTX 3090
+        n_ctx=n_ctx,
+        n_threads=n_threads,
+        offload_kqv=True,           # Beneficial for large models
+        use_mlock=True,
+        verbose=False
+    )
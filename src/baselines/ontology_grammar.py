@@ -0,0 +1,57 @@
+import hashlib
+from typing import List
+
+# an empty answer is allowed for sentences without triples. Unquoted subjects end at the first comma because
+# parse_triples splits the arguments there, a subject with a comma or parentheses is written in double quotes as
+# the parser accepts it; objects may contain commas and one level of parentheses, e.g. "Georgia (U.S. state)"
+GRAMMAR_TEMPLATE = '''root ::= (triple ("\\n" triple)*)?
+triple ::= relation "(" subject ", " object ")"
+relation ::= {relations}
+subject ::= quoted | [^,()"\\n] [^,()\\n]*
+object ::= quoted | object-part+
+object-part ::= [^()"\\n] [^()\\n]* | "(" [^()\\n]* ")"
+quoted ::= "\\"" [^"\\n]+ "\\""
+'''
+# packed prompts are answered in numbered blocks, "[1]" on a line of its own followed by its triples
+PACKED_ROOT = '''root ::= block ("\\n" block)*
+block ::= "[" [1-9] [0-9]* "]" ("\\n" triple)*
+'''
+
+
+def relation_labels(ontology: dict) -> List[str]:
+    """Relation labels of the ontology with spaces replaced by underscores, as the evaluation expects them"""
+    labels = []
+    for relation in ontology.get('relations', []):
+        label = relation.get('label', '').strip().replace(" ", "_")
+        if label and label not in labels:
+            labels.append(label)
+    return labels
+
+
+def gbnf_literal(text: str) -> str:
+    """Quote a string as a GBNF literal"""
+    escaped = text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{escaped}"'
+
+
+def build_grammar(ontology: dict, packed: bool = False) -> str:
+    """
+    GBNF grammar that only admits lines of relation(subject, object) with relation labels from the ontology,
+    or no line at all. Generation ends with the end-of-sequence token once a line is complete.
+    :param ontology: ontology JSON with a "relations" list
+    :param packed: admit the numbered blocks of a packed prompt's answer instead
+    :return: the grammar text
+    """
+    labels = relation_labels(ontology)
+    if not labels:
+        raise ValueError("The ontology has no relation labels")
+    alternatives = ' | '.join(gbnf_literal(label) for label in labels)
+    grammar = GRAMMAR_TEMPLATE.format(relations=alternatives)
+    if packed:
+        grammar = PACKED_ROOT + grammar.split('\n', 1)[1]
+    return grammar
+
+
+def grammar_hash(grammar: str) -> str:
+    """Short identifier of a grammar, part of the response cache key"""
+    return hashlib.sha1(grammar.encode('utf-8')).hexdigest()[:16]
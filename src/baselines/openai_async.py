@@ -0,0 +1,232 @@
+import asyncio
+import email.utils
+import random
+import time
+from typing import Callable, List, Optional
+
+import openai
+
+from common.prompt_jobs import estimate_tokens
+from streaming import IncrementalTripleParser, consume_async_stream
+
+# status codes that are worth another attempt, everything else fails the prompt immediately
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Refills continuously at rate_per_minute up to capacity; acquire waits until the amount is available.
+    An amount larger than the capacity is granted once the bucket is full, so a single oversized request
+    cannot block forever."""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # created in the event loop that first waits on it, a lock is bound to one loop
+        self.lock: Optional[asyncio.Lock] = None
+        self.loop = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float) -> None:
+        # the lock keeps waiters in arrival order, so large requests are not starved by small ones
+        loop = asyncio.get_running_loop()
+        if self.lock is None or self.loop is not loop:
+            self.lock, self.loop = asyncio.Lock(), loop
+        async with self.lock:
+            while True:
+                self._refill()
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Return (positive) or charge (negative) tokens once the real cost of a request is known"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def request_tokens(prompt: str, max_tokens: int) -> int:
+    """Upper bound of the tokens a request counts against the TPM limit"""
+    return estimate_tokens(prompt) + max_tokens
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Delay requested by the server through retry-after-ms or retry-after (seconds or an HTTP date)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the delay the server asked for"""
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRY_STATUS
+
+
+class AsyncChatRunner:
+    """Send chat completion requests concurrently while staying under requests/min and tokens/min limits.
+
+    At most max_concurrency requests are in flight. Every request first takes one unit from the RPM bucket
+    and its estimated token cost from the TPM bucket; the estimate is corrected with the reported usage once
+    the response arrives. Requests failing with 408/409/429/5xx or a connection error are retried with
+    jittered exponential backoff that honours retry-after headers.
+
+    With stream=True, completions are streamed into an incremental triple parser and the request is closed as
+    soon as one of the stop conditions holds (see streaming.IncrementalTripleParser); results then carry the
+    time to first token and to the last triple.
+    """
+
+    def __init__(self,
+                 client: 'openai.AsyncOpenAI',
+                 model: str,
+                 max_concurrency: int = 8,
+                 rpm: Optional[float] = None,
+                 tpm: Optional[float] = None,
+                 max_retries: int = 6,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 request_params: Optional[dict] = None,
+                 stream: bool = False,
+                 stop_on: tuple = (),
+                 max_triples: Optional[int] = None):
+        self.client = client
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.rpm_bucket = TokenBucket(rpm) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_params = {'max_tokens': 250, 'temperature': 0, **(request_params or {})}
+        self.stream = stream
+        self.stop_on = stop_on
+        self.max_triples = max_triples
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failed': 0, 'stopped_early': 0}
+
+    async def _throttle(self, cost: int) -> None:
+        if self.rpm_bucket:
+            await self.rpm_bucket.acquire(1)
+        if self.tpm_bucket:
+            await self.tpm_bucket.acquire(cost)
+
+    async def _stream(self, prompt: str, request_params: dict) -> dict:
+        stream = await self.client.chat.completions.create(
+            model=self.model, messages=[{"role": "user", "content": prompt}], stream=True,
+            stream_options={'include_usage': True}, **request_params)
+        usage, finish_reason = {}, []
+
+        async def texts():
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, 'usage', None) is not None:
+                        usage.update(chunk.usage.model_dump())
+                    if chunk.choices and chunk.choices[0].finish_reason:
+                        finish_reason.append(chunk.choices[0].finish_reason)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                # closing the response before the end cancels the rest of the generation
+                await stream.close()
+
+        result = await consume_async_stream(texts(), IncrementalTripleParser(self.stop_on, self.max_triples))
+        if not result['stop_reason'] and not finish_reason:
+            # the connection closed mid-answer, retried like any connection error instead of keeping a truncation
+            raise openai.APIConnectionError(message='Stream ended before the completion finished',
+                                            request=stream.response.request)
+        if result['stop_reason']:
+            self.stats['stopped_early'] += 1
+        # an early stop ends the stream before the usage chunk
+        result['usage'] = usage or None
+        return result
+
+    async def complete(self, prompt: str, overrides: Optional[dict] = None) -> dict:
+        """Send one prompt with retries, returns the response text, token usage and latency (and timing when
+        streaming). overrides replace request parameters for this prompt, e.g. a larger max_tokens."""
+        request_params = {**self.request_params, **(overrides or {})}
+        cost = request_tokens(prompt, request_params['max_tokens'])
+        for attempt in range(self.max_retries + 1):
+            await self._throttle(cost)
+            self.stats['requests'] += 1
+            start_time = time.time()
+            try:
+                if self.stream:
+                    result = await self._stream(prompt, request_params)
+                else:
+                    response = await self.client.chat.completions.create(
+                        model=self.model, messages=[{"role": "user", "content": prompt}], **request_params)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                if getattr(e, 'status_code', None) == 429:
+                    self.stats['rate_limited'] += 1
+                self.stats['retries'] += 1
+                await asyncio.sleep(backoff_delay(attempt, self.base_delay, self.max_delay, retry_after_seconds(e)))
+                continue
+            if self.stream:
+                if self.tpm_bucket and result['usage']:
+                    self.tpm_bucket.adjust(cost - result['usage']['total_tokens'])
+                result['latency'] = round(time.time() - start_time, 3)
+                return result
+            usage = getattr(response, 'usage', None)
+            if self.tpm_bucket and usage is not None:
+                self.tpm_bucket.adjust(cost - usage.total_tokens)
+            return {'response': response.choices[0].message.content,
+                    'usage': usage.model_dump() if usage is not None else None,
+                    'latency': round(time.time() - start_time, 3)}
+
+    async def run(self,
+                  prompts: List[dict],
+                  on_result: Optional[Callable[[dict, dict], None]] = None) -> List[Optional[dict]]:
+        """Complete {'id', 'prompt'} items, results are returned in input order with None for failures. An item's
+        'max_tokens' replaces the runner's. on_result(prompt_data, result) is called as each prompt finishes, a prompt
+        whose callback raises counts as failed."""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def worker(prompt_data: dict) -> Optional[dict]:
+            async with semaphore:
+                try:
+                    overrides = {'max_tokens': prompt_data['max_tokens']} if prompt_data.get('max_tokens') else None
+                    result = await self.complete(prompt_data['prompt'], overrides)
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    print(f"Error processing prompt {prompt_data['id']}: {str(e)}")
+                    return None
+            if on_result is not None:
+                try:
+                    on_result(prompt_data, result)
+                except Exception as e:
+                    # e.g. a full disk while saving, the other prompts carry on
+                    self.stats['failed'] += 1
+                    print(f"Error handling the response to prompt {prompt_data['id']}: {str(e)}")
+                    return None
+            return result
+
+        return await asyncio.gather(*(worker(prompt_data) for prompt_data in prompts))
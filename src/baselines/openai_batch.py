@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from openai import OpenAI
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+# provider limit on requests per batch input file
+MAX_BATCH_REQUESTS = 50000
+ID_SEPARATOR = '::'
+
+
+def custom_id(onto: str, prompt_id: str) -> str:
+    """Batch request id, ontology and prompt id are recovered from it when results are mapped back"""
+    return f"{onto}{ID_SEPARATOR}{prompt_id}"
+
+
+def build_batch_requests(prompts_by_onto: Dict[str, List[dict]], model: str, request_params: dict) -> List[dict]:
+    """One batch input line per prompt of every ontology, a prompt's 'max_tokens' replaces the request's"""
+    requests = []
+    for onto, prompts in prompts_by_onto.items():
+        for prompt_data in prompts:
+            if not prompt_data.get('id') or not prompt_data.get('prompt'):
+                continue
+            requests.append({
+                'custom_id': custom_id(onto, prompt_data['id']),
+                'method': 'POST',
+                'url': BATCH_ENDPOINT,
+                'body': {'model': model, 'messages': [{"role": "user", "content": prompt_data['prompt']}],
+                         **request_params, **({'max_tokens': prompt_data['max_tokens']}
+                                              if prompt_data.get('max_tokens') else {})}
+            })
+    return requests
+
+
+def batch_input(requests: List[dict]) -> bytes:
+    return ''.join(json.dumps(request, ensure_ascii=False) + '\n' for request in requests).encode('utf-8')
+
+
+def submit_batch(client: OpenAI, requests: List[dict], metadata: Optional[dict] = None):
+    """Upload the requests as a batch input file and create the batch job"""
+    content = batch_input(requests)
+    input_file = client.files.create(file=('batch_input.jsonl', content), purpose='batch')
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window='24h',
+                                  metadata=metadata)
+    print(f"Submitted batch {batch.id} with {len(requests)} requests")
+    return batch
+
+
+def wait_for_batch(client: OpenAI,
+                   batch_id: str,
+                   poll_interval: float = 30.0,
+                   max_poll_interval: float = 600.0,
+                   timeout: Optional[float] = None):
+    """Poll until the batch reaches a terminal status, the interval grows by half after every poll"""
+    start_time = time.time()
+    interval = poll_interval
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        progress = f", {counts.completed + counts.failed}/{counts.total} done" if counts else ''
+        print(f"Batch {batch_id}: {batch.status}{progress}")
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        if timeout is not None and time.time() - start_time + interval > timeout:
+            raise TimeoutError(f"Batch {batch_id} did not finish within {timeout} seconds")
+        time.sleep(interval)
+        interval = min(max_poll_interval, interval * 1.5)
+
+
+def read_result_file(client: OpenAI, file_id: Optional[str]) -> List[dict]:
+    if not file_id:
+        return []
+    text = client.files.content(file_id).text
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def collect_results(client: OpenAI, batch) -> Dict[str, Optional[str]]:
+    """Map custom ids to the completion text; failed requests map to None"""
+    results = {}
+    for line in read_result_file(client, batch.output_file_id) + read_result_file(client, batch.error_file_id):
+        response = line.get('response') or {}
+        if line.get('error') or response.get('status_code') != 200:
+            print(f"Batch request {line.get('custom_id')} failed: {line.get('error') or response.get('body')}")
+            results.setdefault(line['custom_id'], None)
+            continue
+        results[line['custom_id']] = response['body']['choices'][0]['message']['content']
+    return results
+
+
+def requests_hash(requests: List[dict]) -> str:
+    return hashlib.sha1(batch_input(requests)).hexdigest()
+
+
+def load_batch_state(state_file: str) -> dict:
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_batch_state(state_file: str, state: dict) -> None:
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, state_file)
+
+
+def run_batches(client: OpenAI,
+                requests: List[dict],
+                state_file: str,
+                poll_interval: float = 30.0,
+                max_batch_requests: int = MAX_BATCH_REQUESTS) -> Dict[str, Optional[str]]:
+    """Submit the requests in batches of at most max_batch_requests and wait for all of them.
+    Submitted batch ids are recorded in state_file keyed by the hash of their input, so an interrupted run
+    resumes polling the same jobs instead of paying for them twice. The caller removes state_file once the
+    results are saved."""
+    state = load_batch_state(state_file)
+    batch_ids = []
+    for start in range(0, len(requests), max_batch_requests):
+        chunk = requests[start:start + max_batch_requests]
+        key = requests_hash(chunk)
+        if key in state:
+            print(f"Resuming batch {state[key]}")
+        else:
+            state[key] = submit_batch(client, chunk, metadata={'input_sha1': key}).id
+            save_batch_state(state_file, state)
+        batch_ids.append((key, state[key]))
+
+    results = {}
+    for key, batch_id in batch_ids:
+        batch = wait_for_batch(client, batch_id, poll_interval)
+        if batch.status != 'completed':
+            print(f"Batch {batch_id} ended with status {batch.status}: {batch.errors}")
+            # a rerun submits the requests of failed, expired or cancelled jobs again
+            del state[key]
+            save_batch_state(state_file, state)
+        results.update(collect_results(client, batch))
+    return results
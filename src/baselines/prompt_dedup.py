@@ -0,0 +1,77 @@
+from typing import Dict, List, Optional, Tuple
+
+from common.prompt_jobs import estimate_tokens
+from common.response_cache import cache_key, prompt_hash
+
+
+class PromptDedup:
+    """
+    Plan the prompts of several jobs, one per (config, ontology), so that every distinct prompt reaches the
+    model once. Prompts are distinct by text and decoding parameters (e.g. an ontology's grammar), the same
+    identity as the response cache. A prompt is dispatched with the first job that needs it; its response is
+    fanned out to every (job, prompt id) target, including targets in jobs dispatched later.
+    """
+
+    def __init__(self, backend: str, model: str):
+        self.backend = backend
+        self.model = model
+        # key -> [(job, prompt id)], the first target owns the request
+        self.targets: Dict[str, List[Tuple[str, str]]] = {}
+        self.keys: Dict[Tuple[str, str], str] = {}
+        self.owned: Dict[str, List[dict]] = {}
+        self.prompt_tokens: Dict[str, int] = {}
+        self.stats = {'jobs': 0, 'prompts': 0, 'distinct': 0, 'saved_calls': 0, 'estimated_saved_prompt_tokens': 0,
+                      'saved_prompt_tokens': 0, 'saved_completion_tokens': 0}
+
+    def add(self, job: str, prompts: List[dict], params: dict) -> None:
+        """Register the {'id', 'prompt'} items a job still needs answered"""
+        self.stats['jobs'] += 1
+        owned = self.owned.setdefault(job, [])
+        for prompt_data in prompts:
+            key = cache_key(self.backend, self.model, params, prompt_hash(prompt_data['prompt']))
+            self.keys[(job, prompt_data['id'])] = key
+            self.stats['prompts'] += 1
+            if key in self.targets:
+                self.targets[key].append((job, prompt_data['id']))
+                self.stats['saved_calls'] += 1
+                self.stats['estimated_saved_prompt_tokens'] += self.prompt_tokens[key]
+                continue
+            self.targets[key] = [(job, prompt_data['id'])]
+            self.prompt_tokens[key] = estimate_tokens(prompt_data['prompt'])
+            self.stats['distinct'] += 1
+            owned.append(prompt_data)
+
+    def dispatch(self, job: str) -> List[dict]:
+        """The prompts to send for a job: those no earlier job sends"""
+        return self.owned.get(job, [])
+
+    def targets_of(self, job: str, prompt_id: str) -> List[Tuple[str, str]]:
+        """Every (job, prompt id) the dispatched prompt answers, itself first"""
+        return self.targets[self.keys[(job, prompt_id)]]
+
+    def fan_out(self, job: str, prompt_id: str, response_text: str, prompt_tokens: Optional[int] = None,
+                completion_tokens: Optional[int] = None) -> List[Tuple[str, str]]:
+        """
+        Every (job, prompt id) a response answers, the dispatched one first. The response's token counts are
+        added to the savings once per extra target, estimated from the texts when the backend reports none.
+        """
+        key = self.keys[(job, prompt_id)]
+        targets = self.targets_of(job, prompt_id)
+        duplicates = len(targets) - 1
+        if duplicates:
+            if prompt_tokens is None:
+                prompt_tokens = self.prompt_tokens[key]
+            if completion_tokens is None:
+                completion_tokens = estimate_tokens(response_text)
+            self.stats['saved_prompt_tokens'] += duplicates * prompt_tokens
+            self.stats['saved_completion_tokens'] += duplicates * completion_tokens
+        return targets
+
+    def plan_summary(self) -> str:
+        return (f"Deduplication: {self.stats['prompts']} prompts across {self.stats['jobs']} ontologies, "
+                f"{self.stats['distinct']} distinct; saves {self.stats['saved_calls']} model calls and about "
+                f"{self.stats['estimated_saved_prompt_tokens']} prompt tokens")
+
+    def summary(self) -> str:
+        return (f"Deduplication saved {self.stats['saved_calls']} model calls, {self.stats['saved_prompt_tokens']} "
+                f"prompt and {self.stats['saved_completion_tokens']} completion tokens")
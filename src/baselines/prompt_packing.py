@@ -0,0 +1,163 @@
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from common.triple_parser import parse_triples
+
+PACK_INSTRUCTION = ("The test sentences are numbered. Answer them in the given order, each under its number in "
+                    "brackets on a line of its own, e.g. [1], and leave the block of a sentence without triples "
+                    "empty.")
+# a slot marker line, optionally emphasised or followed by a colon: "[2]", "**[2]**", "[2]:"; a triple may
+# follow on the same line
+_SLOT_MARKER = re.compile(r'^[ \t]*(?:\*\*)?\[(\d+)\](?:\*\*)?:?[ \t]*(.*)$')
+_WORD = re.compile(r'\w{3,}')
+
+
+def slot_marker(slot: int) -> str:
+    """Marker of the 1-based slot number, in the prompt and expected in the answer"""
+    return f"[{slot}]"
+
+
+def plan_packs(items: List[Tuple[str, int, int]], header_tokens: int, budget: int, max_size: int) -> List[List[int]]:
+    """
+    Group items greedily in their order so that each pack stays under the token budget.
+    :param items: (example key, example tokens, slot tokens) per item; an example shared by several items of a
+    pack is paid once, slot tokens cover the test sentence and the answer allowance
+    :param header_tokens: instruction and ontology, paid once per pack
+    :param budget: tokens of prompt and answer per pack; an item over budget on its own gets a pack of one
+    :param max_size: most items per pack
+    :return: item indices per pack
+    """
+    packs, current, examples, tokens = [], [], set(), header_tokens
+    for i, (example, example_tokens, slot_tokens) in enumerate(items):
+        cost = slot_tokens + (0 if example in examples else example_tokens)
+        if current and (tokens + cost > budget or len(current) >= max_size):
+            packs.append(current)
+            current, examples, tokens = [], set(), header_tokens
+            cost = slot_tokens + example_tokens
+        current.append(i)
+        examples.add(example)
+        tokens += cost
+    if current:
+        packs.append(current)
+    return packs
+
+
+def split_slots(response_text: str) -> Tuple[Dict[int, List[str]], List[str], set]:
+    """
+    Split a packed answer at its slot markers.
+    :return: (slot number -> lines, lines before the first marker, slot numbers that occur more than once)
+    """
+    blocks, preamble, repeated = {}, [], set()
+    current = None
+    for line in response_text.splitlines():
+        match = _SLOT_MARKER.match(line)
+        if match:
+            current = int(match.group(1))
+            if current in blocks:
+                repeated.add(current)
+            blocks.setdefault(current, [])
+            if match.group(2).strip():
+                blocks[current].append(match.group(2))
+        elif current is None:
+            preamble.append(line)
+        else:
+            blocks[current].append(line)
+    return blocks, preamble, repeated
+
+
+def _words(text: str) -> set:
+    return set(_WORD.findall(text.lower()))
+
+
+def unpack_response(response_text: str, slots: List[dict]) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Demultiplex a packed answer into the response of every slot.
+    A slot is retried on its own when its marker is missing or repeated, or when its triples share no word
+    with its sentence but do with another sentence of the pack (an answer shifted to the wrong number).
+    A pack of one is the sentence's own prompt, its whole answer belongs to the sentence.
+    :param response_text: the model's answer to the packed prompt
+    :param slots: [{'id', 'sentence'}] in slot order
+    :return: (prompt id -> response text, prompt ids to retry)
+    """
+    if len(slots) == 1:
+        return {slots[0]['id']: response_text}, []
+    blocks, _, repeated = split_slots(response_text)
+    sentence_words = [_words(slot['sentence']) for slot in slots]
+    answers, retry = {}, []
+    for number, slot in enumerate(slots, 1):
+        if number not in blocks or number in repeated:
+            retry.append(slot['id'])
+            continue
+        text = '\n'.join(blocks[number]).strip()
+        arguments = set()
+        for subject, _, obj in parse_triples(text):
+            arguments |= _words(subject) | _words(obj)
+        own = sentence_words[number - 1]
+        if arguments and not arguments & own and any(arguments & words for i, words in enumerate(sentence_words)
+                                                     if i != number - 1):
+            retry.append(slot['id'])
+            continue
+        answers[slot['id']] = text
+    return answers, retry
+
+
+def prompt_params(params: dict, prompt_data: dict) -> dict:
+    """Decoding parameters of a prompt for the response cache, a packed prompt's answer allowance replaces
+    max_tokens"""
+    if prompt_data.get('max_tokens'):
+        return {**params, 'max_tokens': prompt_data['max_tokens']}
+    return params
+
+
+class ResponseRouter:
+    """
+    Append responses to the checkpoints of their jobs. The answer to a packed prompt is split into one
+    response per sentence; sentences it does not answer reliably are collected per job to be retried with
+    their own prompt.
+    """
+
+    def __init__(self, record: Callable[[str, str, Optional[dict]], dict]):
+        """:param record: builds the checkpoint record of (prompt id, response text, timing)"""
+        self.record = record
+        self.checkpoints = {}
+        self.packs: Dict[str, Dict[str, dict]] = {}
+        self.retry: Dict[str, List[str]] = {}
+        self.stats = {'packs': 0, 'sentences': 0, 'retried': 0}
+
+    def add_job(self, job: str, checkpoint, packs: Optional[List[dict]] = None) -> None:
+        """Register a job's checkpoint; with packs, its prompts are the packed prompts"""
+        self.checkpoints[job] = checkpoint
+        self.retry[job] = []
+        if packs is not None:
+            self.packs[job] = {pack['id']: pack for pack in packs}
+
+    def pending(self, job: str, prompts: List[dict]) -> List[dict]:
+        """Prompts, or packs, with a sentence not in the checkpoint yet"""
+        checkpoint = self.checkpoints[job]
+        slot_ids = lambda prompt_data: [slot['id'] for slot in prompt_data.get('slots') or [prompt_data]]
+        return [p for p in prompts if any(prompt_id not in checkpoint for prompt_id in slot_ids(p))]
+
+    def failed(self, job: str, prompt_id: str) -> None:
+        """A packed prompt got no answer at all, its sentences are retried with their own prompt"""
+        pack = self.packs.get(job, {}).get(prompt_id)
+        if pack is not None and len(pack['slots']) > 1:
+            retry = [slot['id'] for slot in pack['slots'] if slot['id'] not in self.checkpoints[job]]
+            self.stats['retried'] += len(retry)
+            self.retry[job] += retry
+
+    def write(self, job: str, prompt_id: str, response_text: str, timing: Optional[dict] = None) -> None:
+        checkpoint = self.checkpoints[job]
+        pack = self.packs.get(job, {}).get(prompt_id)
+        if pack is None:
+            checkpoint.append(self.record(prompt_id, response_text, timing))
+            return
+        answers, retry = unpack_response(response_text, pack['slots'])
+        self.stats['packs'] += 1
+        for slot_id, text in answers.items():
+            if slot_id not in checkpoint:
+                # timing belongs to the whole pack, it is not split per sentence
+                checkpoint.append(self.record(slot_id, text, timing if len(pack['slots']) == 1 else None))
+                self.stats['sentences'] += 1
+        retry = [slot_id for slot_id in retry if slot_id not in checkpoint]
+        self.stats['retried'] += len(retry)
+        self.retry[job] += retry
@@ -0,0 +1,500 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from nltk.stem import PorterStemmer
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.checkpoint import ResponseCheckpoint, read_records
+from common.jsonl_io import iter_jsonl, open_text
+from common.response_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_SIZE_MB, ResponseCache
+from common.triple_parser import parse_triples
+from evaluation.run_eval import append_jsonl, evaluate_sentence, load_config, read_jsonl, save_jsonl
+from ann_index import check_ann_config
+from embedding_store import DEFAULT_MAX_SIZE_MB as DEFAULT_STORE_MAX_SIZE_MB, DEFAULT_STORE_DIR, EmbeddingStore
+from gen_prompt import (get_file_paths, get_similar_sentences, get_train_sentence, load_file, load_train_sentences,
+                        prepare_prompt)
+from lexical_retrieval import LEXICAL_METHODS, LexicalIndex, hybrid_rerank
+from openai_async import AsyncChatRunner
+from similarity_io import load_similarities, write_similarities
+
+MODEL = "gpt-4o"
+REQUEST_PARAMS = {'max_tokens': 250, 'temperature': 0}
+# order of the averages in run_eval.py's avg_out_file
+METRICS = ('precision', 'recall', 'f1', 'onto_conf', 'sub_halluc', 'rel_halluc', 'obj_halluc')
+# put on a queue by a stage that has nothing more to send
+DONE = None
+
+Search = Callable[[List[str]], Tuple[np.ndarray, np.ndarray]]
+
+
+def load_encoder_for(config: dict, test_texts: List[str], train_texts: List[str]) -> Tuple[object, str]:
+    """The config's sentence encoder, imported on first use so lexical retrieval runs without torch"""
+    from encoder_precision import encoder_key, load_encoder
+    model_name = config.get('model_name', 'sentence-t5-xxl')
+    precision = config.get('encoder_precision', 'fp32')
+    reduced = precision != 'fp32'
+    model = load_encoder(model_name, precision,
+                         query_sentences=test_texts if reduced else [],
+                         pool_sentences=train_texts if reduced else [],
+                         check_config=config.get('precision_check', {}),
+                         top_k=config.get('top_k', 5),
+                         local_files_only=config.get('local_files_only', False))
+    return model, encoder_key(model_name, precision)
+
+
+def lexical_search(config: dict, train_texts: List[str], method: str, top_k: int) -> Search:
+    lexical_config = config.get('lexical', {})
+    index = LexicalIndex(train_texts, method, k1=lexical_config.get('k1', 1.5), b=lexical_config.get('b', 0.75))
+    return lambda texts: index.topk(texts, top_k)
+
+
+def dense_search(config: dict, onto: str, train_texts: List[str], train_hash: str, train_file: str,
+                 encode: Callable[[List[str]], np.ndarray], model_key: str, store_root: str, device,
+                 top_k: int) -> Search:
+    """
+    Cosine search of gen_sentence_similarity_t5-xxl.py, through the ANN index of the config's "ann" section if
+    it has one, or lexical candidates reranked by cosine for the hybrid retriever
+    """
+    import torch
+    from dense_retrieval import open_ann_index, search_neighbours
+    train_vectors = encode(train_texts)
+    if config.get('retriever', 'dense') == 'hybrid':
+        num_candidates = max(config.get('hybrid_candidates', 50), top_k)
+        candidates = lexical_search(config, train_texts, config.get('lexical', {}).get('method', 'bm25'),
+                                    num_candidates)
+        return lambda texts: hybrid_rerank(candidates(texts)[1], encode(texts), train_vectors, top_k)
+
+    train_embeddings = torch.from_numpy(train_vectors).to(device)
+    ann = open_ann_index(onto, config['ann'], model_key, store_root, train_embeddings, train_hash, train_file) \
+        if config.get('ann') else None
+    chunk_size = config.get('similarity_chunk_size', 1024)
+    return lambda texts: search_neighbours(torch.from_numpy(encode(texts)).to(device), train_embeddings, top_k,
+                                           chunk_size, ann, show_progress=False)
+
+
+class Pipeline:
+    """
+    Test sentences flow one by one through retrieval, prompt building, inference and scoring. Stages are
+    connected by bounded queues, so a stage blocks instead of running ahead when the next one falls behind,
+    and the first scores arrive after the first responses rather than after the whole run.
+
+    Side outputs are the files of the batch scripts: similarities and prompts per ontology as
+    gen_sentence_similarity_t5-xxl.py and gen_prompt.py write them, responses appended to the checkpoint the
+    evaluation config reads, and run_eval.py's metrics once every ontology is scored. Responses already in the
+    checkpoint or the response cache are scored without a request.
+    """
+
+    def __init__(self, args: argparse.Namespace, config: dict, eval_inputs: dict, runner: AsyncChatRunner,
+                 cache: Optional[ResponseCache], backend: str):
+        self.args = args
+        self.config = config
+        self.eval_inputs = eval_inputs
+        self.runner = runner
+        self.cache = cache
+        self.backend = backend
+        self.ps = PorterStemmer()
+        self.file_paths = get_file_paths(config)
+        self.eval_paths = {onto['id']: onto for onto in eval_inputs['onto_list']}
+        self.ontologies: Dict[str, dict] = {}
+        self.encoder = None
+        self.store = None
+        # the encoder, the embedding store and the search run on this one thread: the store's SQLite connection
+        # only works in the thread that opened it
+        self.retrieval_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='retrieval')
+        self.running = {metric: 0.0 for metric in METRICS}
+        self.stats = {'sentences': 0, 'prompts': 0, 'zero_shot': 0, 'requests': 0, 'resumed': 0, 'cached': 0,
+                      'failed': 0, 'scored': 0}
+        self.start_time = time.time()
+        self.first_score = None
+
+    # ---- retrieval ----
+
+    def open_ontology(self, onto: str) -> Optional[dict]:
+        """Load what the stages need for one ontology and open its side outputs"""
+        paths, eval_paths = self.file_paths[onto], self.eval_paths[onto]
+        test_sentences = load_file(paths['test_file'])
+        train_sentences = load_train_sentences(paths['train_file'])
+        ontology = load_file(paths['ontology_file'])
+        if not all([test_sentences, train_sentences, ontology]) or not os.path.exists(eval_paths['gt']):
+            print(f"Skipping {onto} due to missing files")
+            return None
+        test_items = [(s.get('id'), s.get('text', s.get('sent', ''))) for s in test_sentences]
+        test_items = [(test_id, text) for test_id, text in test_items if test_id and text]
+
+        context = {'id': onto, 'ontology': ontology, 'train': train_sentences, 'test_items': test_items,
+                   'ground_truth': {record['id']: record for record in read_jsonl(eval_paths['gt'])},
+                   'selected_ids': read_jsonl(eval_paths['selected_ids'], is_json=False)
+                   if 'selected_ids' in eval_paths else [],
+                   'eval_metrics': {}, 'scores': {}, 'totals': {metric: 0.0 for metric in METRICS},
+                   'similarities': None, 'search': None, 'retrieved': True}
+        if self.args.reuse_similarities:
+            context['similarities'] = load_similarities(paths['test_train_similarity_file'])
+            if context['similarities'] is None:
+                return None
+        else:
+            context['search'], context['train_ids'] = self.train_search(onto, paths['train_file'], test_items)
+            if context['search'] is None:
+                return None
+            context['top_scores'], context['top_indices'] = [], []
+
+        checkpoint = ResponseCheckpoint(eval_paths['sys'], overwrite=self.args.overwrite)
+        context['checkpoint'] = checkpoint
+        # answered sentences of an interrupted run are scored from their records
+        context['records'] = {} if self.args.overwrite else {
+            record.get('id'): record for file_path in dict.fromkeys([checkpoint.output_file, checkpoint.log_file])
+            for record in read_records(file_path) if record.get('id') in checkpoint}
+        os.makedirs(os.path.dirname(paths['prompt_file']) or '.', exist_ok=True)
+        context['prompt_out'] = open_text(paths['prompt_file'], 'w')
+        return context
+
+    def train_search(self, onto: str, train_file: str,
+                     test_items: List[Tuple[str, str]]) -> Tuple[Optional[Search], List[str]]:
+        """Neighbour search over an ontology's train sentences with the config's retriever"""
+        retriever = self.config.get('retriever', 'dense')
+        top_k = self.config.get('top_k', 5)
+        if retriever in LEXICAL_METHODS:
+            train_ids, train_texts = [], []
+            for record in iter_jsonl(train_file):
+                train_ids.append(record['id'])
+                train_texts.append(record['sent'])
+        else:
+            from dense_retrieval import load_sentences
+            # the content hash keys the ANN index, as in gen_sentence_similarity_t5-xxl.py
+            train_texts, train_ids, train_hash = load_sentences(train_file)
+        if not train_texts:
+            print(f"Skipping {onto} due to missing data")
+            return None, []
+        if retriever in LEXICAL_METHODS:
+            return lexical_search(self.config, train_texts, retriever, top_k), train_ids
+
+        if self.encoder is None:
+            self.encoder = load_encoder_for(self.config, [text for _, text in test_items], train_texts)
+            store_config = self.config.get('embedding_store', {})
+            self.store = EmbeddingStore(store_config.get('path', DEFAULT_STORE_DIR),
+                                        store_config.get('max_size_mb', DEFAULT_STORE_MAX_SIZE_MB))
+        model, model_key = self.encoder
+        batch_size = self.config.get('encode_batch_size', 32)
+        # go through a tensor, bfloat16 outputs have no numpy equivalent
+        encode_fn = lambda texts: model.encode(texts, batch_size=batch_size, convert_to_tensor=True,
+                                               show_progress_bar=False).float().cpu().numpy()
+        encode = lambda texts: self.store.encode(model_key, texts, encode_fn)
+        return dense_search(self.config, onto, train_texts, train_hash, train_file, encode, model_key, self.store.root,
+                            model.device, top_k), train_ids
+
+    def neighbours(self, context: dict, chunk: List[Tuple[str, str]]) -> List[List[Tuple[str, float]]]:
+        """(train id, score) neighbours of a chunk of test sentences, most similar first"""
+        if context['similarities'] is not None:
+            return [context['similarities'].get(test_id, []) for test_id, _ in chunk]
+        scores, indices = context['search']([text for _, text in chunk])
+        context['top_scores'].append(scores)
+        context['top_indices'].append(indices)
+        return [[(context['train_ids'][i], float(score)) for i, score in zip(row, row_scores) if i >= 0]
+                for row, row_scores in zip(indices.tolist(), scores.tolist())]
+
+    async def on_retrieval_thread(self, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.retrieval_thread, function, *args)
+
+    def write_similarities(self, context: dict) -> None:
+        if context['search'] is None or not context['top_indices']:
+            return
+        output_file = self.file_paths[context['id']]['test_train_similarity_file']
+        if not context['retrieved']:
+            print(f"Similarities of {context['id']} are incomplete and not saved to {output_file}")
+            return
+        write_similarities(output_file, [test_id for test_id, _ in context['test_items']], context['train_ids'],
+                           np.concatenate(context['top_scores']), np.concatenate(context['top_indices']))
+        print(f"Similarities of {context['id']} saved to {output_file}")
+
+    async def retrieve(self, out_queue: asyncio.Queue) -> None:
+        """Stage 1: neighbours of the test sentences, one chunk at a time"""
+        chunk_size = self.args.retrieval_chunk
+        for onto in self.config['onto_list']:
+            if onto not in self.eval_paths:
+                print(f"{onto} is not in the evaluation config, skipping it")
+                continue
+            try:
+                context = await self.on_retrieval_thread(self.open_ontology, onto)
+            except Exception as e:
+                print(f"Error opening ontology {onto}: {str(e)}")
+                continue
+            if context is None:
+                continue
+            self.ontologies[onto] = context
+            print(f"\nStreaming ontology: {onto} ({len(context['test_items'])} test sentences)")
+            for start in range(0, len(context['test_items']), chunk_size):
+                chunk = context['test_items'][start:start + chunk_size]
+                try:
+                    neighbours = await self.on_retrieval_thread(self.neighbours, context, chunk)
+                except Exception as e:
+                    # the sentences still get a prompt, without an example
+                    print(f"Error retrieving neighbours for {onto}, using zero-shot prompts for {len(chunk)} "
+                          f"sentences: {str(e)}")
+                    context['retrieved'] = False
+                    neighbours = [None] * len(chunk)
+                for (test_id, text), similar in zip(chunk, neighbours):
+                    self.stats['sentences'] += 1
+                    await out_queue.put({'onto': context, 'id': test_id, 'text': text, 'neighbours': similar})
+            await self.on_retrieval_thread(self.write_similarities, context)
+        await out_queue.put(DONE)
+
+    # ---- prompt building ----
+
+    def build_prompt(self, item: dict) -> Optional[str]:
+        """The prompt gen_prompt.py writes for the sentence, formatted as in its prompt file; a zero-shot prompt
+        when retrieval failed for the sentence"""
+        context = item['onto']
+        train_sent = None
+        if item['neighbours'] is not None:
+            similar = get_similar_sentences(item['id'], {item['id']: item['neighbours']},
+                                            self.config.get('min_similarity'))
+            if not similar:
+                return None
+            train_sent = get_train_sentence(similar[0], context['train'])
+            if not train_sent:
+                return None
+        else:
+            self.stats['zero_shot'] += 1
+        prompt = prepare_prompt(context['ontology'], item['text'], train_sent)
+        if not prompt:
+            return None
+        # the runners send the prompt as read back from the prompt file, so cached responses are shared
+        prompt = prompt.replace('\n        ', '\n').strip()
+        context['prompt_out'].write(json.dumps({'id': item['id'], 'prompt': prompt}, ensure_ascii=False) + '\n')
+        return prompt
+
+    async def build_prompts(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue) -> None:
+        """Stage 2: prompts from the nearest train sentence"""
+        while (item := await in_queue.get()) is not DONE:
+            try:
+                item['prompt'] = self.build_prompt(item)
+            except Exception as e:
+                print(f"Error building the prompt of {item['id']}: {str(e)}")
+                item['prompt'] = None
+            if item['prompt']:
+                self.stats['prompts'] += 1
+                await out_queue.put(item)
+        for _ in range(self.args.concurrency):
+            await out_queue.put(DONE)
+
+    # ---- inference ----
+
+    def response_record(self, prompt_id: str, response_text: str, timing: Optional[dict] = None) -> dict:
+        record = {'id': prompt_id, 'response': response_text, 'triples': parse_triples(response_text)}
+        if timing is not None:
+            record['timing'] = timing
+        return record
+
+    async def answer(self, item: dict) -> Optional[dict]:
+        """The response record of a sentence: resumed, cached or requested"""
+        context = item['onto']
+        if item['id'] in context['records']:
+            self.stats['resumed'] += 1
+            return context['records'][item['id']]
+        response_text = self.cache.get(self.backend, self.runner.model, REQUEST_PARAMS, item['prompt']) \
+            if self.cache is not None else None
+        timing = None
+        if response_text is not None:
+            self.stats['cached'] += 1
+        else:
+            self.stats['requests'] += 1
+            try:
+                result = await self.runner.complete(item['prompt'])
+            except Exception as e:
+                print(f"Error processing prompt {item['id']}: {str(e)}")
+                self.stats['failed'] += 1
+                return None
+            response_text, timing = result['response'], result.get('timing')
+            if self.cache is not None:
+                self.cache.put(self.backend, self.runner.model, REQUEST_PARAMS, item['prompt'], response_text)
+        record = self.response_record(item['id'], response_text, timing)
+        context['checkpoint'].append(record)
+        return record
+
+    async def infer(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue) -> None:
+        """Stage 3, run by --concurrency workers: responses and their triples"""
+        while (item := await in_queue.get()) is not DONE:
+            item['record'] = await self.answer(item)
+            if item['record'] is not None:
+                await out_queue.put(item)
+        await out_queue.put(DONE)
+
+    # ---- scoring ----
+
+    def score_item(self, item: dict) -> None:
+        context = item['onto']
+        gt_record = context['ground_truth'].get(item['id'])
+        if gt_record is None:
+            return
+        eval_metrics, scores = evaluate_sentence(self.ps, context['ontology'], gt_record,
+                                                 item['record'].get('triples', []))
+        context['eval_metrics'][item['id']] = eval_metrics
+        context['scores'][item['id']] = scores
+        self.stats['scored'] += 1
+        for metric in METRICS:
+            context['totals'][metric] += scores[metric]
+            self.running[metric] += scores[metric]
+
+    def report(self) -> None:
+        scored = self.stats['scored']
+        averages = ', '.join(f"{metric} {self.running[metric] / scored:.2f}" for metric in METRICS)
+        print(f"[{time.time() - self.start_time:.1f}s] {scored} of {self.stats['sentences']} sentences scored "
+              f"({self.stats['requests']} requests, {self.stats['cached']} cached, {self.stats['resumed']} resumed, "
+              f"{self.stats['failed']} failed, {self.stats['zero_shot']} zero-shot): {averages}")
+
+    async def score(self, in_queue: asyncio.Queue) -> None:
+        """Stage 4: per-sentence metrics as run_eval.py computes them, with running averages"""
+        workers = self.args.concurrency
+        while workers:
+            item = await in_queue.get()
+            if item is DONE:
+                workers -= 1
+                continue
+            try:
+                await asyncio.to_thread(self.score_item, item)
+            except Exception as e:
+                print(f"Error scoring {item['id']}: {str(e)}")
+                continue
+            if self.first_score is None and self.stats['scored']:
+                self.first_score = time.time() - self.start_time
+                print(f"First score after {self.first_score:.1f} seconds")
+            if self.stats['scored'] and self.stats['scored'] % self.args.report_every == 0:
+                self.report()
+
+    # ---- run ----
+
+    async def run(self) -> None:
+        size = self.args.queue_size
+        retrieved, prompts, responses = asyncio.Queue(size), asyncio.Queue(size), asyncio.Queue(size)
+        tasks = [asyncio.create_task(self.retrieve(retrieved)),
+                 asyncio.create_task(self.build_prompts(retrieved, prompts)),
+                 *[asyncio.create_task(self.infer(prompts, responses)) for _ in range(self.args.concurrency)],
+                 asyncio.create_task(self.score(responses))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # a failed stage would leave the others waiting on its queue
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def close(self) -> None:
+        for context in self.ontologies.values():
+            context['prompt_out'].close()
+            context['checkpoint'].close()
+            if hasattr(context['train'], 'close'):
+                context['train'].close()
+        if self.store is not None:
+            self.retrieval_thread.submit(self.store.close).result()
+        self.retrieval_thread.shutdown()
+
+    def write_metrics(self) -> None:
+        """Per-sentence and average metrics in run_eval.py's files and layout. Averages are over all ground
+        truth sentences of an ontology, sentences without a response count as zero."""
+        avg_out_file = self.eval_inputs['avg_out_file']
+        global_totals = {metric: 0.0 for metric in METRICS}
+        for onto, context in self.ontologies.items():
+            save_jsonl([context['eval_metrics'][sent_id] for sent_id in context['ground_truth']
+                        if sent_id in context['eval_metrics']], self.eval_paths[onto]['output'])
+            total_test_cases = len(context['ground_truth'])
+            append_jsonl(average_metrics({"onto": onto, "type": "all_test_cases"}, context['totals'],
+                                         total_test_cases), avg_out_file)
+            for metric in METRICS:
+                global_totals[metric] += context['totals'][metric] / total_test_cases if total_test_cases else 0
+            selected_ids = context['selected_ids']
+            if selected_ids:
+                selected_totals = {metric: 0.0 for metric in METRICS}
+                for scores in filter(None, map(context['scores'].get, selected_ids)):
+                    for metric in METRICS:
+                        selected_totals[metric] += scores[metric]
+                append_jsonl(average_metrics({"onto": onto, "type": "selected_test_cases"}, selected_totals,
+                                             len(selected_ids)), avg_out_file)
+        if self.ontologies:
+            append_jsonl({**average_metrics({"id": "global", "type": "global"}, global_totals, len(self.ontologies)),
+                          "onto_list": [self.eval_paths[onto] for onto in self.ontologies]}, avg_out_file)
+        print(f"Metrics saved to {avg_out_file}")
+
+
+def average_metrics(header: dict, totals: Dict[str, float], count: int) -> dict:
+    return {**header, **{f"avg_{metric}": f"{totals[metric] / count:.2f}" if count else "0.00"
+                         for metric in METRICS}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream test sentences through retrieval, prompt building, '
+                                                 'inference and scoring with overlapping stages')
+    parser.add_argument('--prompt_gen_config_path', required=True,
+                        help='Prompt generation config: ontologies, test/train data, similarity and prompt files')
+    parser.add_argument('--eval_config_path', required=True,
+                        help='Evaluation config: response files, ground truth and metric outputs')
+    parser.add_argument('--reuse_similarities', action='store_true',
+                        help='Read the similarity files of gen_sentence_similarity_t5-xxl.py instead of retrieving '
+                             'with the config\'s retriever')
+    parser.add_argument('--retrieval_chunk', type=int, default=32, help='Test sentences retrieved per step')
+    parser.add_argument('--queue_size', type=int, default=64, help='Items held between two stages')
+    parser.add_argument('--report_every', type=int, default=25, help='Print running scores every so many sentences')
+    parser.add_argument('--api_key', required=False, help='OpenAI API key')
+    parser.add_argument('--base_url', required=False,
+                        help='OpenAI-compatible endpoint, e.g. llama_server.py for the Qwen baseline')
+    parser.add_argument('--model', default=MODEL, help='Model name sent with every request')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of requests in flight')
+    parser.add_argument('--rpm', type=float, default=500, help='Requests per minute limit, 0 disables it')
+    parser.add_argument('--tpm', type=float, default=30000, help='Tokens per minute limit, 0 disables it')
+    parser.add_argument('--max_retries', type=int, default=6, help='Retries on 429, 5xx and connection errors')
+    parser.add_argument('--stream', action='store_true', help='Stream completions and record time to first token')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Discard existing responses instead of resuming from them')
+    parser.add_argument('--cache_path', default=DEFAULT_CACHE_PATH, help='Response cache database')
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_MAX_SIZE_MB, help='Response cache size limit')
+    parser.add_argument('--no_cache', action='store_true', help='Neither read nor write the response cache')
+    args = parser.parse_args()
+
+    api_key = args.api_key or os.getenv('OPENAI_API_KEY') or ('local' if args.base_url else None)
+    if not api_key:
+        print("OpenAI API key not provided. Please set it as an argument or environment variable.")
+        sys.exit(1)
+    config = load_file(args.prompt_gen_config_path)
+    if not config:
+        sys.exit(1)
+    if not os.path.exists(args.eval_config_path):
+        print(f"Evaluation config file is not found in path: {args.eval_config_path}")
+        sys.exit(1)
+    eval_inputs = load_config(args.eval_config_path)
+    if config.get('ann') and not args.reuse_similarities:
+        try:
+            check_ann_config(config['ann'])
+        except (ValueError, ImportError) as e:
+            print(f"Invalid ANN configuration in {args.prompt_gen_config_path}: {str(e)}")
+            sys.exit(1)
+
+    # the same cache keys as gen_responses_gpt-4o.py, responses are shared with the batch workflow
+    backend = f"openai@{args.base_url}" if args.base_url else "openai"
+    cache = None if args.no_cache else ResponseCache(args.cache_path, args.cache_max_mb)
+    client = AsyncOpenAI(api_key=api_key, base_url=args.base_url, max_retries=0)
+    runner = AsyncChatRunner(client, args.model, max_concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm,
+                             max_retries=args.max_retries, request_params=REQUEST_PARAMS, stream=args.stream)
+
+    pipeline = Pipeline(args, config, eval_inputs, runner, cache, backend)
+    try:
+        asyncio.run(pipeline.run())
+    except Exception as e:
+        print(f"Error running the pipeline: {str(e)}")
+        sys.exit(1)
+    finally:
+        pipeline.close()
+        if cache is not None:
+            cache.close()
+
+    if pipeline.stats['scored']:
+        pipeline.report()
+    pipeline.write_metrics()
+    print(f"Pipeline finished in {time.time() - pipeline.start_time:.1f} seconds, first score after "
+          f"{pipeline.first_score or 0:.1f} seconds; {pipeline.stats['prompts']} prompts, "
+          f"{pipeline.stats['requests']} requests ({runner.stats})")
@@ -0,0 +1,86 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# callers put src/ on sys.path before importing this module
+from common.jsonl_io import compression_suffix, open_text
+
+# test id -> [(train id, score)], the score is None for the legacy id-only JSON format
+Neighbours = Dict[str, List[Tuple[str, Optional[float]]]]
+
+
+def similarity_format(path: str) -> str:
+    """Output format implied by the file extension, compression suffixes are ignored"""
+    base_name = path[:len(path) - len(compression_suffix(path))]
+    if base_name.endswith('.npz'):
+        return 'npz'
+    if base_name.endswith('.jsonl'):
+        return 'jsonl'
+    return 'json'
+
+
+def write_similarities(path: str,
+                       test_ids: List[str],
+                       train_ids: List[str],
+                       scores: np.ndarray,
+                       indices: np.ndarray) -> None:
+    """Write top-k neighbours in the format implied by the path.
+    json keeps the original {test_id: [train_id, ...]} layout without scores, jsonl writes one
+    {"id", "neighbours", "scores"} object per test sentence, npz stores int32 neighbour indices and float16
+    scores next to the id tables. Missing neighbours (index -1) are dropped, or kept as -1 in npz."""
+    fmt = similarity_format(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if fmt == 'npz':
+        if compression_suffix(path):
+            raise ValueError(f"npz similarity files are not compressed further: {path}")
+        # np.savez appends .npz to names that lack it, write through a file object to keep the path as given
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     test_ids=np.array(test_ids, dtype=str),
+                     train_ids=np.array(train_ids, dtype=str),
+                     indices=np.asarray(indices, dtype=np.int32),
+                     scores=np.asarray(scores, dtype=np.float16))
+        return
+
+    with open_text(path, 'w') as f:
+        if fmt == 'json':
+            results = {test_ids[row]: [train_ids[i] for i in neighbours if i >= 0]
+                       for row, neighbours in enumerate(indices.tolist())}
+            json.dump(results, f, indent=4)
+            return
+        for row, (neighbours, row_scores) in enumerate(zip(indices.tolist(), scores.tolist())):
+            kept = [(train_ids[i], round(score, 4)) for i, score in zip(neighbours, row_scores) if i >= 0]
+            f.write(json.dumps({'id': test_ids[row],
+                                'neighbours': [train_id for train_id, _ in kept],
+                                'scores': [score for _, score in kept]}, ensure_ascii=False) + '\n')
+
+
+def load_similarities(path: str) -> Optional[Neighbours]:
+    """Load a similarity file written in any of the formats, including the legacy JSON list of
+    {"test_id", "similar_sentences"} items"""
+    try:
+        fmt = similarity_format(path)
+        if fmt == 'npz':
+            with np.load(path, allow_pickle=False) as data:
+                test_ids, train_ids = data['test_ids'].tolist(), data['train_ids'].tolist()
+                indices, scores = data['indices'], data['scores'].astype(np.float32)
+            return {test_id: [(train_ids[i], float(score)) for i, score in zip(row, row_scores) if i >= 0]
+                    for test_id, row, row_scores in zip(test_ids, indices.tolist(), scores.tolist())}
+
+        with open_text(path, 'r') as f:
+            if fmt == 'jsonl':
+                neighbours = {}
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        neighbours[item['id']] = list(zip(item['neighbours'], item['scores']))
+                return neighbours
+            data = json.load(f)
+        if isinstance(data, list):
+            data = {item.get('test_id'): item.get('similar_sentences', []) for item in data}
+        return {test_id: [(train_id, None) for train_id in train_list] for test_id, train_list in data.items()}
+    except Exception as e:
+        print(f"Error loading similarities from {path}: {str(e)}")
+        return None
@@ -0,0 +1,103 @@
+from typing import Optional
+
+import numpy as np
+
+SPECULATIVE_MODES = ('prompt_lookup', 'draft_model')
+# tokens drafted per step when not given: prompt lookup copies long spans cheaply, a draft model pays per token
+DEFAULT_DRAFT_TOKENS = {'prompt_lookup': 10, 'draft_model': 6}
+
+
+class LlamaModelDraft:
+    """
+    Draft tokens with a small llama.cpp model that shares the target model's vocabulary, e.g. Qwen2.5-0.5B for
+    Qwen2.5-32B. The draft context follows the target's verified tokens: the part it already holds is kept,
+    the rest is evaluated, then num_pred_tokens tokens are decoded greedily.
+    """
+
+    def __init__(self, model_path: str, num_pred_tokens: int, n_ctx: int, n_threads: int, n_gpu_layers: int):
+        from llama_cpp import Llama
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, n_gpu_layers=n_gpu_layers,
+                         verbose=False)
+        self.num_pred_tokens = num_pred_tokens
+
+    def _rewind(self, input_ids: np.ndarray) -> int:
+        """Drop the cached tokens that differ from input_ids, returns how many are kept"""
+        cached = self.llm.input_ids[:self.llm.n_tokens]
+        n = min(len(cached), len(input_ids))
+        mismatch = np.nonzero(cached[:n] != input_ids[:n])[0]
+        keep = int(mismatch[0]) if len(mismatch) else n
+        # the last token is evaluated again so its logits are current
+        keep = min(keep, len(input_ids) - 1)
+        # same KV removal as Llama.generate uses for its prefix matching
+        if keep <= 0 or not self.llm._ctx.kv_cache_seq_rm(-1, keep, -1):
+            self.llm.reset()
+            return 0
+        self.llm.n_tokens = keep
+        return keep
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        keep = self._rewind(input_ids)
+        self.llm.eval(input_ids[keep:].tolist())
+        budget = min(self.num_pred_tokens, self.llm.n_ctx() - len(input_ids) - 1)
+        draft = []
+        for _ in range(max(0, budget)):
+            token = self.llm.sample(temp=0)
+            if token == self.llm.token_eos():
+                break
+            draft.append(token)
+            if len(draft) < budget:
+                self.llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class AcceptanceCounter:
+    """
+    Wrap a draft model and count how many drafted tokens the target model accepted. The target passes its
+    verified tokens with every call, so the previous draft is resolved by comparing it with what was appended
+    since; the draft of a sequence's last step is never verified and not counted.
+    """
+
+    def __init__(self, draft_model):
+        self.draft_model = draft_model
+        self.proposed = 0
+        self.accepted = 0
+        self.last = None
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        if self.last is not None:
+            base, draft = self.last
+            if len(input_ids) > len(base) and np.array_equal(input_ids[:len(base)], base):
+                appended = input_ids[len(base):]
+                n = min(len(appended), len(draft))
+                mismatch = np.nonzero(appended[:n] != draft[:n])[0]
+                self.accepted += int(mismatch[0]) if len(mismatch) else n
+                self.proposed += len(draft)
+        draft = self.draft_model(input_ids, **kwargs)
+        self.last = (input_ids.copy(), draft.copy()) if len(draft) else None
+        return draft
+
+    @property
+    def stats(self) -> dict:
+        return {'proposed': self.proposed, 'accepted': self.accepted}
+
+
+def make_draft_model(speculative: Optional[dict], llama_kwargs: dict) -> Optional[AcceptanceCounter]:
+    """
+    Build the draft model of a replica, None for plain decoding. At temperature 0 the target model verifies
+    every drafted token greedily, so outputs match plain decoding and only the speed changes.
+    :param speculative: {'mode': 'prompt_lookup' | 'draft_model', 'num_pred_tokens': int, 'model_path': draft GGUF}
+    :param llama_kwargs: arguments of the target model, the draft model uses the same context and threads
+    :return: the draft model wrapped in an AcceptanceCounter
+    """
+    if not speculative:
+        return None
+    mode = speculative['mode']
+    num_pred_tokens = speculative.get('num_pred_tokens') or DEFAULT_DRAFT_TOKENS[mode]
+    if mode == 'prompt_lookup':
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+        return AcceptanceCounter(LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens))
+    if mode == 'draft_model':
+        return AcceptanceCounter(LlamaModelDraft(speculative['model_path'], num_pred_tokens,
+                                                 llama_kwargs.get('n_ctx', 2048), llama_kwargs.get('n_threads'),
+                                                 llama_kwargs.get('n_gpu_layers', 0)))
+    raise ValueError(f"Unknown speculative decoding mode {mode}, expected {', '.join(SPECULATIVE_MODES)}")
@@ -0,0 +1,142 @@
+import time
+from typing import AsyncIterator, Iterator, List, Optional
+
+from common.triple_parser import parse_line_triples
+
+STOP_CONDITIONS = ('blank_line', 'non_triple')
+
+
+class IncrementalTripleParser:
+    """
+    Parse triples from streamed text as soon as their line is complete and decide when generation can stop.
+    Stop conditions only apply once at least one triple was parsed, so a preamble before the answer does not
+    end generation:
+      blank_line  - an empty line follows the triples
+      non_triple  - a non-empty line that is not a triple follows the triples
+      max_triples - this many triples were parsed
+    """
+
+    def __init__(self, stop_on: tuple = (), max_triples: Optional[int] = None):
+        unknown = set(stop_on) - set(STOP_CONDITIONS)
+        if unknown:
+            raise ValueError(f"Unknown stop condition(s) {', '.join(sorted(unknown))}, "
+                             f"expected {', '.join(STOP_CONDITIONS)}")
+        self.stop_on = set(stop_on)
+        self.max_triples = max_triples
+        self.text = ''
+        self.buffer = ''
+        self.triples = []
+        self.stopped = False
+        self.stop_reason = None
+
+    def _line(self, line: str) -> None:
+        if self.stopped:
+            return
+        triples = parse_line_triples(line)
+        if triples:
+            if self.max_triples:
+                triples = triples[:self.max_triples - len(self.triples)]
+            self.triples.extend(triples)
+            if self.max_triples and len(self.triples) >= self.max_triples:
+                self.stopped, self.stop_reason = True, 'max_triples'
+        elif self.triples:
+            if not line.strip() and 'blank_line' in self.stop_on:
+                self.stopped, self.stop_reason = True, 'blank_line'
+            elif line.strip() and 'non_triple' in self.stop_on:
+                self.stopped, self.stop_reason = True, 'non_triple'
+
+    def feed(self, chunk: str) -> int:
+        """Add streamed text, returns the number of triples completed by it"""
+        if self.stopped or not chunk:
+            return 0
+        before = len(self.triples)
+        self.buffer += chunk
+        while '\n' in self.buffer and not self.stopped:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.text += line + '\n'
+            self._line(line)
+        if self.stopped:
+            # text after the stopping line is not part of the answer
+            self.buffer = ''
+        return len(self.triples) - before
+
+    def finish(self) -> List[List[str]]:
+        """Parse the last, unterminated line and return all triples"""
+        if self.buffer:
+            self.text += self.buffer
+            self._line(self.buffer)
+            self.buffer = ''
+        return self.triples
+
+    @property
+    def response(self) -> str:
+        """The answer text up to and including the line that stopped generation"""
+        return (self.text + self.buffer).rstrip('\n')
+
+
+class StreamTimer:
+    """Time to first token and to the line that completed the last triple, relative to the request start"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.first_token = None
+        self.last_triple = None
+
+    def chunk(self, text: str, new_triples: int) -> None:
+        now = time.time()
+        if text and self.first_token is None:
+            self.first_token = now
+        if new_triples:
+            self.last_triple = now
+
+    def timing(self) -> dict:
+        elapsed = lambda t: round(t - self.start, 3) if t is not None else None
+        return {'ttft': elapsed(self.first_token), 'time_to_last_triple': elapsed(self.last_triple),
+                'total': elapsed(time.time())}
+
+
+def _result(parser: IncrementalTripleParser, timer: StreamTimer, num_chunks: int) -> dict:
+    before = len(parser.triples)
+    parser.finish()
+    if len(parser.triples) > before:
+        timer.last_triple = time.time()
+    return {'response': parser.response, 'triples': parser.triples, 'chunks': num_chunks,
+            'stop_reason': parser.stop_reason, 'timing': timer.timing()}
+
+
+def consume_stream(chunks: Iterator[str], parser: IncrementalTripleParser) -> dict:
+    """
+    Feed text chunks to the parser until the stream ends or a stop condition holds. The iterator is closed
+    afterwards, for a generator over a running completion this ends generation.
+    :return: response text, triples, number of chunks, stop reason and timing
+    """
+    timer = StreamTimer()
+    num_chunks = 0
+    try:
+        for text in chunks:
+            num_chunks += 1
+            timer.chunk(text, parser.feed(text))
+            if parser.stopped:
+                break
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+    return _result(parser, timer, num_chunks)
+
+
+async def consume_async_stream(chunks: AsyncIterator[str], parser: IncrementalTripleParser) -> dict:
+    """consume_stream for asynchronous chunk iterators, closed with aclose"""
+    timer = StreamTimer()
+    num_chunks = 0
+    try:
+        async for text in chunks:
+            num_chunks += 1
+            timer.chunk(text, parser.feed(text))
+            if parser.stopped:
+                break
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+    return _result(parser, timer, num_chunks)
@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.jsonl_io import iter_jsonl, open_text
+from model_files import DEFAULT_MODELS_DIR, MODEL_NAME, MODEL_REPO, download_model
+
+
+def machine_info() -> dict:
+    """Identifies the machine a report was measured on"""
+    cpu_model = None
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            cpu_model = next((line.split(':', 1)[1].strip() for line in f if line.startswith('model name')), None)
+    except OSError:
+        pass
+    try:
+        import llama_cpp
+        llama_cpp_version = llama_cpp.__version__
+    except ImportError:
+        llama_cpp_version = None
+    return {'hostname': socket.gethostname(), 'platform': platform.platform(), 'cpu_model': cpu_model,
+            'cpu_count': os.cpu_count(), 'memory_gb': round(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+                                                            / 1024 ** 3, 1),
+            'python': platform.python_version(), 'llama_cpp_python': llama_cpp_version}
+
+
+def sample_prompts(patterns: List[str], num_prompts: int, seed: int) -> List[str]:
+    """A reproducible random sample of prompts from (optionally compressed) prompt JSONL files"""
+    prompts = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            prompts += [record['prompt'] for record in iter_jsonl(path, skip_invalid=True) if record.get('prompt')]
+    if num_prompts and len(prompts) > num_prompts:
+        prompts = random.Random(seed).sample(prompts, num_prompts)
+    return prompts
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_llama_config(model_path: str, config: dict, prompts: List[str], max_tokens: int, warmup: int,
+                     keep_prefix: bool) -> dict:
+    """
+    Load the model with one setting and time every prompt; runs in its own process so peak RSS belongs to
+    this setting. Token counts and evaluation times come from llama.cpp's performance counters, TTFT is the
+    wall time until the first streamed token.
+    """
+    import llama_cpp
+    from llama_cpp import Llama
+
+    start_time = time.time()
+    llm = Llama(model_path=model_path, verbose=False, **config)
+    load_seconds = time.time() - start_time
+    measurements = []
+    for i, prompt in enumerate(prompts[:warmup] + prompts):
+        if not keep_prefix:
+            # evaluate every prompt in full instead of reusing the prefix shared with the previous one
+            llm.reset()
+        llama_cpp.llama_perf_context_reset(llm._ctx.ctx)
+        start_time, first_token = time.time(), None
+        for chunk in llm.create_chat_completion(messages=[{"role": "user", "content": prompt}], temperature=0,
+                                                max_tokens=max_tokens, stream=True):
+            if first_token is None and chunk['choices'][0]['delta'].get('content'):
+                first_token = time.time()
+        end_time = time.time()
+        perf = llama_cpp.llama_perf_context(llm._ctx.ctx)
+        if i < warmup:
+            continue
+        measurements.append({
+            'prompt_tokens': perf.n_p_eval,
+            # the last sampled token is not evaluated
+            'completion_tokens': perf.n_eval + 1,
+            'prompt_eval_seconds': perf.t_p_eval_ms / 1000,
+            'decode_seconds': perf.t_eval_ms / 1000,
+            'decode_tokens': perf.n_eval,
+            'ttft': (first_token or end_time) - start_time,
+            'latency': end_time - start_time
+        })
+    return {'load_seconds': round(load_seconds, 2), 'peak_rss_mb': peak_rss_mb(), 'per_prompt': measurements}
+
+
+async def run_endpoint(base_url: str, model: str, api_key: str, prompts: List[str], max_tokens: int,
+                       warmup: int) -> dict:
+    """Time prompts one at a time against an OpenAI-compatible endpoint, token counts from its usage fields"""
+    from openai import AsyncOpenAI
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    measurements = []
+    for i, prompt in enumerate(prompts[:warmup] + prompts):
+        start_time, first_token, usage = time.time(), None, None
+        stream = await client.chat.completions.create(
+            model=model, messages=[{"role": "user", "content": prompt}], temperature=0, max_tokens=max_tokens,
+            stream=True, stream_options={'include_usage': True})
+        async for chunk in stream:
+            if first_token is None and chunk.choices and chunk.choices[0].delta.content:
+                first_token = time.time()
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+        end_time = time.time()
+        if i < warmup:
+            continue
+        if usage is None:
+            print("The endpoint reported no usage, token rates are left out")
+        first_token = first_token or end_time
+        measurements.append({
+            'prompt_tokens': usage.prompt_tokens if usage else None,
+            'completion_tokens': usage.completion_tokens if usage else None,
+            # remote evaluation time is only visible as the wait for the first token
+            'prompt_eval_seconds': first_token - start_time,
+            'decode_seconds': end_time - first_token,
+            'decode_tokens': max(0, usage.completion_tokens - 1) if usage else None,
+            'ttft': first_token - start_time,
+            'latency': end_time - start_time
+        })
+    return {'load_seconds': None, 'peak_rss_mb': None, 'per_prompt': measurements}
+
+
+def summarize(measurements: List[dict]) -> dict:
+    """Aggregate rates and latency percentiles of one configuration"""
+    total = lambda name: sum(m[name] or 0 for m in measurements)
+    rate = lambda tokens, seconds: round(tokens / seconds, 2) if seconds else None
+    ttft = np.array([m['ttft'] for m in measurements])
+    latency = np.array([m['latency'] for m in measurements])
+    return {
+        'prompts': len(measurements),
+        'prompt_tokens': total('prompt_tokens'),
+        'completion_tokens': total('completion_tokens'),
+        'prompt_eval_tok_s': rate(total('prompt_tokens'), total('prompt_eval_seconds')),
+        'decode_tok_s': rate(total('decode_tokens'), total('decode_seconds')),
+        'ttft_mean': round(float(ttft.mean()), 3),
+        'ttft_p50': round(float(np.percentile(ttft, 50)), 3),
+        'ttft_p95': round(float(np.percentile(ttft, 95)), 3),
+        'latency_mean': round(float(latency.mean()), 3),
+        'latency_p95': round(float(np.percentile(latency, 95)), 3)
+    }
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark inference on a sample of real prompts and write a '
+                                                 'JSONL report with one record per setting')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--prompt_files', nargs='+', help='Prompt JSONL files or glob patterns')
+    source.add_argument('--prompt', help='A single prompt')
+    parser.add_argument('--num_prompts', type=int, default=20, help='Prompts sampled from the files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max_tokens', type=int, default=250)
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed prompts run first in every setting')
+    parser.add_argument('--model_path', default=None, help=f'GGUF model, {MODEL_NAME} is downloaded if not given')
+    parser.add_argument('--models_dir', default=DEFAULT_MODELS_DIR)
+    parser.add_argument('--n_threads', type=int_list, default=[os.cpu_count()], help='Comma-separated sweep')
+    parser.add_argument('--n_batch', type=int_list, default=[512], help='Comma-separated sweep')
+    parser.add_argument('--n_ctx', type=int_list, default=[2048], help='Comma-separated sweep')
+    parser.add_argument('--n_gpu_layers', type=int, default=-1)
+    parser.add_argument('--keep_prefix', action='store_true',
+                        help='Let consecutive prompts reuse their shared prefix, as the runners do')
+    parser.add_argument('--base_url', default=None,
+                        help='Benchmark an OpenAI-compatible endpoint (e.g. llama_server.py) instead of loading '
+                             'the model; the sweeps do not apply')
+    parser.add_argument('--model', default=MODEL_NAME, help='Model name sent to --base_url')
+    parser.add_argument('--api_key', default=None)
+    parser.add_argument('--output', default='benchmark_report.jsonl', help='Report file, appended to')
+    args = parser.parse_args()
+
+    prompts = [args.prompt] if args.prompt else sample_prompts(args.prompt_files, args.num_prompts, args.seed)
+    if not prompts:
+        print("No prompts found")
+        sys.exit(1)
+    print(f"Benchmarking {len(prompts)} prompts")
+    machine = machine_info()
+
+    if args.base_url:
+        api_key = args.api_key or os.getenv('OPENAI_API_KEY') or 'local'
+        settings = [{'base_url': args.base_url, 'model': args.model}]
+    else:
+        model_path = args.model_path or download_model(MODEL_REPO, MODEL_NAME, args.models_dir)
+        if not model_path:
+            sys.exit(1)
+        settings = [{'n_threads': t, 'n_batch': b, 'n_ctx': c, 'n_gpu_layers': args.n_gpu_layers}
+                    for t, b, c in itertools.product(args.n_threads, args.n_batch, args.n_ctx)]
+
+    with open_text(args.output, 'a') as f:
+        for setting in settings:
+            print(f"\nSetting: {setting}")
+            try:
+                if args.base_url:
+                    result = asyncio.run(run_endpoint(args.base_url, args.model, api_key, prompts, args.max_tokens,
+                                                      args.warmup))
+                else:
+                    # a fresh process per setting, so peak RSS and the page cache state are not inherited
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                        result = executor.submit(run_llama_config, model_path, setting, prompts, args.max_tokens,
+                                                 args.warmup, args.keep_prefix).result()
+            except Exception as e:
+                print(f"Error benchmarking {setting}: {str(e)}")
+                continue
+            record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': machine,
+                      'model': os.path.basename(args.model_path or MODEL_NAME) if not args.base_url else args.model,
+                      'setting': setting, 'max_tokens': args.max_tokens, 'keep_prefix': args.keep_prefix,
+                      'load_seconds': result['load_seconds'], 'peak_rss_mb': result['peak_rss_mb'],
+                      **summarize(result['per_prompt']), 'per_prompt': result['per_prompt']}
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            print(json.dumps({k: v for k, v in record.items() if k not in ('machine', 'per_prompt')}, indent=2))
+    print(f"Report appended to {args.output}")
@@ -0,0 +1,205 @@
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.jsonl_io import iter_jsonl
+from common.triple_parser import parse_line_triples, parse_triples
+from evaluation.run_eval import calculate_precision_recall_f1, normalize_triple
+from streaming import IncrementalTripleParser
+
+
+def legacy_parse_triples(response_text: str) -> List[List[str]]:
+    """The parser the runners used before triple_parser, kept as the baseline"""
+    triples = []
+    lines = response_text.strip().split('\n')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if '(' in line and ')' in line:
+            try:
+                relation_part, args_part = line.split('(', 1)
+                args_part = args_part.rstrip(')')
+                args = args_part.split(',', 1)
+                if len(args) == 2:
+                    sub = args[0].strip()
+                    obj = args[1].strip()
+                    rel = relation_part.strip()
+                    triples.append([sub, rel, obj])
+            except Exception as e:
+                print(f"Error parsing line: {line}, Error: {str(e)}")
+    return triples
+
+
+def regression(responses: List[str], examples: int) -> None:
+    """Compare both parsers line by line on stored responses and time them on the whole corpus"""
+    categories = {'same': 0, 'changed': 0, 'only_new': 0, 'only_legacy': 0, 'neither': 0}
+    samples = {name: [] for name in categories}
+    for response in responses:
+        for line in response.splitlines():
+            if not line.strip():
+                continue
+            old, new = legacy_parse_triples(line), parse_line_triples(line)
+            if not old and not new:
+                name = 'neither'
+            elif not old:
+                name = 'only_new'
+            elif not new:
+                name = 'only_legacy'
+            else:
+                name = 'same' if old == new else 'changed'
+            categories[name] += 1
+            if len(samples[name]) < examples:
+                samples[name].append((line.strip()[:120], old, new))
+    print(f"Lines: {json.dumps(categories)}")
+    # the streaming parser feeds lines to parse_line_triples, both must agree on whole responses
+    inconsistent = [r for r in responses
+                    if parse_triples(r) != [t for line in r.splitlines() for t in parse_line_triples(line)]]
+    print(f"Responses where parse_triples and parse_line_triples disagree: {len(inconsistent)}")
+    for response in inconsistent[:examples]:
+        print(f"  {response[:200]!r}")
+    for name in ('changed', 'only_new', 'only_legacy'):
+        for line, old, new in samples[name]:
+            print(f"  [{name}] {line}\n      legacy: {old}\n      new:    {new}")
+
+    for name, parse in (('legacy', legacy_parse_triples), ('new', parse_triples)):
+        best = min(timed(parse, responses) for _ in range(3))
+        print(f"{name} parser: {len(responses)} responses in {best * 1000:.1f} ms")
+
+
+def ground_truth_scores(records: List[Dict], ground_truth: Dict[str, Dict]) -> None:
+    """Average precision, recall and F1 of both parsers on the responses that have ground truth, scored the way
+    run_eval scores a sentence"""
+    scored = [(record, ground_truth[record['id']]) for record in records if record.get('id') in ground_truth]
+    for name, parse in (('legacy', legacy_parse_triples), ('new', parse_triples)):
+        totals = [0.0, 0.0, 0.0]
+        for record, gt_record in scored:
+            gt_triples = [[tr['sub'], tr['rel'], tr['obj']] for tr in gt_record['triples']]
+            gt_relations = {tr[1].replace(" ", "_") for tr in gt_triples}
+            system_triples = [tr for tr in parse(record['response']) if tr[1] in gt_relations]
+            scores = calculate_precision_recall_f1({normalize_triple(*tr) for tr in gt_triples},
+                                                   {normalize_triple(*tr) for tr in system_triples})
+            totals = [total + score for total, score in zip(totals, scores)]
+        precision, recall, f1 = (total / max(len(scored), 1) for total in totals)
+        print(f"{name} parser on {len(scored)} responses with ground truth: precision {precision:.4f}, "
+              f"recall {recall:.4f}, f1 {f1:.4f}")
+
+
+def load_ground_truth(response_paths: List[str]) -> Dict[str, Dict]:
+    """Ground truth records by id of the datasets the response files belong to, data/<dataset>/ground_truth"""
+    ground_truth = {}
+    dataset_dirs = {path.split(f"{os.sep}baselines{os.sep}")[0] for path in response_paths}
+    for dataset_dir in sorted(dataset_dirs):
+        for path in glob.glob(os.path.join(dataset_dir, 'ground_truth', '*.jsonl')):
+            ground_truth.update((r['id'], r) for r in iter_jsonl(path, skip_invalid=True))
+    return ground_truth
+
+
+def timed(parse, responses: List[str]) -> float:
+    start_time = time.perf_counter()
+    for response in responses:
+        parse(response)
+    return time.perf_counter() - start_time
+
+
+NAME_PARTS = ['Alan Turing', 'Dune', 'Never Say Never (1998)', 'Part A, B', 'Why (Must We Fall)', "C'mon N' Ride",
+              'BWV 1043', 'New York', 'x', 'The "Great" One', 'Symphony No. 5', 'Coma Berenices']
+RELATIONS = ['author', 'took_place_at', 'part_of', 'languages_spoken,_written_or_signed', 'composer']
+FORMATS = ['{t}', '- {t}', '* {t}', '{n}. {t}', '{n}) {t}', '**{t}**', '`{t}`', '{t}.', '({t})']
+# lines with an empty relation or text after the triple, and what each must parse to
+EDGE_LINES = {' (Paris, France)': [], '\t(a, b)': [], '(a, b)': [], '()': [], ' (,)': [],
+              'country(Paris, France) and more': [['Paris', 'country', 'France']],
+              'foo(a, b), bar(c, d)': [['a', 'foo', 'b'], ['c', 'bar', 'd']],
+              'rel(a, "b)': [['a', 'rel', 'b']]}
+
+
+def render_arg(name: str, is_subject: bool) -> str:
+    # unquoted subjects end at the first comma and double quotes are quoting, so such names get quoted
+    if '"' in name:
+        return name
+    if is_subject and ',' in name:
+        return f'"{name}"'
+    return name
+
+
+def fuzz(iterations: int, seed: int) -> int:
+    """Render random triples with the formatting models produce and check they parse back; also feed the text
+    to the incremental parser in random chunks"""
+    rng = random.Random(seed)
+    failures = 0
+    for line, wanted in EDGE_LINES.items():
+        for text in (line, f"```\n{line}\n```"):
+            try:
+                parsed = parse_triples(text)
+            except Exception as e:
+                parsed = f"{type(e).__name__}: {e}"
+            if parsed != wanted:
+                failures += 1
+                print(f"Edge case mismatch: {text!r}\n  expected {wanted}\n  parsed   {parsed}")
+    for _ in range(iterations):
+        expected, lines = [], []
+        if rng.random() < 0.3:
+            lines.append('```')
+        for n in range(1, rng.randint(1, 6) + 1):
+            subject = rng.choice([p for p in NAME_PARTS if '"' not in p])
+            obj = rng.choice(NAME_PARTS)
+            relation = rng.choice(RELATIONS)
+            expected.append([subject, relation, obj])
+            triple = f"{relation}({render_arg(subject, True)}, {render_arg(obj, False)})"
+            lines.append(rng.choice(FORMATS).format(t=triple, n=n))
+            if rng.random() < 0.1:
+                lines.append('')
+        if lines[0] == '```':
+            lines.append('```')
+        if rng.random() < 0.3:
+            lines.insert(0, 'Here are the triples (one per line):')
+        text = '\n'.join(lines)
+
+        parsed = parse_triples(text)
+        if parsed != expected:
+            failures += 1
+            if failures <= 5:
+                print(f"Fuzz mismatch:\n{text}\n  expected {expected}\n  parsed   {parsed}")
+            continue
+        parser = IncrementalTripleParser()
+        position = 0
+        while position < len(text):
+            size = rng.randint(1, 8)
+            parser.feed(text[position:position + size])
+            position += size
+        if parser.finish() != expected:
+            failures += 1
+            if failures <= 5:
+                print(f"Incremental mismatch:\n{text}\n  expected {expected}\n  parsed   {parser.triples}")
+    print(f"Fuzz: {iterations - failures} of {iterations} generated responses parsed exactly")
+    return failures
+
+
+if __name__ == "__main__":
+    default_pattern = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'data', '**',
+                                   'llm_responses', '*.jsonl*')
+    parser = argparse.ArgumentParser(description='Compare the triple parser with the legacy one on stored '
+                                                 'responses and fuzz it with generated ones')
+    parser.add_argument('--responses', default=default_pattern, help='Glob of response JSONL files')
+    parser.add_argument('--examples', type=int, default=5, help='Examples shown per category of difference')
+    parser.add_argument('--fuzz_iterations', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.responses, recursive=True))
+    records = []
+    for path in paths:
+        records += [r for r in iter_jsonl(path, skip_invalid=True) if isinstance(r.get('response'), str)]
+    responses = [r['response'] for r in records]
+    print(f"Regression corpus: {len(responses)} stored responses")
+    if responses:
+        regression(responses, args.examples)
+        ground_truth_scores(records, load_ground_truth([os.path.normpath(path) for path in paths]))
+    sys.exit(1 if fuzz(args.fuzz_iterations, args.seed) else 0)
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List
+
+from llama_cpp import Llama
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.jsonl_io import iter_jsonl
+from speculative import SPECULATIVE_MODES, make_draft_model
+
+
+def decode(llm: Llama, prompts: List[str], max_tokens: int) -> dict:
+    """Greedy answers of all prompts with wall time and generated token count"""
+    responses, completion_tokens = [], 0
+    start_time = time.time()
+    for prompt in prompts:
+        response = llm.create_chat_completion(messages=[{"role": "user", "content": prompt}], temperature=0,
+                                              max_tokens=max_tokens)
+        responses.append(response['choices'][0]['message']['content'])
+        completion_tokens += response['usage']['completion_tokens']
+    seconds = time.time() - start_time
+    return {'responses': responses, 'seconds': seconds, 'completion_tokens': completion_tokens,
+            'tokens_per_second': completion_tokens / seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare plain and speculative greedy decoding on a prompt file')
+    parser.add_argument('--model_path', required=True, help='Target GGUF model')
+    parser.add_argument('--prompt_file', required=True, help='Prompt JSONL file, optionally compressed')
+    parser.add_argument('--num_prompts', type=int, default=10)
+    parser.add_argument('--speculative', choices=SPECULATIVE_MODES, default='prompt_lookup')
+    parser.add_argument('--draft_model_path', default=None, help='Draft GGUF model for --speculative draft_model')
+    parser.add_argument('--num_draft_tokens', type=int, default=None)
+    parser.add_argument('--max_tokens', type=int, default=250)
+    parser.add_argument('--n_ctx', type=int, default=2048)
+    parser.add_argument('--n_threads', type=int, default=os.cpu_count())
+    parser.add_argument('--n_gpu_layers', type=int, default=-1)
+    args = parser.parse_args()
+
+    prompts = [record['prompt'] for record in iter_jsonl(args.prompt_file) if record.get('prompt')][:args.num_prompts]
+    llama_kwargs = dict(model_path=args.model_path, n_ctx=args.n_ctx, n_threads=args.n_threads,
+                        n_gpu_layers=args.n_gpu_layers, verbose=False)
+
+    # one model at a time, the second load maps the weights from the page cache
+    plain = decode(Llama(**llama_kwargs), prompts, args.max_tokens)
+    draft_model = make_draft_model({'mode': args.speculative, 'num_pred_tokens': args.num_draft_tokens,
+                                    'model_path': args.draft_model_path}, llama_kwargs)
+    speculative = decode(Llama(**llama_kwargs, draft_model=draft_model), prompts, args.max_tokens)
+
+    mismatches = [i for i, (a, b) in enumerate(zip(plain['responses'], speculative['responses'])) if a != b]
+    stats = draft_model.stats
+    report = {
+        'mode': args.speculative,
+        'prompts': len(prompts),
+        'plain_tokens_per_second': round(plain['tokens_per_second'], 2),
+        'speculative_tokens_per_second': round(speculative['tokens_per_second'], 2),
+        'speedup': round(plain['seconds'] / speculative['seconds'], 3),
+        'drafted_tokens': stats['proposed'],
+        'accepted_tokens': stats['accepted'],
+        'acceptance_rate': round(stats['accepted'] / max(stats['proposed'], 1), 3),
+        'identical_outputs': len(prompts) - len(mismatches)
+    }
+    print(json.dumps(report, indent=2))
+    for i in mismatches:
+        print(f"\nOutput {i} differs\nplain:       {plain['responses'][i]!r}\nspeculative: {speculative['responses'][i]!r}")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,279 @@
+import argparse
+import ast
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', '..'))
+from common.jsonl_io import iter_jsonl, open_text
+from common.triple_parser import parse_triples
+from openai_stub_server import format_triples, load_ground_truth
+
+RUNNER = os.path.join(TEST_DIR, '..', 'gen_responses_gpt-4o.py')
+STUB = os.path.join(TEST_DIR, 'openai_stub_server.py')
+# a loaded API: lognormal time to first token, then a steady generation speed
+BASE_STUB_ARGS = ['--latency', '0.6', '--latency_jitter', '0.4', '--latency_distribution', 'lognormal',
+                  '--tokens_per_second', '60']
+# the runner's own limits are off unless a scenario tests them, so the stub's behaviour decides throughput
+BASE_RUNNER_ARGS = ['--rpm', '0', '--tpm', '0']
+# replaced by an --rpm derived from the sample size, see throttle_rpm
+THROTTLE_RPM = '$throttle_rpm'
+SCENARIOS = {
+    'baseline': {'stub': [], 'runner': []},
+    'rate_limited': {'stub': ['--rpm', '30', '--retry_after', '10'], 'runner': []},
+    'server_errors': {'stub': ['--error_rate', '0.1'], 'runner': []},
+    'dropped_connections': {'stub': ['--drop_rate', '0.1'], 'runner': []},
+    'long_tail': {'stub': ['--latency', '1.0', '--latency_jitter', '3.0'], 'runner': []},
+    'streaming': {'stub': ['--drop_rate', '0.05'], 'runner': ['--stream']},
+    # the runner's request bucket holds half the sample, the other half waits for the bucket to refill
+    'client_throttled': {'stub': [], 'runner': ['--rpm', THROTTLE_RPM, '--tpm', '0']},
+    'batch': {'stub': ['--batch_seconds', '4'], 'runner': ['--mode', 'batch', '--poll_interval', '1']},
+}
+_PROCESSED = re.compile(r'^Processed prompt \S+ in ([\d.]+) seconds', re.MULTILINE)
+_QUERIED = re.compile(r'^Queried \d+ prompts in [\d.]+ seconds \((\{.*\})\)$', re.MULTILINE)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def sample_prompts(config: dict, num_prompts: int, seed: int) -> Dict[str, List[dict]]:
+    """A reproducible sample of the config's prompts, spread over its ontologies"""
+    prompts = []
+    for onto in config['onto_list']:
+        prompt_file = config['path_patterns']['prompt'].replace('$$onto$$', onto)
+        if os.path.exists(prompt_file):
+            prompts += [(onto, record) for record in iter_jsonl(prompt_file, skip_invalid=True)
+                        if record.get('id') and record.get('prompt')]
+    if num_prompts and len(prompts) > num_prompts:
+        prompts = random.Random(seed).sample(prompts, num_prompts)
+    by_onto = {}
+    for onto, record in prompts:
+        by_onto.setdefault(onto, []).append(record)
+    return by_onto
+
+
+def write_workspace(work_dir: str, prompts_by_onto: Dict[str, List[dict]]) -> str:
+    """Prompt files and a prompt generation config under work_dir, responses go to work_dir as well"""
+    prompt_dir = os.path.join(work_dir, 'data', 'load_test', 'baselines', 'prompts')
+    os.makedirs(prompt_dir, exist_ok=True)
+    for onto, prompts in prompts_by_onto.items():
+        with open_text(os.path.join(prompt_dir, f'ont_{onto}_prompts.jsonl'), 'w') as f:
+            for record in prompts:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    config_path = os.path.join(work_dir, 'load_test_config.json')
+    with open(config_path, 'w') as f:
+        json.dump({'onto_list': list(prompts_by_onto),
+                   'path_patterns': {'prompt': os.path.join(prompt_dir, 'ont_$$onto$$_prompts.jsonl')}}, f)
+    return config_path
+
+
+def wait_for_stub(base_url: str, stub: subprocess.Popen, timeout: float = 60) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline and stub.poll() is None:
+        try:
+            with urllib.request.urlopen(f"{base_url}/stats", timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def stub_stats(base_url: str) -> Optional[dict]:
+    try:
+        with urllib.request.urlopen(f"{base_url}/stats", timeout=5) as response:
+            return json.loads(response.read())
+    except OSError:
+        return None
+
+
+def expected_triples(prompt: str, ground_truth: Dict[str, List[dict]]) -> Optional[List[List[str]]]:
+    """What the runner should record for a prompt the stub answers from ground truth"""
+    match = re.search(r'^Test Sentence: (.*)$', prompt, re.MULTILINE)
+    if not match or match.group(1).strip() not in ground_truth:
+        return None
+    sentence = match.group(1).strip()
+    return parse_triples('\n'.join(format_triples(sentence, ground_truth[sentence], 1.0)))
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    values = np.array(values)
+    return {'p50': round(float(np.percentile(values, 50)), 3), 'p95': round(float(np.percentile(values, 95)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3), 'max': round(float(values.max()), 3)}
+
+
+def throttle_rpm(total: int) -> int:
+    """Runner --rpm whose bucket, which holds one minute of requests, is full after half the prompts"""
+    return max(1, total // 2)
+
+
+def min_throttled_seconds(rpm: int, total: int) -> float:
+    """Least wall time of a run whose requests beyond the bucket's capacity wait for it to refill"""
+    return max(0, total - rpm) * 60 / rpm
+
+
+def run_scenario(name: str, scenario: dict, config_path: str, work_dir: str, prompts_by_onto: Dict[str, List[dict]],
+                 ground_truth_patterns: List[str], ground_truth: Dict[str, List[dict]], concurrency: int,
+                 timeout: float) -> dict:
+    """Start a stub with the scenario's settings, run the GPT-4o runner against it and measure the run"""
+    total = sum(len(prompts) for prompts in prompts_by_onto.values())
+    rpm, throttled_run = throttle_rpm(total), THROTTLE_RPM in scenario['runner']
+    scenario = {side: [str(rpm) if arg == THROTTLE_RPM else arg for arg in args] for side, args in scenario.items()}
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/v1"
+    stub_args = [sys.executable, STUB, '--port', str(port), '--ground_truth', *ground_truth_patterns,
+                 *BASE_STUB_ARGS, *scenario['stub']]
+    baseline_name = f"LoadTest-{name}"
+    runner_args = [sys.executable, RUNNER, '--prompt_gen_config_path', config_path, '--base_url', base_url,
+                   '--api_key', 'load-test', '--baseline_name', baseline_name, '--overwrite', '--no_cache',
+                   '--concurrency', str(concurrency), *BASE_RUNNER_ARGS, *scenario['runner']]
+    log_path = os.path.join(work_dir, f'{name}.log')
+    stub = subprocess.Popen(stub_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_stub(f"http://127.0.0.1:{port}", stub):
+            raise RuntimeError("the stub server did not start")
+        start_time = time.time()
+        try:
+            run = subprocess.run(runner_args, capture_output=True, text=True, timeout=timeout,
+                                 cwd=os.path.dirname(RUNNER))
+            output, exit_code = run.stdout + run.stderr, run.returncode
+        except subprocess.TimeoutExpired as e:
+            output, exit_code = (e.stdout or b'').decode('utf-8', 'replace'), 'timeout'
+        wall_seconds = time.time() - start_time
+        stats = stub_stats(f"http://127.0.0.1:{port}") or {}
+    finally:
+        stub.terminate()
+        stub.wait()
+    with open(log_path, 'w') as f:
+        f.write(output)
+
+    response_dir = os.path.join(work_dir, 'data', 'load_test', 'baselines', baseline_name, 'llm_responses')
+    answered, correct, checked = 0, 0, 0
+    for onto, prompts in prompts_by_onto.items():
+        response_file = os.path.join(response_dir, f'ont_{onto}_responses.jsonl')
+        records = {r['id']: r for r in iter_jsonl(response_file, skip_invalid=True)} \
+            if os.path.exists(response_file) else {}
+        for prompt_data in prompts:
+            record = records.get(prompt_data['id'])
+            if record is None:
+                continue
+            answered += 1
+            expected = expected_triples(prompt_data['prompt'], ground_truth)
+            if expected is not None:
+                checked += 1
+                correct += record.get('triples') == expected
+
+    # the runner's statistics are cumulative, the last ontology's line covers the run
+    runner_stats = _QUERIED.findall(output)
+    # a throttled run that finishes sooner than its bucket allows did not throttle
+    throttled = wall_seconds >= min_throttled_seconds(rpm, total) * 0.9 if throttled_run else None
+    return {
+        'scenario': name, 'stub_args': scenario['stub'], 'runner_args': scenario['runner'], 'exit_code': exit_code,
+        'prompts': total, 'answered': answered, 'throttled': throttled,
+        'passed': answered == total and exit_code == 0 and throttled is not False,
+        # answers that match the stub's ground truth, anything else means a response reached the wrong prompt
+        'correct': round(correct / checked, 4) if checked else None,
+        'wall_seconds': round(wall_seconds, 2),
+        'prompts_per_second': round(answered / wall_seconds, 2) if wall_seconds else None,
+        'completion_tokens_per_second': round(stats.get('completion_tokens', 0) / wall_seconds, 1)
+        if wall_seconds else None,
+        'latency': percentiles([float(v) for v in _PROCESSED.findall(output)]),
+        'runner': ast.literal_eval(runner_stats[-1]) if runner_stats else None,
+        'stub': stats, 'log': log_path
+    }
+
+
+def print_table(results: List[dict]) -> None:
+    header = f"{'scenario':<20} {'answered':>9} {'correct':>8} {'wall s':>8} {'prompts/s':>10} {'tok/s':>8} " \
+             f"{'p50':>7} {'p95':>7} {'p99':>7} {'retries':>8} {'429':>5} {'5xx':>5} {'drops':>6} {'result':>6}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        latency, runner, stub = r['latency'], r['runner'] or {}, r['stub']
+        print(f"{r['scenario']:<20} {r['answered']:>4}/{r['prompts']:<4} {str(r['correct']):>8} "
+              f"{r['wall_seconds']:>8} {str(r['prompts_per_second']):>10} {str(r['completion_tokens_per_second']):>8} "
+              f"{str(latency.get('p50', '-')):>7} {str(latency.get('p95', '-')):>7} {str(latency.get('p99', '-')):>7} "
+              f"{str(runner.get('retries', '-')):>8} {stub.get('rate_limited', '-'):>5} "
+              f"{stub.get('server_errors', '-'):>5} {stub.get('dropped', '-'):>6} "
+              f"{'ok' if r['passed'] else 'FAIL':>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load-test gen_responses_gpt-4o.py against the local stub server '
+                                                 'under a suite of latency and failure scenarios; run from '
+                                                 'src/baselines like the runners')
+    parser.add_argument('--prompt_gen_config_path', default='config/dbpedia_webnlg_prompt_gen_config.json',
+                        help='Config whose prompts are sampled')
+    parser.add_argument('--ground_truth', nargs='*', default=None,
+                        help='Ground truth JSONL files or globs the stub answers from, by default the ground_truth '
+                             'directory of the config\'s dataset')
+    parser.add_argument('--num_prompts', type=int, default=200, help='Prompts sampled from the config')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=16, help='Runner --concurrency')
+    parser.add_argument('--timeout', type=float, default=900, help='Seconds before a scenario run is abandoned')
+    parser.add_argument('--work_dir', default=None, help='Keep prompts, responses and runner logs here')
+    parser.add_argument('--output', default='load_test_report.jsonl', help='Report file, appended to')
+    args = parser.parse_args()
+
+    with open(args.prompt_gen_config_path) as f:
+        config = json.load(f)
+    ground_truth_patterns = args.ground_truth
+    if ground_truth_patterns is None:
+        base_path = config['path_patterns']['prompt'].split('/baselines')[0]
+        ground_truth_patterns = [os.path.abspath(os.path.join(base_path, 'ground_truth', '*.jsonl'))]
+    ground_truth_patterns = [os.path.abspath(p) for p in ground_truth_patterns]
+    ground_truth = load_ground_truth(ground_truth_patterns)
+
+    prompts_by_onto = sample_prompts(config, args.num_prompts, args.seed)
+    if not prompts_by_onto:
+        print("No prompts found")
+        sys.exit(1)
+    if 'client_throttled' in args.scenarios and len(prompts_by_onto) < 2:
+        # the runner queries ontologies one after the other, the bucket must carry over between them
+        print("Warning: client_throttled samples a single ontology, raise --num_prompts to cover several")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='load_test_')
+    config_path = write_workspace(work_dir, prompts_by_onto)
+    print(f"{sum(map(len, prompts_by_onto.values()))} prompts of {len(prompts_by_onto)} ontologies, "
+          f"ground truth of {len(ground_truth)} sentences, workspace {work_dir}")
+
+    results = []
+    with open_text(args.output, 'a') as f:
+        for name in args.scenarios:
+            print(f"\nScenario {name}: stub {' '.join(SCENARIOS[name]['stub']) or '(base)'}, "
+                  f"runner {' '.join(SCENARIOS[name]['runner']) or '(base)'}")
+            try:
+                result = run_scenario(name, SCENARIOS[name], config_path, work_dir, prompts_by_onto,
+                                      ground_truth_patterns, ground_truth, args.concurrency, args.timeout)
+            except Exception as e:
+                print(f"Error running scenario {name}: {str(e)}")
+                continue
+            results.append(result)
+            f.write(json.dumps({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), **result}) + '\n')
+            f.flush()
+            print(json.dumps({k: v for k, v in result.items() if k not in ('stub_args', 'runner_args', 'stub')}))
+
+    print()
+    print_table(results)
+    print(f"Report appended to {args.output}")
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    # every prompt answered, a clean runner exit and, for client_throttled, a run as slow as its limit
+    sys.exit(0 if results and len(results) == len(args.scenarios) and all(r['passed'] for r in results) else 1)
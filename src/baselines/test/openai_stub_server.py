@@ -0,0 +1,398 @@
+import argparse
+import email.parser
+import email.policy
+import glob
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.jsonl_io import iter_jsonl
+
+LATENCY_DISTRIBUTIONS = ('normal', 'lognormal', 'exponential', 'constant')
+# test sentences of single and packed prompts, "Test Sentence: ..." and "Test Sentence [2]: ..."
+_TEST_SENTENCE = re.compile(r'^Test Sentence(?: \[(\d+)\])?: (.*)$', re.MULTILINE)
+
+
+def load_ground_truth(patterns: List[str]) -> Dict[str, List[dict]]:
+    """Sentence text -> ground truth triples of (optionally compressed) ground truth JSONL files"""
+    triples = {}
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            for record in iter_jsonl(path, skip_invalid=True):
+                if isinstance(record, dict) and record.get('sent'):
+                    triples[record['sent'].strip()] = record.get('triples') or []
+    return triples
+
+
+def keep_triple(sentence: str, triple: dict, recall: float) -> bool:
+    """Deterministic choice of the triples a simulated model finds"""
+    if recall >= 1:
+        return True
+    key = json.dumps([sentence, triple], sort_keys=True).encode('utf-8')
+    return int(hashlib.sha1(key).hexdigest()[:8], 16) / 0xffffffff < recall
+
+
+def format_triples(sentence: str, triples: List[dict], recall: float) -> List[str]:
+    """
+    Triple lines written like the examples in the prompts: entities with spaces for underscores, relations as
+    the prompt's relation list spells them; subjects with a comma are quoted so they parse
+    """
+    lines = []
+    for t in triples:
+        if not keep_triple(sentence, t, recall):
+            continue
+        sub = t.get('sub', '').replace('_', ' ')
+        sub = f'"{sub}"' if ',' in sub else sub
+        lines.append(f"{t.get('rel', '')}({sub}, {t.get('obj', '').replace('_', ' ')})")
+    return lines
+
+
+class StubState:
+    """Counters and failure settings shared by all request handler threads"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.RLock()
+        self.counts = {'requests': 0, 'ok': 0, 'rate_limited': 0, 'server_errors': 0, 'dropped': 0,
+                       'streams_closed_early': 0, 'ground_truth_answers': 0, 'canned_answers': 0,
+                       'prompt_tokens': 0, 'completion_tokens': 0}
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        # uploaded and generated files by id, as (metadata, content)
+        self.files = {}
+        self.batches = {}
+        self.ground_truth = load_ground_truth(args.ground_truth) if args.ground_truth else {}
+        if args.ground_truth:
+            print(f"Loaded ground truth triples of {len(self.ground_truth)} sentences")
+
+    def latency(self) -> float:
+        """Time to the first token drawn from the configured distribution, --latency is its mean"""
+        mean, jitter = self.args.latency, self.args.latency_jitter
+        with self.lock:
+            if self.args.latency_distribution == 'constant' or mean <= 0:
+                return max(0.0, mean)
+            if self.args.latency_distribution == 'exponential':
+                return self.rng.expovariate(1 / mean)
+            if self.args.latency_distribution == 'lognormal':
+                # parameters that give the requested mean and standard deviation
+                sigma = math.sqrt(math.log(1 + (jitter / mean) ** 2))
+                return self.rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+            return max(0.0, self.rng.gauss(mean, jitter))
+
+    def answer(self, prompt: str) -> str:
+        """
+        The ground truth triples of the prompt's test sentences, one per line, under [k] markers for packed
+        prompts; --response for prompts with unknown sentences
+        """
+        sentences = _TEST_SENTENCE.findall(prompt)
+        if not sentences or any(sentence.strip() not in self.ground_truth for _, sentence in sentences):
+            self.count('canned_answers')
+            return self.args.response
+        self.count('ground_truth_answers')
+        lines = []
+        for slot, sentence in sentences:
+            if slot:
+                lines.append(f"[{slot}]")
+            lines += format_triples(sentence.strip(), self.ground_truth[sentence.strip()], self.args.recall)
+        return '\n'.join(lines)
+
+    def draw(self) -> float:
+        with self.lock:
+            return self.rng.random()
+
+    def over_rpm(self) -> bool:
+        """Fixed one-minute window request limit, like the per-minute limits of the real API"""
+        if not self.args.rpm:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start, self.window_requests = now, 0
+            self.window_requests += 1
+            return self.window_requests > self.args.rpm
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counts[key] += amount
+
+    def count_usage(self, usage: dict) -> None:
+        self.count('prompt_tokens', usage['prompt_tokens'])
+        self.count('completion_tokens', usage['completion_tokens'])
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        meta = {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose}
+        with self.lock:
+            self.files[file_id] = (meta, content)
+        return meta
+
+    def answer_batch_line(self, line: dict) -> dict:
+        """Result line of one batch request; failures use the same error rate as online requests"""
+        result = {'id': f"batch_req_{uuid.uuid4().hex[:24]}", 'custom_id': line.get('custom_id'), 'error': None}
+        if self.draw() < self.args.error_rate:
+            result['response'] = {'status_code': 500, 'request_id': uuid.uuid4().hex,
+                                  'body': {'error': {'message': 'The server had an error', 'type': 'server_error'}}}
+            return result
+        body = line.get('body', {})
+        prompt = ''.join(m.get('content', '') for m in body.get('messages', []))
+        result['response'] = {'status_code': 200, 'request_id': uuid.uuid4().hex,
+                              'body': completion_body(body.get('model', 'stub'), prompt, self.answer(prompt))}
+        self.count_usage(result['response']['body']['usage'])
+        return result
+
+    def batch_view(self, batch_id: str) -> dict:
+        """Advance a batch through validating, in_progress and completed based on its age"""
+        with self.lock:
+            return self._advance_batch(self.batches[batch_id])
+
+    def _advance_batch(self, batch: dict) -> dict:
+        age = time.time() - batch['created_at']
+        if batch['status'] == 'validating' and age >= self.args.batch_seconds / 2:
+            batch['status'] = 'in_progress'
+            batch['in_progress_at'] = int(time.time())
+        if batch['status'] == 'in_progress' and age >= self.args.batch_seconds:
+            _, content = self.files[batch['input_file_id']]
+            lines = [json.loads(line) for line in content.decode('utf-8').splitlines() if line.strip()]
+            results = [self.answer_batch_line(line) for line in lines]
+            ok = [r for r in results if r['response']['status_code'] == 200]
+            failed = [r for r in results if r['response']['status_code'] != 200]
+            to_jsonl = lambda rows: ''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8')
+            batch['output_file_id'] = self.add_file('batch_output.jsonl', 'batch_output', to_jsonl(ok))['id']
+            if failed:
+                batch['error_file_id'] = self.add_file('batch_errors.jsonl', 'batch_output', to_jsonl(failed))['id']
+            batch['request_counts'] = {'total': len(results), 'completed': len(ok), 'failed': len(failed)}
+            batch['status'] = 'completed'
+            batch['completed_at'] = int(time.time())
+        return batch
+
+
+def completion_body(model: str, prompt: str, content: str) -> dict:
+    prompt_tokens = len(prompt) // 4 + 1
+    completion_tokens = len(content) // 4 + 1
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens}
+    }
+
+
+def stream_chunks(model: str, prompt: str, content: str, include_usage: bool, chars_per_chunk: int = 4):
+    """chat.completion.chunk events of a streamed completion, about one token per chunk"""
+    base = {'id': f"chatcmpl-{uuid.uuid4().hex[:24]}", 'object': 'chat.completion.chunk',
+            'created': int(time.time()), 'model': model}
+    yield {**base, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]}
+    for start in range(0, len(content), chars_per_chunk):
+        yield {**base, 'choices': [{'index': 0, 'delta': {'content': content[start:start + chars_per_chunk]},
+                                    'finish_reason': None}]}
+    yield {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+    if include_usage:
+        yield {**base, 'choices': [], 'usage': completion_body(model, prompt, content)['usage']}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /v1/chat/completions endpoint with configurable latency and failures"""
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, body: dict, headers: dict = None) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str, error_type: str, headers: dict = None) -> None:
+        self.send_json(status, {'error': {'message': message, 'type': error_type, 'code': None}}, headers)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        parts = path.split('/')
+        if path in ('/stats', '/v1/stats'):
+            self.send_json(200, self.state.counts)
+        elif path.startswith('/v1/batches/') and parts[3] in self.state.batches:
+            self.send_json(200, self.state.batch_view(parts[3]))
+        elif path.startswith('/v1/files/') and len(parts) == 5 and parts[4] == 'content' \
+                and parts[3] in self.state.files:
+            content = self.state.files[parts[3]][1]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif path.startswith('/v1/files/') and parts[3] in self.state.files:
+            self.send_json(200, self.state.files[parts[3]][0])
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}", 'invalid_request_error')
+
+    def do_POST(self):
+        path = self.path.rstrip('/')
+        if path == '/v1/chat/completions':
+            self.chat_completion()
+        elif path == '/v1/files':
+            self.upload_file()
+        elif path == '/v1/batches':
+            self.create_batch()
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}", 'invalid_request_error')
+
+    def upload_file(self):
+        """multipart/form-data upload with a "purpose" field and a "file" part"""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8')
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + self.read_body())
+        fields, filename, content = {}, 'upload.jsonl', b''
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'file':
+                filename = part.get_filename() or filename
+                content = part.get_payload(decode=True)
+            else:
+                fields[name] = part.get_content().strip()
+        self.send_json(200, self.state.add_file(filename, fields.get('purpose', 'batch'), content))
+
+    def create_batch(self):
+        request = json.loads(self.read_body() or b'{}')
+        if request.get('input_file_id') not in self.state.files:
+            self.send_error_json(400, f"No such file: {request.get('input_file_id')}", 'invalid_request_error')
+            return
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': request.get('endpoint'), 'errors': None,
+                 'input_file_id': request['input_file_id'], 'completion_window': request.get('completion_window'),
+                 'status': 'validating', 'output_file_id': None, 'error_file_id': None,
+                 'created_at': int(time.time()), 'in_progress_at': None, 'completed_at': None,
+                 'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+                 'metadata': request.get('metadata')}
+        with self.state.lock:
+            self.state.batches[batch_id] = batch
+        self.send_json(200, batch)
+
+    def chat_completion(self):
+        args = self.state.args
+        request = json.loads(self.read_body() or b'{}')
+        self.state.count('requests')
+
+        if self.state.over_rpm() or self.state.draw() < args.rate_limit_rate:
+            self.state.count('rate_limited')
+            self.send_error_json(429, 'Rate limit reached', 'rate_limit_error',
+                                 {'retry-after': str(args.retry_after)})
+            return
+        if self.state.draw() < args.error_rate:
+            self.state.count('server_errors')
+            self.send_error_json(500, 'The server had an error processing the request', 'server_error')
+            return
+
+        prompt = ''.join(m.get('content', '') for m in request.get('messages', []))
+        content = self.state.answer(prompt)
+        dropped = self.state.draw() < args.drop_rate
+        time.sleep(self.state.latency())
+        if request.get('stream'):
+            self.send_stream(request, prompt, content, dropped)
+            return
+        if args.tokens_per_second:
+            time.sleep(completion_body('', prompt, content)['usage']['completion_tokens'] / args.tokens_per_second)
+        if dropped:
+            # the connection closes without a response, clients see a connection error
+            self.state.count('dropped')
+            self.close_connection = True
+            return
+        self.state.count('ok')
+        body = completion_body(request.get('model', 'stub'), prompt, content)
+        self.state.count_usage(body['usage'])
+        self.send_json(200, body)
+
+    def send_stream(self, request: dict, prompt: str, content: str, dropped: bool = False) -> None:
+        """Server-sent events, one chunk (about a token) every --chunk_seconds or at --tokens_per_second; the
+        connection closes after [DONE], or halfway through the content when dropped"""
+        include_usage = bool((request.get('stream_options') or {}).get('include_usage'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+        args = self.state.args
+        delay = 1 / args.tokens_per_second if args.tokens_per_second else args.chunk_seconds
+        chunks = list(stream_chunks(request.get('model', 'stub'), prompt, content, include_usage))
+        try:
+            for i, chunk in enumerate(chunks):
+                if dropped and i >= len(chunks) // 2:
+                    self.state.count('dropped')
+                    return
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.state.count('ok')
+            self.state.count_usage(completion_body('', prompt, content)['usage'])
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. after enough triples
+            self.state.count('streams_closed_early')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible stand-in for testing and load-testing the '
+                                                 'runners')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='Mean latency to the first token in seconds')
+    parser.add_argument('--latency_jitter', type=float, default=0.1, help='Standard deviation of the latency')
+    parser.add_argument('--latency_distribution', choices=LATENCY_DISTRIBUTIONS, default='normal',
+                        help='lognormal and exponential give the long tails of a loaded API')
+    parser.add_argument('--tokens_per_second', type=float, default=0,
+                        help='Generation speed after the first token, 0 answers at once')
+    parser.add_argument('--rpm', type=int, default=0, help='Answer 429 beyond this many requests per minute')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    parser.add_argument('--retry_after', type=float, default=1.0, help='retry-after header value of 429 responses')
+    parser.add_argument('--drop_rate', type=float, default=0.0,
+                        help='Fraction of requests whose connection closes without (or, streamed, halfway through) '
+                             'the response')
+    parser.add_argument('--response', default='occupation(Alan Turing, mathematician)',
+                        help='Canned completion text, for prompts whose test sentences have no ground truth')
+    parser.add_argument('--ground_truth', nargs='*', default=[],
+                        help='Ground truth JSONL files or globs; prompts with their test sentences are answered with '
+                             'the true triples')
+    parser.add_argument('--recall', type=float, default=1.0,
+                        help='Fraction of ground truth triples in the answers, chosen deterministically')
+    parser.add_argument('--chunk_seconds', type=float, default=0.02, help='Delay between streamed chunks')
+    parser.add_argument('--batch_seconds', type=float, default=5.0, help='Time until a batch job completes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    StubHandler.state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"OpenAI stub listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Stub stats: {StubHandler.state.counts}")
+        server.server_close()
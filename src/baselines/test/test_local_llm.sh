@@ -1,7 +1,12 @@
 #!/bin/bash
 if [ $# -eq 0 ]; then
-    echo "Usage: ./run_model.sh 'your prompt here'"
+    echo "Usage: ./test_local_llm.sh 'your prompt here' [benchmark_inference.py options]"
+    echo "   or: ./test_local_llm.sh --prompt_files 'path/to/prompts/*.jsonl' [options]"
     exit 1
 fi
 
-python3 init_model.py && python3 get_response.py "$1"
+if [[ "$1" == --* ]]; then
+    python3 benchmark_inference.py "$@"
+else
+    python3 benchmark_inference.py --prompt "$1" "${@:2}"
+fi
@@ -0,0 +1,145 @@
+import json
+import os
+import time
+from typing import Optional, Set
+
+from common.jsonl_io import is_compressed, open_text, write_jsonl
+
+PARTIAL_SUFFIX = ".partial"
+
+
+def truncate_partial_line(file_path: str) -> int:
+    """
+    Cut a torn last line, left by a crash in the middle of a write, off a plain JSONL file
+    :param file_path: path to the file
+    :return: number of bytes removed
+    """
+    with open(file_path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return 0
+        # scan backwards in blocks for the last newline
+        end = size
+        block = 1 << 16
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            chunk = f.read(end - start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                keep = start + newline + 1
+                break
+            end = start
+        else:
+            keep = 0
+        if keep < size:
+            f.truncate(keep)
+        return size - keep
+
+
+def read_records(file_path: str) -> list:
+    """
+    Read the intact records of a JSONL file, stopping at corrupt compressed data
+    :param file_path: path to the (possibly compressed) file
+    :return: list of records
+    """
+    records = []
+    if not os.path.exists(file_path):
+        return records
+    try:
+        with open_text(file_path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except (EOFError, OSError, ValueError) as e:
+        print(f"Stopped reading {file_path} at damaged data: {str(e)}")
+    return records
+
+
+class ResponseCheckpoint:
+    """
+    Durable append-only log of responses that lets an interrupted run resume where it stopped.
+
+    Each record is written and flushed to the OS as soon as it completes, so a crash of the process loses
+    nothing; os.fsync runs every fsync_every records or fsync_interval seconds to bound what a power loss or
+    kernel crash can lose. Plain .jsonl outputs are appended to in place. Compressed outputs cannot be
+    appended to safely, so records go to a plain "<output>.partial" file that close() merges into the
+    compressed output. Records of the output and the partial file count as done when a run resumes.
+    """
+
+    def __init__(self, output_file: str, overwrite: bool = False, fsync_every: int = 16,
+                 fsync_interval: float = 5.0):
+        self.output_file = output_file
+        self.log_file = output_file + PARTIAL_SUFFIX if is_compressed(output_file) else output_file
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        if overwrite:
+            for file_path in {self.output_file, self.log_file}:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+        self.done_ids: Set[str] = set()
+        for file_path in {self.output_file, self.log_file}:
+            if file_path == self.log_file and os.path.exists(file_path):
+                removed = truncate_partial_line(file_path)
+                if removed:
+                    print(f"Removed a torn last line ({removed} bytes) from {file_path}")
+            self.done_ids.update(record.get("id") for record in read_records(file_path))
+        self.done_ids.discard(None)
+
+        os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+        self.file = open(self.log_file, "a", encoding="utf-8")
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def __contains__(self, prompt_id: str) -> bool:
+        return prompt_id in self.done_ids
+
+    def append(self, record: dict) -> None:
+        """
+        Append one response record
+        :param record: the response, with an "id" key
+        :return: None
+        """
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.done_ids.add(record.get("id"))
+        self.pending += 1
+        if self.pending >= self.fsync_every or time.time() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        self.last_sync = time.time()
+
+    def close(self) -> None:
+        """
+        Sync the log and, for compressed outputs, merge the partial file into the output
+        :return: None
+        """
+        if self.file.closed:
+            return
+        self.sync()
+        self.file.close()
+        if self.log_file != self.output_file:
+            records = read_records(self.output_file) + read_records(self.log_file)
+            tmp_file = self.output_file + ".tmp" + os.path.splitext(self.output_file)[1]
+            write_jsonl(records, tmp_file)
+            os.replace(tmp_file, self.output_file)
+            os.remove(self.log_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an interrupted run keeps its partial file, it is merged when the run is resumed and completes
+        if exc_type is None:
+            self.close()
+        else:
+            self.sync()
+            self.file.close()
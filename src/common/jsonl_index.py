@@ -0,0 +1,258 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional, Tuple
+
+from common.jsonl_io import is_compressed, iter_jsonl
+
+# Sidecar layout: magic, header struct, then three column arrays (sorted key hashes, byte offsets, line lengths).
+INDEX_MAGIC = b"T2KJIDX1"
+INDEX_SUFFIX = ".idx"
+_HEADER = struct.Struct("<QqQ40s16s")
+_BYTEORDER = sys.byteorder.encode("ascii").ljust(16, b"\0")
+
+
+def key_hash(key: str) -> int:
+    """
+    Stable 64-bit hash of a record key used for the sorted lookup table
+    :param key: record key (e.g. the value of the "id" field)
+    :return: unsigned 64-bit integer
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def file_sha1(file_path: str) -> str:
+    """
+    Compute the SHA1 digest of a file, reading it in blocks
+    :param file_path: path to the file
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as in_file:
+        for block in iter(lambda: in_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_jsonl(jsonl_path: str, key: str = "id") -> Tuple[Dict[str, Tuple[int, int]], str]:
+    """
+    Scan a .jsonl file once and collect the byte span of every record
+    :param jsonl_path: path to the .jsonl file
+    :param key: the attribute used as the record key
+    :return:
+        spans: dict - key -> (offset, length); later duplicates override earlier ones
+        sha1: str - hex digest of the file content
+    """
+    spans = {}
+    digest = hashlib.sha1()
+    offset = 0
+    with open(jsonl_path, "rb") as in_file:
+        for line in in_file:
+            digest.update(line)
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                record = None
+            if isinstance(record, dict) and record.get(key) is not None:
+                spans[str(record[key])] = (offset, len(line))
+            offset += len(line)
+    return spans, digest.hexdigest()
+
+
+def write_index(index_path: str, stat: os.stat_result, sha1: str, spans: Dict[str, Tuple[int, int]]) -> None:
+    """
+    Serialize the lookup table for a .jsonl file to a sidecar index file
+    :param index_path: path of the index file to write
+    :param stat: stat result of the indexed file at scan time
+    :param sha1: hex digest of the indexed file
+    :param spans: key -> (offset, length) table
+    :return: None
+    """
+    entries = sorted((key_hash(k), offset, length) for k, (offset, length) in spans.items())
+    hashes = array("Q", (e[0] for e in entries))
+    offsets = array("Q", (e[1] for e in entries))
+    lengths = array("Q", (e[2] for e in entries))
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(INDEX_MAGIC)
+        out_file.write(_HEADER.pack(stat.st_size, stat.st_mtime_ns, len(entries), sha1.encode("ascii"), _BYTEORDER))
+        hashes.tofile(out_file)
+        offsets.tofile(out_file)
+        lengths.tofile(out_file)
+    os.replace(tmp_path, index_path)
+
+
+def read_index_header(index_path: str) -> Optional[Tuple[int, int, int, str]]:
+    """
+    Read the header of a sidecar index file
+    :param index_path: path to the index file
+    :return: (size, mtime_ns, count, sha1) of the indexed file or None if the index is missing or unreadable
+    """
+    try:
+        with open(index_path, "rb") as in_file:
+            if in_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            size, mtime_ns, count, sha1, byteorder = _HEADER.unpack(in_file.read(_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if byteorder != _BYTEORDER:
+        return None
+    return size, mtime_ns, count, sha1.decode("ascii")
+
+
+def is_index_valid(jsonl_path: str, index_path: str) -> bool:
+    """
+    Check whether a sidecar index still describes the .jsonl file. The size must match; a matching mtime is
+    trusted, otherwise the content hash decides (e.g. after a copy that did not preserve timestamps).
+    :param jsonl_path: path to the .jsonl file
+    :param index_path: path to the index file
+    :return: True if the index can be used as is
+    """
+    header = read_index_header(index_path)
+    if header is None:
+        return False
+    size, mtime_ns, _, sha1 = header
+    stat = os.stat(jsonl_path)
+    if stat.st_size != size:
+        return False
+    if stat.st_mtime_ns == mtime_ns:
+        return True
+    return file_sha1(jsonl_path) == sha1
+
+
+class JsonlIndex(Mapping):
+    """
+    Read-only, dictionary-like view over a .jsonl file that reads and parses only the requested lines.
+    A sorted key-hash -> (offset, length) table is stored next to the file (<file>.idx), memory-mapped on open,
+    and rebuilt whenever the file changes. If the sidecar cannot be written, the table is kept in memory.
+    """
+
+    def __init__(self, jsonl_path: str, key: str = "id", index_path: Optional[str] = None):
+        self.jsonl_path = jsonl_path
+        self.key = key
+        self.index_path = index_path or jsonl_path + INDEX_SUFFIX
+        self._index_file = None
+        self._index_map = None
+        if key != "id":
+            # the key is not recorded in the header, keep indexes for other keys apart
+            self.index_path = f"{self.index_path}.{key}"
+        self._data_file = open(jsonl_path, "rb")
+        try:
+            self._open_index()
+        except BaseException:
+            # the caller never gets the object to close, release the handles opened so far
+            self.close()
+            raise
+
+    def _open_index(self) -> None:
+        if not is_index_valid(self.jsonl_path, self.index_path):
+            stat = os.stat(self.jsonl_path)
+            spans, sha1 = scan_jsonl(self.jsonl_path, self.key)
+            try:
+                write_index(self.index_path, stat, sha1, spans)
+            except OSError as e:
+                print(f"Could not write index {self.index_path}, keeping it in memory: {str(e)}")
+                self._load_in_memory(spans)
+                return
+        self._load_mapped()
+
+    def _load_mapped(self) -> None:
+        self._index_file = open(self.index_path, "rb")
+        count = read_index_header(self.index_path)[2]
+        start = len(INDEX_MAGIC) + _HEADER.size
+        if count == 0:
+            self._hashes, self._offsets, self._lengths = [], [], []
+            return
+        self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._index_map)
+        width = 8 * count
+        self._hashes = view[start:start + width].cast("Q")
+        self._offsets = view[start + width:start + 2 * width].cast("Q")
+        self._lengths = view[start + 2 * width:start + 3 * width].cast("Q")
+
+    def _load_in_memory(self, spans: Dict[str, Tuple[int, int]]) -> None:
+        entries = sorted((key_hash(k), offset, length) for k, (offset, length) in spans.items())
+        self._hashes = array("Q", (e[0] for e in entries))
+        self._offsets = array("Q", (e[1] for e in entries))
+        self._lengths = array("Q", (e[2] for e in entries))
+
+    def _read_line(self, position: int) -> bytes:
+        self._data_file.seek(self._offsets[position])
+        return self._data_file.read(self._lengths[position])
+
+    def _lookup(self, key: str) -> Optional[Tuple[bytes, dict]]:
+        target = key_hash(key)
+        position = bisect_left(self._hashes, target)
+        # verify the key on every entry with the same hash to rule out collisions
+        while position < len(self._hashes) and self._hashes[position] == target:
+            line = self._read_line(position)
+            record = json.loads(line)
+            if str(record.get(self.key)) == key:
+                return line, record
+            position += 1
+        return None
+
+    def get_line(self, key: str) -> Optional[bytes]:
+        """
+        Return the raw line of a record
+        :param key: record key
+        :return: the line as bytes or None if the key is not indexed
+        """
+        found = self._lookup(key)
+        return found[0] if found else None
+
+    def __getitem__(self, key: str) -> dict:
+        found = self._lookup(key)
+        if found is None:
+            raise KeyError(key)
+        return found[1]
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self._lookup(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __iter__(self) -> Iterator[str]:
+        # keys in file order
+        for position in sorted(range(len(self._offsets)), key=self._offsets.__getitem__):
+            yield str(json.loads(self._read_line(position))[self.key])
+
+    def close(self) -> None:
+        for column in ("_hashes", "_offsets", "_lengths"):
+            value = getattr(self, column, None)
+            if isinstance(value, memoryview):
+                value.release()
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_keyed_jsonl(jsonl_path: str, key: str = "id") -> Mapping:
+    """
+    Open a .jsonl file for lookups by key. Plain files go through JsonlIndex; compressed files cannot be
+    read at an offset, so they are streamed once into a dictionary.
+    :param jsonl_path: path to the (possibly compressed) .jsonl file
+    :param key: the attribute used as the record key
+    :return: a mapping from key to record
+    """
+    if is_compressed(jsonl_path):
+        return {str(record[key]): record for record in iter_jsonl(jsonl_path, skip_invalid=True)
+                if isinstance(record, dict) and record.get(key) is not None}
+    return JsonlIndex(jsonl_path, key)
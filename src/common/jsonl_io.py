@@ -0,0 +1,97 @@
+import gzip
+import io
+import json
+from typing import IO, Iterable, Iterator, List
+
+GZIP_SUFFIX = ".gz"
+ZSTD_SUFFIX = ".zst"
+COMPRESSED_SUFFIXES = (GZIP_SUFFIX, ZSTD_SUFFIX)
+
+
+def compression_suffix(file_path: str) -> str:
+    """
+    Return the compression suffix of a path
+    :param file_path: path to a file, e.g. "ont_1_movie_prompts.jsonl.gz"
+    :return: ".gz", ".zst" or "" for uncompressed files
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        if file_path.endswith(suffix):
+            return suffix
+    return ""
+
+
+def is_compressed(file_path: str) -> bool:
+    """
+    Check whether a path names a compressed file
+    :param file_path: path to the file
+    :return: True for .gz and .zst files
+    """
+    return compression_suffix(file_path) != ""
+
+
+def open_text(file_path: str, mode: str = "r", encoding: str = "utf-8") -> IO[str]:
+    """
+    Open a text file for streaming read, write or append, compressing transparently based on the extension.
+    .gz files use gzip, .zst files use zstandard (optional dependency), everything else is opened as is.
+    Appending adds a new gzip member / zstd frame, which readers of both formats handle.
+    :param file_path: path to the file
+    :param mode: "r", "w", "a" (a trailing "+" or "t" is accepted for plain files)
+    :param encoding: text encoding
+    :return: a text file object
+    """
+    suffix = compression_suffix(file_path)
+    if suffix == GZIP_SUFFIX:
+        return gzip.open(file_path, mode[0] + "t", encoding=encoding)
+    if suffix == ZSTD_SUFFIX:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"Reading or writing {file_path} requires the zstandard package (pip install zstandard)")
+        if mode[0] == "r":
+            raw = zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), read_across_frames=True, closefd=True)
+        else:
+            raw = zstandard.ZstdCompressor().stream_writer(open(file_path, mode[0] + "b"), closefd=True)
+        return io.TextIOWrapper(raw, encoding=encoding)
+    return open(file_path, mode, encoding=encoding)
+
+
+def iter_jsonl(jsonl_path: str, skip_invalid: bool = False) -> Iterator[dict]:
+    """
+    Stream the records of a (possibly compressed) .jsonl file
+    :param jsonl_path: path to the .jsonl file
+    :param skip_invalid: skip blank and malformed lines instead of raising
+    :return: an iterator over the parsed records
+    """
+    with open_text(jsonl_path) as in_file:
+        for line in in_file:
+            if skip_invalid:
+                try:
+                    yield json.loads(line.strip())
+                except json.JSONDecodeError:
+                    continue
+            else:
+                yield json.loads(line)
+
+
+def read_jsonl(jsonl_path: str, skip_invalid: bool = False) -> List[dict]:
+    """
+    Read all records of a (possibly compressed) .jsonl file
+    :param jsonl_path: path to the .jsonl file
+    :param skip_invalid: skip blank and malformed lines instead of raising
+    :return: list of records
+    """
+    return list(iter_jsonl(jsonl_path, skip_invalid))
+
+
+def write_jsonl(data: Iterable[dict], jsonl_path: str, mode: str = "w", ensure_ascii: bool = False) -> None:
+    """
+    Write records to a (possibly compressed) .jsonl file
+    :param data: records to serialize
+    :param jsonl_path: path to the output file
+    :param mode: "w" to overwrite, "a" to append
+    :param ensure_ascii: escape non-ASCII characters
+    :return: None
+    """
+    with open_text(jsonl_path, mode) as out_file:
+        for item in data:
+            out_file.write(json.dumps(item, ensure_ascii=ensure_ascii) + "\n")
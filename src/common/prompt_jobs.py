@@ -0,0 +1,154 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from common.jsonl_index import open_keyed_jsonl
+from common.jsonl_io import compression_suffix, open_text
+from common.triple_parser import parse_triples
+
+
+def estimate_tokens(text: str) -> int:
+    """About 4 characters per token, the estimate of prompt packing, deduplication and the TPM limiter"""
+    return len(text) // 4 + 1
+
+
+def load_file(src_file: str) -> Optional[dict]:
+    """Load either JSON or JSONL file, optionally gzip/zstd compressed"""
+    try:
+        with open_text(src_file, 'r') as f:
+            content = f.read()
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            data = []
+            for line in content.splitlines():
+                try:
+                    data.append(json.loads(line.strip()))
+                except json.JSONDecodeError:
+                    continue
+            return data
+    except Exception as e:
+        print(f"Error loading file {src_file}: {str(e)}")
+        return None
+
+
+def packed_prompt_file(prompt_file: str) -> str:
+    """Packed prompts are written next to the prompts, e.g. ont_x_prompts.jsonl -> ont_x_prompts_packed.jsonl"""
+    suffix = compression_suffix(prompt_file)
+    base = prompt_file[:len(prompt_file) - len(suffix)]
+    if base.endswith('.jsonl'):
+        base = base[:-len('.jsonl')]
+    return f"{base}_packed.jsonl{suffix}"
+
+
+def get_file_paths(config: dict, baseline_name: str) -> Dict[str, dict]:
+    """Prompt, ontology and response paths of every ontology in a prompt-gen config"""
+    try:
+        # Extract dataset and type (seen/unseen) from path patterns
+        prompt_pattern = config['path_patterns']['prompt']
+
+        # Determine if it's an unseen dataset
+        is_unseen = 'unseen' in prompt_pattern
+
+        # Extract base dataset path (e.g., "../../data/dbpedia_webnlg" or "../../data/wikidata_tekgen")
+        base_path = prompt_pattern.split('/baselines')[0]
+
+        # Construct response directory path
+        response_base = f"{base_path}/baselines/{baseline_name}"
+        if is_unseen:
+            response_dir = f"{response_base}/unseen/llm_responses"
+        else:
+            response_dir = f"{response_base}/llm_responses"
+
+        file_paths = {}
+        for onto in config['onto_list']:
+            file_paths[onto] = {
+                'prompt_file': prompt_pattern.replace('$$onto$$', onto),
+                'ontology_file': config['path_patterns'].get('onto', '').replace('$$onto$$', onto),
+                'response_dir': response_dir
+            }
+        return file_paths
+    except Exception as e:
+        print(f"Error generating file paths: {str(e)}")
+        return {}
+
+
+def read_prompts(prompt_file: str) -> Optional[List[dict]]:
+    """Read a prompt JSONL file"""
+    try:
+        with open_text(prompt_file, 'r') as f:
+            return [json.loads(line.strip()) for line in f if line.strip()]
+    except Exception as e:
+        print(f"Error reading prompt file {prompt_file}: {str(e)}")
+        return None
+
+
+def prompt_jobs(config_paths: List[str], baseline_name: str, packed: bool = False) -> Optional[List[dict]]:
+    """
+    One job per (config, ontology) with a prompt file: {'name', 'onto', 'prompts', 'packed', 'prompt_file',
+    'ontology_file', 'output_file', 'response_dir'}; with packed, the prompts are the packed prompts where
+    gen_prompt.py wrote them
+    """
+    jobs = []
+    for config_path in config_paths:
+        config = load_file(config_path)
+        if not config:
+            return None
+        file_paths = get_file_paths(config, baseline_name)
+        if not file_paths:
+            return None
+        # ontologies of several configs are told apart by the config name
+        config_name = os.path.splitext(os.path.basename(config_path))[0]
+        for onto in config['onto_list']:
+            paths = file_paths[onto]
+            prompt_file = paths['prompt_file']
+            if not os.path.exists(prompt_file):
+                print(f"Prompt file {prompt_file} not found. Skipping ontology {onto}.")
+                continue
+            source = packed_prompt_file(prompt_file) if packed else prompt_file
+            if source != prompt_file and not os.path.exists(source):
+                print(f"Packed prompt file {source} not found, the prompts of {onto} are answered one by one.")
+                source = prompt_file
+            prompts = read_prompts(source)
+            if prompts is None:
+                continue
+            os.makedirs(paths['response_dir'], exist_ok=True)
+            jobs.append({
+                'name': onto if len(config_paths) == 1 else f"{config_name}/{onto}",
+                'onto': onto,
+                'prompts': prompts,
+                'packed': source != prompt_file,
+                'prompt_file': prompt_file,
+                'ontology_file': paths['ontology_file'],
+                # responses are compressed the same way as the prompts they answer
+                'output_file': os.path.join(paths['response_dir'],
+                                            f'ont_{onto}_responses.jsonl' + compression_suffix(prompt_file)),
+                'response_dir': paths['response_dir']
+            })
+    return jobs
+
+
+def retry_prompts(job: dict, prompt_ids: List[str]) -> List[dict]:
+    """The own prompts of sentences a packed answer did not answer reliably, looked up by id"""
+    try:
+        prompts = open_keyed_jsonl(job['prompt_file'])
+    except Exception as e:
+        print(f"Error reading prompt file {job['prompt_file']}: {str(e)}")
+        return []
+    try:
+        return [prompts[prompt_id] for prompt_id in dict.fromkeys(prompt_ids) if prompt_id in prompts]
+    finally:
+        if hasattr(prompts, 'close'):
+            prompts.close()
+
+
+def response_record(prompt_id: str, response_text: str, timing: Optional[dict] = None) -> dict:
+    """The record a runner writes for a prompt, with the triples parsed from its response"""
+    record = {
+        'id': prompt_id,
+        'response': response_text,
+        'triples': parse_triples(response_text)
+    }
+    if timing is not None:
+        record['timing'] = timing
+    return record
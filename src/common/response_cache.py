@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+from common.jsonl_io import iter_jsonl, write_jsonl
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "TEXT2KG_RESPONSE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "text2kgbench", "responses.sqlite"))
+DEFAULT_MAX_SIZE_MB = 2048
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY, backend TEXT NOT NULL, model TEXT NOT NULL, params TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL, response TEXT NOT NULL, size INTEGER NOT NULL,
+    created REAL NOT NULL, last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_used);
+"""
+
+
+def prompt_hash(prompt: str) -> str:
+    """
+    Content address of a prompt
+    :param prompt: the prompt text
+    :return: hex sha256 digest
+    """
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def cache_key(backend: str, model: str, params: dict, prompt_digest: str) -> str:
+    """
+    Key of a response, any change of backend, model or decoding parameters gives a different key
+    :param backend: e.g. "openai" or "llama_cpp"
+    :param model: model name or file
+    :param params: decoding parameters, e.g. {"temperature": 0, "max_tokens": 250}
+    :param prompt_digest: prompt_hash of the prompt
+    :return: hex sha256 digest
+    """
+    identity = json.dumps([backend, model, params, prompt_digest], sort_keys=True)
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of model responses in a single SQLite file.
+
+    Entries are keyed by (backend, model, decoding parameters, prompt hash), so the same prompt sent by any
+    config or run is answered from the cache. When the stored responses exceed max_size_mb, the least
+    recently used entries are evicted. export/import_ move entries through (optionally compressed) JSONL so
+    cached baselines can be shared.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_size_mb: Optional[float] = DEFAULT_MAX_SIZE_MB):
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, backend: str, model: str, params: dict, prompt: str) -> Optional[str]:
+        """
+        Look up a response and mark it as used
+        :return: the cached response text or None
+        """
+        key = cache_key(backend, model, params, prompt_hash(prompt))
+        row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return row[0]
+
+    def put(self, backend: str, model: str, params: dict, prompt: str, response: str) -> None:
+        """
+        Store a response, evicting old entries first if the size limit requires it
+        :return: None
+        """
+        digest = prompt_hash(prompt)
+        self._insert(cache_key(backend, model, params, digest), backend, model, params, digest, response,
+                     time.time())
+        self.db.commit()
+        self.evict()
+
+    def _insert(self, key: str, backend: str, model: str, params: dict, digest: str, response: str,
+                created: float) -> None:
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, backend, model, params, prompt_hash, response, size, created, "
+            "last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, backend, model, json.dumps(params, sort_keys=True), digest, response,
+             len(response.encode("utf-8")), created, now))
+
+    def size_bytes(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def evict(self) -> int:
+        """
+        Remove least recently used entries until the stored responses fit the size limit
+        :return: number of evicted entries
+        """
+        if self.max_bytes is None:
+            return 0
+        excess = self.size_bytes() - self.max_bytes
+        evicted = 0
+        while excess > 0:
+            oldest = self.db.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 1000").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                excess -= size
+                evicted += 1
+                if excess <= 0:
+                    break
+        self.db.commit()
+        if evicted:
+            print(f"Evicted {evicted} responses from the cache")
+        return evicted
+
+    def entries(self, backend: Optional[str] = None, model: Optional[str] = None) -> Iterator[dict]:
+        """
+        Iterate over cached entries, optionally restricted to one backend and/or model
+        :return: an iterator over entry dicts
+        """
+        query = "SELECT backend, model, params, prompt_hash, response, created FROM responses"
+        conditions, values = [], []
+        if backend:
+            conditions.append("backend = ?")
+            values.append(backend)
+        if model:
+            conditions.append("model = ?")
+            values.append(model)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        for backend_, model_, params, digest, response, created in self.db.execute(query + " ORDER BY created",
+                                                                                   values):
+            yield {"backend": backend_, "model": model_, "params": json.loads(params), "prompt_hash": digest,
+                   "response": response, "created": created}
+
+    def export(self, jsonl_path: str, backend: Optional[str] = None, model: Optional[str] = None) -> int:
+        """
+        Write entries to a (possibly compressed) JSONL file
+        :return: number of exported entries
+        """
+        entries = list(self.entries(backend, model))
+        write_jsonl(entries, jsonl_path)
+        return len(entries)
+
+    def import_(self, jsonl_path: str) -> int:
+        """
+        Add the entries of an exported JSONL file, existing entries are replaced
+        :return: number of imported entries
+        """
+        count = 0
+        for entry in iter_jsonl(jsonl_path, skip_invalid=True):
+            key = cache_key(entry["backend"], entry["model"], entry["params"], entry["prompt_hash"])
+            self._insert(key, entry["backend"], entry["model"], entry["params"], entry["prompt_hash"],
+                         entry["response"], entry.get("created", time.time()))
+            count += 1
+        self.db.commit()
+        self.evict()
+        return count
+
+    def close(self) -> None:
+        self.db.close()
+
+
+if __name__ == "__main__":
+    # run from src/: python -m common.response_cache {stats,export,import} ...
+    parser = argparse.ArgumentParser(description="Inspect, export or import the response cache")
+    parser.add_argument("--cache_path", default=DEFAULT_CACHE_PATH, help="Path of the cache database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Print entry counts per backend and model")
+    export_parser = subparsers.add_parser("export", help="Write entries to a JSONL file")
+    export_parser.add_argument("jsonl_path")
+    export_parser.add_argument("--backend")
+    export_parser.add_argument("--model")
+    import_parser = subparsers.add_parser("import", help="Add entries from an exported JSONL file")
+    import_parser.add_argument("jsonl_path")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.cache_path, max_size_mb=None)
+    if args.command == "stats":
+        rows = cache.db.execute("SELECT backend, model, COUNT(*), SUM(size) FROM responses GROUP BY backend, model")
+        for backend, model, count, size in rows:
+            print(f"{backend}\t{model}\t{count} responses\t{size / 1024 / 1024:.2f} MB")
+    elif args.command == "export":
+        print(f"Exported {cache.export(args.jsonl_path, args.backend, args.model)} responses to {args.jsonl_path}")
+    else:
+        print(f"Imported {cache.import_(args.jsonl_path)} responses from {args.jsonl_path}")
+    cache.close()
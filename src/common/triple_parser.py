@@ -0,0 +1,236 @@
+import re
+from typing import List, Optional, Tuple
+
+# code fence lines: ``` or ~~~, optionally with a language
+_FENCE = re.compile(r'(?:```|~~~)')
+# list markers and emphasis in front of a triple: "- ", "* ", "• ", "1. ", "2) ", "(3) ", "**", "`"
+_PREFIX = re.compile(r'(?:[-*•+]\s+|\d+[.)]\s+|\(\d+\)\s+)?(?:\*\*|`)*\s*')
+# a second triple after an arrow, e.g. "relation(Type, Type) -> relation(subject, object)"
+_ARROW = re.compile(r'\s*(?:->|=>|→)\s*')
+# another call chained after a triple, e.g. "foo(a, b), bar(c, d)"
+_CHAINED = re.compile(r'[\s,;`*]*(?=[^\s(),.:;"“”`*]+\()')
+_LIST_MARKERS = set('-*•+0123456789')
+_BULLETS = {'-', '*', '•', '+'}
+_QUOTES = {'"': '"', '“': '”'}
+# characters that change the parenthesis depth, quoting or argument split
+_SPECIAL = re.compile(r'[(),"“”]')
+# relation labels are short; a longer text before "(" is prose with a parenthetical remark
+MAX_RELATION_WORDS = 6
+
+
+def _strip_arg(text: str) -> str:
+    text = text.strip().strip('*`').strip()
+    if len(text) >= 2 and _QUOTES.get(text[0]) == text[-1]:
+        text = text[1:-1].strip()
+    elif text[:1] in _QUOTES and _QUOTES[text[0]] not in text[1:]:
+        # an opening quote that is never closed
+        text = text[1:].strip()
+    return text
+
+
+_NOT_IN_RELATION = re.compile(r'[.:;"“”`]')
+
+
+def _valid_relation(relation: str) -> bool:
+    return relation.isidentifier() or bool(relation) and relation.count(' ') < MAX_RELATION_WORDS and \
+        not _NOT_IN_RELATION.search(relation)
+
+
+def _scan_call(line: str, start: int) -> Optional[tuple]:
+    """
+    Parse relation(arguments) starting at start, tracking parenthesis depth and double quotes
+    :return: (relation, subject, object, end index after the closing parenthesis) or None
+    """
+    open_paren = line.find('(', start)
+    if open_paren < 0:
+        return None
+    relation = line[start:open_paren].strip().strip('*`').strip()
+    if not relation and line.startswith('(', start):
+        # the whole triple wrapped in parentheses, e.g. "(relation(subject, object))"
+        inner = _scan_call(line, open_paren + 1)
+        if inner is not None and line.startswith(')', inner[3]):
+            return inner[:3] + (inner[3] + 1,)
+        return None
+    if not _valid_relation(relation):
+        return None
+
+    end = line.find(')', open_paren)
+    comma = line.find(',', open_paren, end)
+    if end > 0 and line.find('(', open_paren + 1, end) < 0 and line.find('"', open_paren, end) < 0 and \
+            line.find('“', open_paren, end) < 0:
+        # no nested parentheses or quotes, the first closing parenthesis ends the call
+        if comma < 0:
+            return None
+        subject, obj = _strip_arg(line[open_paren + 1:comma]), _strip_arg(line[comma + 1:end])
+        return (relation, subject, obj, end + 1) if subject and obj else None
+
+    depth, quote, comma, end = 0, None, -1, -1
+    for special in _SPECIAL.finditer(line, open_paren):
+        c, i = special.group(), special.start()
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in _QUOTES:
+            # only a quote opening an argument and closed later on quotes, a stray one stands for an apostrophe
+            if depth == 1 and line[open_paren:i].rstrip()[-1] in '(,' and _QUOTES[c] in line[i + 1:]:
+                quote = _QUOTES[c]
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                end = i
+                break
+        elif c == ',' and depth == 1 and comma < 0:
+            # subjects end at the first top-level comma, objects keep theirs
+            comma = i
+    if comma < 0:
+        return None
+    if end < 0:
+        # unbalanced parentheses inside an argument, the triple runs to the end of the line
+        end = len(line.rstrip().rstrip(')')) if line.rstrip().endswith(')') else -1
+        if end < 0:
+            return None
+    subject, obj = _strip_arg(line[open_paren + 1:comma]), _strip_arg(line[comma + 1:end])
+    if not subject or not obj:
+        return None
+    return relation, subject, obj, end + 1
+
+
+def _plain_arg(text: str) -> str:
+    # an argument of a plain line: parenthesised groups side by side, or double quotes without parentheses
+    if '(' in text or ')' in text:
+        groups = text.count('(')
+        if '"' in text or groups != text.count(')'):
+            return ''
+        if groups == 1:
+            if text.find('(') > text.find(')'):
+                return ''
+        else:
+            close = -1
+            for _ in range(groups):
+                open_paren = text.find('(', close + 1)
+                if text.find(')', close + 1, open_paren) >= 0:
+                    return ''
+                close = text.find(')', open_paren)
+                if text.find('(', open_paren + 1, close) >= 0:
+                    return ''
+        return text.strip()
+    return _strip_arg(text) if '"' in text else text.strip()
+
+
+def _plain_args(subject: str, obj: str, tail: str) -> Tuple[str, str]:
+    # a quote opening the subject and closed after the comma hides that comma, one in the tail the parenthesis
+    if '"' in tail or subject.count('"') == 1 and subject.lstrip()[:1] == '"':
+        return '', ''
+    return _plain_arg(subject), _plain_arg(obj)
+
+
+def _plain_relation(head: str) -> Optional[str]:
+    # the text in front of the first parenthesis without its list marker, None if it is prose
+    relation = head.lstrip()
+    if relation[:1] in _LIST_MARKERS:
+        marker, space, label = relation.partition(' ')
+        if space and (marker in _BULLETS or marker[:-1].isdigit() and marker[-1] in '.)'):
+            relation = label
+        else:
+            relation = relation[_PREFIX.match(relation).end():]
+    relation = relation.strip()
+    return relation if not relation or _valid_relation(relation) else None
+
+
+def _parse_calls(line: str) -> List[List[str]]:
+    """The triples of a line that is no plain relation(subject, object), call by call"""
+    stripped = line.strip()
+    if _FENCE.match(stripped):
+        return []
+    triples = []
+    start = _PREFIX.match(stripped).end()
+    while True:
+        call = _scan_call(stripped, start)
+        if call is None:
+            return triples
+        relation, subject, obj, end = call
+        arrow = _ARROW.match(stripped, end)
+        if arrow is not None:
+            # the triple before the arrow is the relation's signature, the one after it the answer
+            start = arrow.end()
+            continue
+        triples.append([subject, relation, obj])
+        if not stripped[end:].strip(' \t.,;:)`*'):
+            return triples
+        chained = _CHAINED.match(stripped, end)
+        if chained is None:
+            return triples
+        start = chained.end()
+
+
+def parse_triples(response_text: str) -> List[List[str]]:
+    """
+    Parse the response text to extract [subject, relation, object] triples, line by line.
+    Accepts list markers, numbering, emphasis and quotes around the triple or its arguments, nested
+    parentheses and quoted commas inside arguments. Unquoted subjects end at the first comma, objects at the
+    matching closing parenthesis. Calls chained after a triple, e.g. "foo(a, b), bar(c, d)", are parsed as well,
+    any other text after it is dropped; prose with a parenthetical remark is told apart by its relation, which
+    must be a short label.
+    """
+    triples = []
+    if '(' not in response_text:
+        return triples
+    # emphasis and curly quotes need the full parser, ruled out once for the whole response
+    marked = '*' in response_text or '`' in response_text or '“' in response_text or '”' in response_text
+    quoted = '"' in response_text
+    for line in response_text.splitlines():
+        if '(' not in line:
+            continue
+        if marked and ('*' in line or '`' in line or '“' in line or '”' in line):
+            triples.extend(_parse_calls(line))
+            continue
+        head, _, rest = line.partition('(')
+        if head.isidentifier():
+            relation = head
+        else:
+            relation = head.strip()
+            if not relation.isidentifier():
+                relation = _plain_relation(head) if relation else ''
+                if relation is None:
+                    # prose with a parenthetical remark
+                    continue
+                if not relation:
+                    rest = rest.rstrip()
+                    if '(' not in rest:
+                        # parentheses that wrap no relation(subject, object), e.g. a remark or a tuple
+                        continue
+                    head, _, inner = rest[:-1].partition('(')
+                    relation = head.strip()
+                    if not rest.endswith('))') or not relation.isidentifier():
+                        # numbering like "(1) relation(subject, object)", text after the triple or an odd label
+                        triples.extend(_parse_calls(line))
+                        continue
+                    # the whole triple wrapped in parentheses, e.g. "(relation(subject, object))"
+                    rest = inner
+        # plain relation(subject, object) lines, the common case, are split without a regex; text after the
+        # triple is dropped unless it holds another call or an arrow
+        args, _, tail = rest.rpartition(')')
+        subject, comma, obj = args.partition(',')
+        if comma and (not tail or '(' not in tail and '>' not in tail and '→' not in tail):
+            if '(' in args or ')' in args or (quoted and '"' in args):
+                subject, obj = _plain_args(subject, obj, tail)
+            else:
+                subject, obj = subject.strip(), obj.strip()
+            if subject and obj:
+                triples.append([subject, relation, obj])
+                continue
+        triples.extend(_parse_calls(line))
+    return triples
+
+
+def parse_line_triples(line: str) -> List[List[str]]:
+    """Parse one line into its [subject, relation, object] triples, usually one, as parse_triples does"""
+    return parse_triples(line)
+
+
+def parse_line(line: str) -> Optional[List[str]]:
+    """The first [subject, relation, object] triple of a line, None if it holds none"""
+    triples = parse_triples(line)
+    return triples[0] if triples else None
@@ -3,10 +3,15 @@ import sys
 import os
 import json
 import re
+from contextlib import ExitStack
 from typing import List, Dict, Set, Tuple
 from nltk.tokenize import word_tokenize
 from nltk.stem import PorterStemmer
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.jsonl_index import JsonlIndex, open_keyed_jsonl
+from common.jsonl_io import open_text
+
 
 def calculate_precision_recall_f1(gold: Set, pred: Set) -> (float, float, float):
     """
@@ -130,15 +135,61 @@ def clean_entity_string(ps, entity: str) -> str:
     return normalized_stemmed_entity.replace("01januari", "")
 
 
+def evaluate_sentence(ps, ontology: Dict, gt_record: Dict, system_triples: List) -> Tuple[Dict, Dict]:
+    """
+    Evaluate the system triples of one test sentence against its ground truth
+    :param ps: stemmer for stemming words before checking for hallucinations
+    :param ontology: ontology to take into account with the concepts and relations
+    :param gt_record: ground truth entry with "id", "sent" and "triples"
+    :param system_triples: triples generated by the system as [subject, relation, object] lists
+    :return:
+        eval_metrics: Dict - the record written to the per-ontology metrics file
+        scores: Dict - the unformatted precision, recall, f1, onto_conf, rel_halluc, sub_halluc and obj_halluc
+    """
+    # collect the ground truth triples
+    gt_triples = [[tr['sub'], tr['rel'], tr['obj']] for tr in gt_record['triples']]
+    sentence = gt_record["sent"]
+
+    # collect the set of relations in ground truth triples, spaces are converted to "_" to make them
+    # comparable with system triples
+    gt_relations = {tr[1].replace(" ", "_") for tr in gt_triples}
+
+    # filter out any triples in system output that does not match with ground truth relations
+    filtered_system_triples = [tr for tr in system_triples if tr[1] in gt_relations]
+
+    # create a normalized string from subject, relation, object of each triple for comparison
+    normalized_system_triples = {normalize_triple(tr[0], tr[1], tr[2]) for tr in filtered_system_triples}
+    normalized_gt_triples = {normalize_triple(tr[0], tr[1], tr[2]) for tr in gt_triples}
+
+    # compare the system output triples with ground truth triples and calculate precision, recall, f1
+    precision, recall, f1 = calculate_precision_recall_f1(normalized_gt_triples, normalized_system_triples)
+
+    # calculate ontology conformance and relation hallucination
+    ont_conformance, rel_hallucination = get_ontology_conformance(ontology, system_triples)
+
+    # calculate subject and object hallucination
+    subj_hallucination, obj_hallucination = get_subject_object_hallucinations(ps, ontology, sentence, system_triples)
+
+    eval_metrics = {"id": gt_record["id"],
+                    "precision": f"{precision:.2f}", "recall": f"{recall:.2f}", "f1": f"{f1:.2f}",
+                    "onto_conf": f"{ont_conformance:.2f}", "rel_halluc": f"{rel_hallucination:.2f}",
+                    "sub_halluc": f"{subj_hallucination:.2f}", "obj_halluc": f"{obj_hallucination:.2f}",
+                    "llm_triples": system_triples, "filtered_llm_triples": filtered_system_triples,
+                    "gt_triples": gt_triples, "sent": sentence}
+    scores = {"precision": precision, "recall": recall, "f1": f1, "onto_conf": ont_conformance,
+              "rel_halluc": rel_hallucination, "sub_halluc": subj_hallucination, "obj_halluc": obj_hallucination}
+    return eval_metrics, scores
+
+
 def read_jsonl(jsonl_path: str, is_json: bool = True) -> List:
     """
     Utility method to read lines from .jsonl file to a data list
-    :param jsonl_path: path to the .jsonl file
+    :param jsonl_path: path to the .jsonl file (.jsonl.gz and .jsonl.zst are decompressed on the fly)
     :param is_json: a flag to indicate if each line is a json dictionary
     :return: a list of strings or json objects containing data in each line
     """
     data = []
-    with open(jsonl_path) as in_file:
+    with open_text(jsonl_path) as in_file:
         for line in in_file:
             if is_json:
                 data.append(json.loads(line))
@@ -186,7 +237,7 @@ def save_jsonl(data: List, jsonl_path: str) -> None:
     :return: None
     """
     ensure_directory_exists(jsonl_path)
-    with open(jsonl_path, "w") as out_file:
+    with open_text(jsonl_path, "w") as out_file:
         for item in data:
             out_file.write(f"{json.dumps(item)}\n")
 
@@ -199,7 +250,7 @@ def append_jsonl(data: Dict, jsonl_path: str) -> None:
     :return: None
     """
     ensure_directory_exists(jsonl_path)
-    with open(jsonl_path, "a+") as out_file:
+    with open_text(jsonl_path, "a") as out_file:
         out_file.write(f"{json.dumps(data)}\n")
 
 
@@ -209,7 +260,7 @@ def read_json(json_path: str) -> Dict:
     :param json_path: path to the json file
     :return: json file content as a dictionary
     """
-    with open(json_path) as in_file:
+    with open_text(json_path) as in_file:
         return json.load(in_file)
 
 
@@ -249,71 +300,57 @@ def main():
         sel_t_p, sel_t_r, sel_t_f1, sel_t_onto_conf, sel_t_rel_halluc, sel_t_sub_halluc, sel_t_obj_halluc = 0, 0, 0, 0, 0, 0, 0
         eval_metrics_list = list()
         onto_id = onto['id']
-        system_output = convert_to_dict(read_jsonl(onto['sys']))
-        ground_truth = convert_to_dict(read_jsonl(onto['gt']))
-        ontology = read_json(onto['onto'])
-        if 'selected_ids' in onto:
-            selected_ids = read_jsonl(onto['selected_ids'], is_json=False)
-        else:
-            selected_ids = []
-
-        # iterate through each element in the ground truth and evaluate the system output
-        for sent_id in list(ground_truth.keys()):
-            # collect the ground truth triples
-            gt_triples = [[tr['sub'], tr['rel'], tr['obj']] for tr in ground_truth[sent_id]['triples']]
-            sentence = ground_truth[sent_id]["sent"]
-
-            # check if system output as an entry for this sentence
-            if sent_id in system_output:
-                system_triples = system_output[sent_id]['triples']
-
-                # collect the set of relations in ground truth triples, spaces are converted to "_" to make them
-                # comparable with system triples
-                gt_relations = {tr[1].replace(" ", "_") for tr in gt_triples}
-
-                # filter out any triples in system output that does not match with ground truth relations
-                filtered_system_triples = [tr for tr in system_triples if tr[1] in gt_relations]
-
-                # create a normalized string from subject, relation, object of each triple for comparison
-                normalized_system_triples = {normalize_triple(tr[0], tr[1], tr[2]) for tr in filtered_system_triples}
-                normalized_gt_triples = {normalize_triple(tr[0], tr[1], tr[2]) for tr in gt_triples}
-
-                # compare the system output triples with ground truth triples and calculate precision, recall, f1
-                precision, recall, f1 = calculate_precision_recall_f1(normalized_gt_triples, normalized_system_triples)
-
-                # calculate ontology conformance and relation hallucination
-                ont_conformance, rel_hallucination = get_ontology_conformance(ontology, system_triples)
-
-                # calculate subject and object hallucination
-                subj_hallucination, obj_hallucination = get_subject_object_hallucinations(ps, ontology, sentence, system_triples)
-                if  f1 < 1  and len(filtered_system_triples) > 0 and subj_hallucination == 0 and obj_hallucination == 0:
-                    print(f"sent: {sentence}\nf1: {f1}\nsys:{filtered_system_triples}\nground:{gt_triples}\n\n")
-
-                eval_metrics = {"id": sent_id, "precision": f"{precision:.2f}" , "recall": f"{recall:.2f}", "f1": f"{f1:.2f}",
-                                "onto_conf": f"{ont_conformance:.2f}", "rel_halluc": f"{rel_hallucination:.2f}",
-                                "sub_halluc": f"{subj_hallucination:.2f}", "obj_halluc": f"{obj_hallucination:.2f}",
-                                "llm_triples": system_triples, "filtered_llm_triples": filtered_system_triples,
-                                "gt_triples": gt_triples, "sent": sentence}
-                eval_metrics_list.append(eval_metrics)
-
-                # aggregate precision, recall, f1 for later averaging
-                t_p += precision
-                t_r += recall
-                t_f1 += f1
-                t_onto_conf += ont_conformance
-                t_rel_halluc += rel_hallucination
-                t_sub_halluc += subj_hallucination
-                t_obj_halluc += obj_hallucination
-
-                # aggregate precision, recall, f1 for later averaging for selected ids
-                if sent_id in selected_ids:
-                    sel_t_p += precision
-                    sel_t_r += recall
-                    sel_t_f1 += f1
-                    sel_t_onto_conf += ont_conformance
-                    sel_t_rel_halluc += rel_hallucination
-                    sel_t_sub_halluc += subj_hallucination
-                    sel_t_obj_halluc += obj_hallucination
+        # system output is only looked up by id, plain files are read through the byte-offset index
+        with ExitStack() as stack:
+            system_output = open_keyed_jsonl(onto['sys'])
+            if isinstance(system_output, JsonlIndex):
+                # the index keeps the system output open, it is closed also when evaluating the ontology fails
+                stack.enter_context(system_output)
+            ground_truth = convert_to_dict(read_jsonl(onto['gt']))
+            ontology = read_json(onto['onto'])
+            if 'selected_ids' in onto:
+                selected_ids = read_jsonl(onto['selected_ids'], is_json=False)
+            else:
+                selected_ids = []
+
+            # iterate through each element in the ground truth and evaluate the system output
+            for sent_id in list(ground_truth.keys()):
+                # collect the ground truth triples
+                gt_triples = [[tr['sub'], tr['rel'], tr['obj']] for tr in ground_truth[sent_id]['triples']]
+                sentence = ground_truth[sent_id]["sent"]
+
+                # check if system output as an entry for this sentence
+                system_record = system_output.get(sent_id)
+                if system_record is not None:
+                    eval_metrics, scores = evaluate_sentence(ps, ontology, ground_truth[sent_id],
+                                                             system_record['triples'])
+                    precision, recall, f1 = scores['precision'], scores['recall'], scores['f1']
+                    ont_conformance, rel_hallucination = scores['onto_conf'], scores['rel_halluc']
+                    subj_hallucination, obj_hallucination = scores['sub_halluc'], scores['obj_halluc']
+                    filtered_system_triples = eval_metrics['filtered_llm_triples']
+                    if  f1 < 1  and len(filtered_system_triples) > 0 and subj_hallucination == 0 and obj_hallucination == 0:
+                        print(f"sent: {sentence}\nf1: {f1}\nsys:{filtered_system_triples}\nground:{gt_triples}\n\n")
+
+                    eval_metrics_list.append(eval_metrics)
+
+                    # aggregate precision, recall, f1 for later averaging
+                    t_p += precision
+                    t_r += recall
+                    t_f1 += f1
+                    t_onto_conf += ont_conformance
+                    t_rel_halluc += rel_hallucination
+                    t_sub_halluc += subj_hallucination
+                    t_obj_halluc += obj_hallucination
+
+                    # aggregate precision, recall, f1 for later averaging for selected ids
+                    if sent_id in selected_ids:
+                        sel_t_p += precision
+                        sel_t_r += recall
+                        sel_t_f1 += f1
+                        sel_t_onto_conf += ont_conformance
+                        sel_t_rel_halluc += rel_hallucination
+                        sel_t_sub_halluc += subj_hallucination
+                        sel_t_obj_halluc += obj_hallucination
 
         save_jsonl(eval_metrics_list, onto['output'])
         total_test_cases = len(ground_truth)